@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compares decoding a large HqlResult with the pure python and the
+fastbinary accelerated binary protocols.
+
+    $ python benchmarks/decode_cells.py --cells 10000 --repeat 5
+
+fastbinary of thrift 0.9 refuses lists of more than 10000 items, which
+ThriftClient decodes in python instead.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from hyperthrift.gen import ttypes
+from hyperthrift.gen2.ttypes import HqlResult
+from hypertable.thriftclient import ACCELERATED
+
+
+def make_payload(ncells, value_size):
+    value = b'x' * value_size
+    cells = [ttypes.Cell(key=ttypes.Key(row=b'row%08d' % i,
+                                        column_family=b'cf',
+                                        column_qualifier=b'q%d' % (i % 10),
+                                        timestamp=1396000000000000000 + i,
+                                        revision=i,
+                                        flag=255),
+                         value=value)
+             for i in range(ncells)]
+    buf = TTransport.TMemoryBuffer()
+    HqlResult(cells=cells).write(TBinaryProtocol.TBinaryProtocol(buf))
+    return buf.getvalue()
+
+
+def decode(payload, protocol_class, repeat):
+    best = None
+    for _ in range(repeat):
+        trans = TTransport.TMemoryBuffer(payload)
+        start = time.time()
+        result = HqlResult()
+        result.read(protocol_class(trans))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(result.cells)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--cells', type=int, default=10000)
+    parser.add_argument('--value-size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    payload = make_payload(args.cells, args.value_size)
+    print("%d cells, %d bytes" % (args.cells, len(payload)))
+
+    python, n = decode(payload, TBinaryProtocol.TBinaryProtocol,
+                       args.repeat)
+    print("python:     %8.3f secs, %10.0f cells/sec" % (python, n / python))
+
+    if not ACCELERATED:
+        print("fastbinary: unavailable or incompatible with this thrift")
+        return
+
+    fast, n = decode(payload, TBinaryProtocol.TBinaryProtocolAccelerated,
+                     args.repeat)
+    print("fastbinary: %8.3f secs, %10.0f cells/sec" % (fast, n / fast))
+    print("speedup:    %8.1fx" % (python / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compares encoding a set_cells request from Cell structs with encoding a
+set_cells_serialized request from a SerializedCellsWriter.
+
+    $ python benchmarks/encode_cells.py --cells 100000 --repeat 5
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from hyperthrift.gen import ClientService, ttypes
+from hypertable.thriftclient import ACCELERATED
+
+from flask_hypertable.serialized import SerializedCellsWriter
+
+
+def make_rows(ncells, value_size):
+    value = b'x' * value_size
+    return [(b'row%08d' % (i // 4), b'cf', b'q%d' % (i % 4), value)
+            for i in range(ncells)]
+
+
+def protocol(trans):
+    if ACCELERATED:
+        return TBinaryProtocol.TBinaryProtocolAccelerated(trans)
+    return TBinaryProtocol.TBinaryProtocol(trans)
+
+
+def encode_structs(rows):
+    cells = [ttypes.Cell(key=ttypes.Key(row=row, column_family=cf,
+                                        column_qualifier=cq),
+                         value=value)
+             for row, cf, cq, value in rows]
+    buf = TTransport.TMemoryBuffer()
+    ClientService.set_cells_args(ns=1, table_name=b'foo',
+                                 cells=cells).write(protocol(buf))
+    return buf.getvalue()
+
+
+def encode_serialized(rows):
+    writer = SerializedCellsWriter()
+    add = writer.add
+    for row, cf, cq, value in rows:
+        add(row, cf, cq, value)
+    buf = TTransport.TMemoryBuffer()
+    ClientService.set_cells_serialized_args(
+        ns=1, table_name=b'foo', cells=writer.getvalue()).write(protocol(buf))
+    return buf.getvalue()
+
+
+def measure(encode, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        payload = encode(rows)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(payload)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--cells', type=int, default=100000)
+    parser.add_argument('--value-size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    rows = make_rows(args.cells, args.value_size)
+    print("%d cells, codec: %s"
+          % (args.cells, ACCELERATED and 'fastbinary' or 'python'))
+
+    structs, structs_size = measure(encode_structs, rows, args.repeat)
+    print("set_cells:            %8.3f secs, %6.2f usecs/cell, %10d bytes"
+          % (structs, structs * 1e6 / args.cells, structs_size))
+
+    ser, ser_size = measure(encode_serialized, rows, args.repeat)
+    print("set_cells_serialized: %8.3f secs, %6.2f usecs/cell, %10d bytes"
+          % (ser, ser * 1e6 / args.cells, ser_size))
+    print("speedup:              %8.1fx" % (structs / ser))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,3 +22,11 @@ __license__ = 'BSD'
 __copyright__ = 'Copyright 2014 Fairiz Azizi'
 
 from .flask_hypertable import FlaskHypertable, FlaskPooledHypertable
+from .pool import ConnectionPool, BalancedPool, PoolTimeout
+from .breaker import CircuitBreaker
+from .pipeline import Pipeline
+from .scanner import Scanner
+from .mutator import Mutator, AsyncMutator, MutatorManager
+from .multiscan import MultiScan, ScanCancelled
+from .parallel import ParallelScan
+from .serialized import SerializedCellsReader, SerializedCellsWriter
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+__all__ = ['CircuitBreaker']
+
+import os
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """ Tracks the health of a single ThriftBroker.
+
+    After ``threshold`` consecutive connect or transport failures the
+    breaker trips: the broker is reported as unhealthy, so callers can
+    route around it, and a background thread starts probing it.
+    The probes back off exponentially, from ``backoff`` up to
+    ``max_backoff`` seconds, until one succeeds and the broker is
+    reported as healthy again.
+
+    >>> breaker = CircuitBreaker(probe=lambda: ping("ht1", 38080))
+    >>> if breaker.healthy:
+    ...     try:
+    ...         use("ht1", 38080)
+    ...     except TTransportException:
+    ...         breaker.record_failure()
+    ...     else:
+    ...         breaker.record_success()
+    """
+
+    def __init__(self, probe, threshold=3, backoff=1.0, max_backoff=30.0):
+        """
+        :param probe: a callable returning True if the broker answers,
+               it may also raise
+        :param threshold: the number of consecutive failures which trips
+               the breaker
+        :param backoff: seconds to wait before the first probe
+        :param max_backoff: the longest wait between two probes
+        """
+        if threshold < 1:
+            raise ValueError("threshold must be >= 1")
+        elif backoff <= 0 or max_backoff < backoff:
+            raise ValueError("expected 0 < backoff <= max_backoff")
+
+        self.probe = probe
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._healthy = True
+        self._failures = 0
+        self._next_backoff = backoff
+        self._prober_pid = None
+
+        self.trips = 0
+        self.probes = 0
+
+    @property
+    def healthy(self):
+        """ False while the breaker is tripped """
+        if not self._healthy and self._prober_pid != os.getpid():
+            # tripped in a parent process, whose prober did not survive
+            # the fork
+            with self._lock:
+                if not self._healthy and self._prober_pid != os.getpid():
+                    self._start_prober()
+        return self._healthy
+
+    @property
+    def failures(self):
+        """ the number of consecutive failures """
+        return self._failures
+
+    def record_success(self, recover=True):
+        """ resets the consecutive failures, closing the breaker
+
+        :param recover: if False, a tripped breaker is left tripped, for
+               successes which say nothing about the broker's recovery
+        """
+        if self._failures or not self._healthy:
+            with self._lock:
+                if self._healthy or recover:
+                    self._failures = 0
+                    self._healthy = True
+
+    def record_failure(self):
+        """ counts a failure, tripping the breaker at ``threshold``
+
+        :return: True if this failure tripped the breaker
+        """
+        with self._lock:
+            self._failures += 1
+            if not self._healthy or self._failures < self.threshold:
+                return False
+            self._healthy = False
+            self.trips += 1
+            self._next_backoff = self.backoff
+            self._start_prober()
+        return True
+
+    def _start_prober(self):
+        """ must hold the lock """
+        self._prober_pid = os.getpid()
+        t = threading.Thread(target=self._probe_loop, args=(self.trips,))
+        t.daemon = True
+        t.start()
+
+    def _probe_loop(self, trip):
+        while True:
+            time.sleep(self._next_backoff)
+
+            with self._lock:
+                if self._healthy or trip != self.trips:
+                    # recovered through regular traffic, a newer prober
+                    # takes over if it tripped again since
+                    return
+                self.probes += 1
+
+            try:
+                ok = self.probe()
+            except Exception:
+                ok = False
+
+            with self._lock:
+                if trip != self.trips:
+                    return
+                if ok or self._healthy:
+                    self._failures = 0
+                    self._healthy = True
+                    return
+                self._next_backoff = min(self._next_backoff * 2,
+                                         self.max_backoff)
@@ -8,11 +8,26 @@ __all__ = ['FlaskHypertable', 'FlaskPooledHypertable']
 
 import atexit
 
-from Queue import Queue, Empty, Full
-from hypertable.thriftclient import ThriftClient
+from ._compat import string_types
+from hypertable.thriftclient import ThriftClient, check_socket_options
+from hyperthrift.gen.ttypes import ClientException
 from thrift.transport import TTransport
 
+import logging
+import os
+import random
 import threading
+import time
+
+from collections import deque
+
+from .breaker import CircuitBreaker
+from .parallel import ParallelScan
+from .multiscan import MultiScan
+from .mutator import Mutator, AsyncMutator, MutatorManager
+from .pipeline import Pipeline
+from .scanner import Scanner
+from .pool import ConnectionPool, BalancedPool
 
 # Find the stack on which we want to store the database connection.
 # Starting with Flask 0.9, the _app_ctx_stack is the correct one,
@@ -22,11 +37,33 @@ try:
 except ImportError:
     from flask import _request_ctx_stack as stack
 
+log = logging.getLogger(__name__)
+
 # see http://flask.pocoo.org/docs/extensiondev/
 # pool settings inspired
 # by sqlalchemy: http://docs.sqlalchemy.org/en/rel_0_9/core/pooling.html
 
 
+def parse_hosts(hosts, default_port):
+    """ Normalizes the HYPERTABLE_HOSTS setting.
+
+    :param hosts: a list of ``'host:port'`` or ``'host'`` strings,
+           or ``(host, port)`` tuples
+    :param default_port: the port to use when none is given
+    :return: a list of ``(host, port)`` tuples
+    """
+    parsed = []
+    for entry in hosts:
+        if isinstance(entry, string_types):
+            host, sep, port = entry.rpartition(':')
+            if not sep:
+                host, port = port, default_port
+            entry = (host, int(port))
+        host, port = entry
+        parsed.append((host, int(port)))
+    return parsed
+
+
 class FlaskHypertable(object):
     """ Flask extension for the Hypertable ThriftClient.
 
@@ -36,11 +73,62 @@ class FlaskHypertable(object):
     HYPERTABLE_PORT: 38080
     HYPERTABLE_TIMEOUT_MSECS: 5000
 
+    #how long to wait for a connection to open, defaults to
+    #HYPERTABLE_TIMEOUT_MSECS which then only bounds each read
+    HYPERTABLE_CONNECT_TIMEOUT_MSECS: None
+
+    #applied to every new socket, see hypertable.thriftclient.TTunedSocket
+    #keys: nodelay, keepalive, keepalive_idle, keepalive_interval,
+    #keepalive_count, rcvbuf, sndbuf
+    HYPERTABLE_SOCKET_OPTIONS: {'nodelay': True}
+
+    #decode responses with thrift's fastbinary C extension when it is
+    #available and compatible, see ``ManagedThriftClient.codec``
+    HYPERTABLE_ACCELERATED: True
+
+    #several ThriftBrokers to spread the connections over, as 'host:port'
+    #strings or (host, port) tuples. Overrides HYPERTABLE_HOST/PORT
+    HYPERTABLE_HOSTS: []
+
+    #path of a ThriftBroker unix socket on this host, used instead of
+    #HYPERTABLE_HOST/PORT and HYPERTABLE_HOSTS
+    HYPERTABLE_UNIX_SOCKET: None
+
+    #with several HYPERTABLE_HOSTS, stop using a broker after this many
+    #consecutive connect or transport failures, 0 disables
+    HYPERTABLE_BREAKER_THRESHOLD: 3
+
+    #then probe it in the background, waiting this many seconds before
+    #the first probe and doubling up to HYPERTABLE_BREAKER_MAX_BACKOFF
+    HYPERTABLE_BREAKER_BACKOFF: 1.0
+    HYPERTABLE_BREAKER_MAX_BACKOFF: 30.0
+
+    #the most namespaces each connection's ``mns`` keeps open, closing the
+    #least recently used one beyond that. None for no limit
+    HYPERTABLE_NAMESPACE_CACHE_SIZE: None
+
+    #the shared mutators of ``ht.mutators``, see ``MutatorManager``:
+    #send a mutator's cells once this many are buffered
+    HYPERTABLE_MUTATOR_MAX_CELLS: 10000
+    #or once they take this many bytes
+    HYPERTABLE_MUTATOR_MAX_BYTES: 4194304
+    #commit the buffered cells every this many seconds
+    HYPERTABLE_MUTATOR_FLUSH_INTERVAL: 1.0
+    #have writes wait for the commit of their cells by default
+    HYPERTABLE_MUTATOR_WAIT: False
+
     Under the hood, this extension uses the ``ManagedThriftClient``.
     """
 
     app = None
     data = None
+    breakers = {}
+    accelerated = True
+    connect_timeout_msecs = None
+    unix_socket = None
+    socket_options = {}
+    namespace_cache_size = None
+    mutators = None
 
     def __init__(self, app=None, local=None):
         self.app = app
@@ -67,10 +155,61 @@ class FlaskHypertable(object):
         app.config.setdefault('HYPERTABLE_HOST', 'localhost')
         app.config.setdefault('HYPERTABLE_PORT', 38080)
         app.config.setdefault("HYPERTABLE_TIMEOUT_MSECS", 5000)
+        app.config.setdefault('HYPERTABLE_CONNECT_TIMEOUT_MSECS', None)
+        app.config.setdefault('HYPERTABLE_SOCKET_OPTIONS', {'nodelay': True})
+        app.config.setdefault('HYPERTABLE_ACCELERATED', True)
+        app.config.setdefault('HYPERTABLE_HOSTS', [])
+        app.config.setdefault('HYPERTABLE_UNIX_SOCKET', None)
+        app.config.setdefault('HYPERTABLE_BREAKER_THRESHOLD', 3)
+        app.config.setdefault('HYPERTABLE_BREAKER_BACKOFF', 1.0)
+        app.config.setdefault('HYPERTABLE_BREAKER_MAX_BACKOFF', 30.0)
+        app.config.setdefault('HYPERTABLE_NAMESPACE_CACHE_SIZE', None)
+        app.config.setdefault('HYPERTABLE_MUTATOR_MAX_CELLS', 10000)
+        app.config.setdefault('HYPERTABLE_MUTATOR_MAX_BYTES', 4 * 1024 * 1024)
+        app.config.setdefault('HYPERTABLE_MUTATOR_FLUSH_INTERVAL', 1.0)
+        app.config.setdefault('HYPERTABLE_MUTATOR_WAIT', False)
+
+        self.unix_socket = app.config['HYPERTABLE_UNIX_SOCKET']
+        if self.unix_socket:
+            self.hosts = []
+        else:
+            self.hosts = parse_hosts(app.config['HYPERTABLE_HOSTS'],
+                                     app.config['HYPERTABLE_PORT'])
+        if not self.hosts:
+            self.hosts = [(app.config['HYPERTABLE_HOST'],
+                           app.config['HYPERTABLE_PORT'])]
 
-        self.host = app.config['HYPERTABLE_HOST']
-        self.port = app.config['HYPERTABLE_PORT']
+        self.host, self.port = self.hosts[0]
         self.timeout_msecs = app.config['HYPERTABLE_TIMEOUT_MSECS']
+        self.connect_timeout_msecs = \
+            app.config['HYPERTABLE_CONNECT_TIMEOUT_MSECS']
+        self.socket_options = app.config['HYPERTABLE_SOCKET_OPTIONS']
+        check_socket_options(self.socket_options)
+        self.accelerated = app.config['HYPERTABLE_ACCELERATED']
+        self.namespace_cache_size = \
+            app.config['HYPERTABLE_NAMESPACE_CACHE_SIZE']
+        if self.namespace_cache_size is not None and \
+                self.namespace_cache_size < 1:
+            raise ValueError("Please specify HYPERTABLE_NAMESPACE_CACHE_SIZE "
+                             ">= 1 or None")
+
+        self.breakers = {}
+        threshold = app.config['HYPERTABLE_BREAKER_THRESHOLD']
+        if len(self.hosts) > 1 and threshold:
+            for host, port in self.hosts:
+                self.breakers[(host, port)] = CircuitBreaker(
+                    self._bind_probe(host, port),
+                    threshold=threshold,
+                    backoff=app.config['HYPERTABLE_BREAKER_BACKOFF'],
+                    max_backoff=app.config['HYPERTABLE_BREAKER_MAX_BACKOFF'])
+
+        # started on the first write
+        self.mutators = MutatorManager(
+            self._connect_mutators,
+            max_cells=app.config['HYPERTABLE_MUTATOR_MAX_CELLS'],
+            max_bytes=app.config['HYPERTABLE_MUTATOR_MAX_BYTES'],
+            flush_interval=app.config['HYPERTABLE_MUTATOR_FLUSH_INTERVAL'],
+            wait=app.config['HYPERTABLE_MUTATOR_WAIT'])
 
         # Use the newstyle teardown_appcontext if it's available,
         # otherwise fall back to the request context
@@ -86,22 +225,78 @@ class FlaskHypertable(object):
             pass  # just in case
 
     def close_app(self):
-        """ shutdowns this instance, releasing the connection pool """
-        pass
+        """ shutdowns this instance, committing the cells written through
+        ``mutators`` """
+        if self.mutators:
+            self.mutators.close()
 
     def connect(self):
-        """ Creates a new Thrift client
+        """ Creates a new Thrift client,
+        to a random healthy broker if several HYPERTABLE_HOSTS are
+        configured, moving on to the others if connecting fails.
+
         :return: ``ManagedThriftClient``
         """
-        return ManagedThriftClient(self.host,
-                                   self.port,
-                                   timeout_ms=self.timeout_msecs)
+        candidates = list(self.hosts)
+        random.shuffle(candidates)
+        # healthy brokers first, the others as a last resort
+        candidates.sort(key=lambda address: address in self.breakers
+                        and not self.breakers[address].healthy)
+
+        for i, (host, port) in enumerate(candidates):
+            breaker = self.breakers.get((host, port))
+            try:
+                client = self._open_client(host, port)
+            except Exception:
+                if breaker:
+                    breaker.record_failure()
+                if i == len(candidates) - 1:
+                    raise
+            else:
+                if breaker:
+                    breaker.record_success()
+                return client
+
+    def _connect_mutators(self):
+        """ a dedicated connection for ``mutators``, never a pooled one """
+        return FlaskHypertable.connect(self)
+
+    def _open_client(self, host, port):
+        return ManagedThriftClient(
+            host,
+            port,
+            timeout_ms=self.timeout_msecs,
+            connect_timeout_ms=self.connect_timeout_msecs,
+            socket_options=self.socket_options,
+            unix_socket=self.unix_socket,
+            accelerated=self.accelerated,
+            namespace_cache_size=self.namespace_cache_size)
+
+    def _bind_probe(self, host, port):
+        """ a CircuitBreaker probe, checking the broker with a new
+        connection """
+        def probe():
+            client = self._open_client(host, port)
+            try:
+                return client.ping()
+            finally:
+                client.close()
+        return probe
 
     def teardown(self, exception):
-        """ Puts the connection object back into the pool. """
+        """ Closes the connection.
+
+        :param: exception if a org.apache.thrift.transport.TTransportException,
+                it counts as a failure of the connection's broker
+        """
         ctx = stack.top
         if hasattr(ctx, 'ht_client'):
-            ctx.ht_client.close()
+            ht_client = ctx.ht_client
+            breaker = self.breakers.get((ht_client.host, ht_client.port))
+            if breaker and isinstance(exception,
+                                      TTransport.TTransportException):
+                breaker.record_failure()
+            ht_client.close()
 
     @property
     def connection(self):
@@ -128,7 +323,6 @@ class FlaskHypertable(object):
 
         if ht_client:
             if ht_client.is_active:
-                self.overflow_count = max(0, self.overflow_count - 1)
                 ht_client.close()
 
         self.data.ht_client = None
@@ -149,73 +343,168 @@ class FlaskPooledHypertable(FlaskHypertable):
     #if all connections are busy, create this many extra connections
     #0 disables
     HYPERTABLE_MAX_OVERFLOW: 10
+
+    #seconds to wait for a connection once the pool and overflow
+    #are exhausted, then raise PoolTimeout. None waits forever
+    HYPERTABLE_POOL_TIMEOUT: 30
+
+    #ping idle connections before handing them out, replacing
+    #the ones which no longer answer (e.g. after a broker restart)
+    HYPERTABLE_POOL_PRE_PING: False
+
+    #close connections older than this many seconds instead of reusing them
+    #None disables
+    HYPERTABLE_POOL_RECYCLE: None
+
+    #same as HYPERTABLE_POOL_RECYCLE, which it overrides when set
+    HYPERTABLE_POOL_MAX_LIFETIME: None
+
+    #close connections which sat unused in the pool for this many seconds
+    #None disables
+    HYPERTABLE_POOL_IDLE_TIMEOUT: None
+
+    #hand out the most recently used connection first, rather than
+    #rotating through all of them, so surplus ones can idle out
+    HYPERTABLE_POOL_LIFO: False
+
+    #open HYPERTABLE_POOL_SIZE connections in parallel in init_app(),
+    #so the first requests don't pay for connecting
+    HYPERTABLE_POOL_PREFILL: False
+
+    #namespaces to open on each new pooled connection, see ``mns``.
+    #They stay open for as long as the connection is pooled
+    HYPERTABLE_NAMESPACES: []
+
+    The connections are managed by a thread safe ``ConnectionPool``,
+    available as the ``pool`` member attribute. With several
+    HYPERTABLE_HOSTS, it is a ``BalancedPool`` holding one
+    ``ConnectionPool`` per broker, each sized as configured above.
     """
 
-    # a queue like collection
-    _q = None
+    pool = None
 
     pool_size = 1
     pool_overflow = 0
-    overflow_count = 0
+    pool_timeout = None
+    pool_pre_ping = False
+    pool_recycle = None
+    pool_idle_timeout = None
+    namespaces = ()
 
-    def init_app(self, app, local=None, qClass=None):
+    def init_app(self, app, local=None, qClass=None, lifo=None):
         """
         :param qClass the queue class to use, optional.
-               Default is ``Queue.Queue`
+               Default is ``Queue.Queue`, or ``Queue.LifoQueue`` if lifo
+        :param lifo bool, overrides HYPERTABLE_POOL_LIFO, optional.
         """
         FlaskHypertable.init_app(self, app, local=local)
 
-        self._q = None
+        self.pool = None
 
         app.config.setdefault('HYPERTABLE_POOL_SIZE', 5)
         app.config.setdefault('HYPERTABLE_MAX_OVERFLOW', 10)
+        app.config.setdefault('HYPERTABLE_POOL_TIMEOUT', 30)
+        app.config.setdefault('HYPERTABLE_POOL_PRE_PING', False)
+        app.config.setdefault('HYPERTABLE_POOL_RECYCLE', None)
+        app.config.setdefault('HYPERTABLE_POOL_MAX_LIFETIME', None)
+        app.config.setdefault('HYPERTABLE_POOL_IDLE_TIMEOUT', None)
+        app.config.setdefault('HYPERTABLE_POOL_LIFO', False)
+        app.config.setdefault('HYPERTABLE_POOL_PREFILL', False)
+        app.config.setdefault('HYPERTABLE_NAMESPACES', [])
 
         self.pool_size = app.config['HYPERTABLE_POOL_SIZE']
         self.pool_overflow = app.config['HYPERTABLE_MAX_OVERFLOW']
+        self.pool_timeout = app.config['HYPERTABLE_POOL_TIMEOUT']
+        self.pool_pre_ping = app.config['HYPERTABLE_POOL_PRE_PING']
+        self.pool_recycle = app.config['HYPERTABLE_POOL_MAX_LIFETIME']
+        if self.pool_recycle is None:
+            self.pool_recycle = app.config['HYPERTABLE_POOL_RECYCLE']
+        self.pool_idle_timeout = app.config['HYPERTABLE_POOL_IDLE_TIMEOUT']
+        self.namespaces = list(app.config['HYPERTABLE_NAMESPACES'])
+        if lifo is None:
+            lifo = app.config['HYPERTABLE_POOL_LIFO']
 
         if self.pool_size < 0:
             raise ValueError("Please specify HYPERTABLE_POOL_SIZE >= 0")
         elif self.pool_overflow < 0:
             raise ValueError("Please specify HYPERTABLE_MAX_OVERFLOW >= 0")
+        elif self.pool_timeout is not None and self.pool_timeout < 0:
+            raise ValueError("Please specify HYPERTABLE_POOL_TIMEOUT >= 0 "
+                             "or None")
+        elif self.pool_recycle is not None and self.pool_recycle < 0:
+            raise ValueError("Please specify HYPERTABLE_POOL_MAX_LIFETIME "
+                             ">= 0 or None")
+        elif self.pool_idle_timeout is not None and \
+                self.pool_idle_timeout < 0:
+            raise ValueError("Please specify HYPERTABLE_POOL_IDLE_TIMEOUT "
+                             ">= 0 or None")
+
+        options = dict(pool_size=self.pool_size,
+                       max_overflow=self.pool_overflow,
+                       qClass=qClass,
+                       timeout=self.pool_timeout,
+                       pre_ping=self.pool_pre_ping,
+                       recycle=self.pool_recycle,
+                       idle_timeout=self.pool_idle_timeout,
+                       lifo=lifo)
+
+        if len(self.hosts) > 1:
+            self.pool = BalancedPool(self._open_pooled_client, self.hosts,
+                                     breakers=self.breakers, **options)
+        else:
+            self.pool = ConnectionPool(self._create_client, **options)
 
-        qClass = qClass or Queue
-        self._q = qClass(maxsize=self.pool_size)
+        if app.config['HYPERTABLE_POOL_PREFILL']:
+            # the connections which did open are kept, the others will be
+            # opened on demand
+            try:
+                self.pool.prefill()
+            except Exception:
+                log.warning("could not prefill the connection pool",
+                            exc_info=True)
+
+    @property
+    def overflow_count(self):
+        """ the number of connections opened beyond the pool size """
+        return self.pool.overflow if self.pool else 0
 
     def close_app(self):
         """ shutdowns this instance, forcibly closing all opened
         connections """
         err = None
 
-        if self._q:
-            while True:
-                try:
-                    client = self._q.get_nowait()
-                    try:
-                        client.close()
-                    except Exception, e:
-                        err = e
-                except Empty:
-                    break
+        if self.pool:
+            err = self.pool.dispose()
 
         FlaskHypertable.close_app(self)
 
         if err:
+            raise err
+
+    def _create_client(self):
+        """ opens a brand new connection for the pool """
+        return self._open_pooled_client(self.host, self.port)
+
+    def _open_pooled_client(self, host, port):
+        """ opens a connection for the pool, with the
+        HYPERTABLE_NAMESPACES already open """
+        client = self._open_client(host, port)
+        try:
+            for name in self.namespaces:
+                client.mns.open_namespace(name)
+        except:
+            client.close()
             raise
+        return client
 
     def connect(self):
         """ Grabs a ThriftClient from the pool or create a new one
         if the pool is empty.
-        """
-        try:
-            client = self._q.get_nowait()
-        except Empty:
-            if self.overflow_count >= self.pool_overflow:
-                client = self._q.get(block=True)
-            else:
-                client = FlaskHypertable.connect(self)
-                self.overflow_count += 1
 
-        return client
+        :raise: PoolTimeout if the pool stayed exhausted for longer than
+                HYPERTABLE_POOL_TIMEOUT
+        """
+        return self.pool.checkout()
 
     # blow away the super class's teardown
     def teardown(self, exception):
@@ -227,30 +516,34 @@ class FlaskPooledHypertable(FlaskHypertable):
         """
         ctx = stack.top
         if hasattr(ctx, 'ht_client'):
-            if isinstance(exception, TTransport.TTransportException):
-                # throw it away
-                if ctx.ht_client.is_active:
-                    self.overflow_count = max(0, self.overflow_count - 1)
-                    ctx.ht_client.close()
-            else:
-                try:
-                    self._q.put_nowait(ctx.ht_client)
-                except Full:
-                    # musta overflowed
-                    self.overflow_count = max(0, self.overflow_count - 1)
-                    if ctx.ht_client.is_active:
-                        ctx.ht_client.close()
+            ht_client = ctx.ht_client
+            del ctx.ht_client
+            self.pool.checkin(
+                ht_client,
+                discard=isinstance(exception, TTransport.TTransportException))
 
     def put_back(self, ht_client):
         """ returns the client to the pool """
-
-        try:
-            self._q.put_nowait(ht_client)
-        except Full:
-            # musta overflowed
-            self.overflow_count = max(0, self.overflow_count - 1)
-            if ht_client.is_active:
-                ht_client.close()
+        self.pool.checkin(ht_client)
+
+    def parallel_scan(self, ns, table, scan_spec=None, workers=4,
+                      ordered=True):
+        """ Scans a table's splits concurrently on pooled connections,
+        see ``ParallelScan``.
+
+        >>> with ht.parallel_scan('test', 'foo', workers=8) as cells:
+        ...     for cell in cells:
+        ...         export(cell)
+
+        :param ns: the namespace name
+        :param workers: the most splits scanned at once, each holding
+               a pooled connection
+        :param ordered: yield the cells in row order, otherwise as soon
+               as they are fetched
+        :return: an iterable ``ParallelScan`` over the cells
+        """
+        return ParallelScan(self.pool, ns, table, scan_spec=scan_spec,
+                            workers=workers, ordered=ordered)
 
     # completely override based class
     def __exit__(self, t, value, traceback):
@@ -265,13 +558,9 @@ class FlaskPooledHypertable(FlaskHypertable):
                      or None)
 
         if ht_client:
-            if isinstance(value, TTransport.TTransportException):
-                # throw it away
-                if ht_client.is_active:
-                    self.overflow_count = max(0, self.overflow_count - 1)
-                    ht_client.close()
-            else:
-                self.put_back(ht_client)
+            self.pool.checkin(
+                ht_client,
+                discard=isinstance(value, TTransport.TTransportException))
 
         self.data.ht_client = None
 
@@ -289,15 +578,168 @@ class ManagedThriftClient(ThriftClient):
 
     mns = None
 
+    # when the connection was opened, see time.time()
+    created_at = None
+
+    # the process which opened the connection
+    pid = None
+
+    # namespace_exists() is answered by the broker without touching
+    # any RangeServer, which makes it a cheap round trip
+    ping_namespace = 'sys'
+
     def __init__(self, *args, **kwargs):
+        """ Takes the arguments of ``ThriftClient``, and
+
+        :param namespace_cache_size: the most namespaces ``mns`` keeps
+               open, None for no limit
+        """
+        namespace_cache_size = kwargs.pop('namespace_cache_size', None)
         ThriftClient.__init__(self, *args, **kwargs)
 
-        self.mns = ManagedNamespaces(self)
+        self.created_at = time.time()
+        self.pid = os.getpid()
+        self.mns = ManagedNamespaces(self, capacity=namespace_cache_size)
 
-    def close(self):
+    def ping(self):
+        """ Checks whether the connection is still usable by making
+        a cheap round trip to the broker.
+
+        :return: bool, False if the transport is closed or broken
+        """
+        if not self.is_active:
+            return False
+        try:
+            self.namespace_exists(self.ping_namespace)
+        except ClientException:
+            pass  # the broker answered, so the connection is fine
+        except Exception:
+            return False
+        return True
+
+    def pipeline(self, raise_on_error=True, max_in_flight=100):
+        """ Batches calls into about one round trip, see ``Pipeline``.
+
+        >>> ns = client.mns['test']
+        >>> with client.pipeline() as p:
+        ...     for row in ('a', 'b', 'c'):
+        ...         p.get_row(ns, 'foo', row)
+        >>> a, b, c = p.results
+        """
+        return Pipeline(self, raise_on_error=raise_on_error,
+                        max_in_flight=max_in_flight)
+
+    def scan(self, ns, table, scan_spec=None, prefetch=False):
+        """ Scans a table, see ``Scanner``.
+
+        >>> with client.scan('test', 'foo', prefetch=True) as cells:
+        ...     for cell in cells:
+        ...         export(cell)
+
+        :param ns: a namespace name or identifier
+        :param scan_spec: a ``ScanSpec``, by default the whole table
+        :param prefetch: fetch the next batch in the background, on a
+               dedicated connection, or that many batches if a number
+        :return: an iterable ``Scanner`` over the cells
+        """
+        return Scanner(self, ns, table, scan_spec=scan_spec,
+                       prefetch=prefetch)
+
+    def multi_scan(self, ns, scans, capacity=8 * 1024 * 1024,
+                   max_buffered=100000):
+        """ Runs several scans at once on this connection, see
+        ``MultiScan``.
+
+        >>> with client.multi_scan('test', [('foo', spec), 'bar']) as scans:
+        ...     foo, bar = scans
+        ...     rows = [cell.key.row for cell in foo]
+
+        :param ns: a namespace name or identifier
+        :param scans: a list of ``(table, scan_spec)`` tuples, or table
+               names to scan whole
+        :param capacity: the bytes of Results the broker may buffer
+        :param max_buffered: the most cells kept for the scans not being
+               read, beyond which the largest is cancelled
+        :return: a ``MultiScan``, a list of iterators over the cells of
+                 each scan
+        """
+        return MultiScan(self, ns, scans, capacity=capacity,
+                         max_buffered=max_buffered)
+
+    def mutator(self, ns, table, flags=0, max_cells=1000,
+                max_bytes=1024 * 1024, flush_interval=None):
+        """ Opens a client side buffered mutator, see ``Mutator``.
+
+        >>> with client.mutator('test', 'foo', max_cells=500) as mutator:
+        ...     for row, value in rows:
+        ...         mutator.set(row, 'cf', 'q', value)
+
+        :param ns: a namespace name or identifier
+        :param flags: ``MutatorFlag`` bits
+        :param max_cells: send the buffered cells once there are this many
+        :param max_bytes: or once they take this many bytes
+        :param flush_interval: or on the next write once the oldest
+               waited this many seconds
+        :return: the ``Mutator``
+        """
+        return Mutator(self, ns, table, flags=flags, max_cells=max_cells,
+                       max_bytes=max_bytes, flush_interval=flush_interval)
+
+    def async_mutator(self, ns, table, flags=0, max_cells=1000,
+                      max_bytes=1024 * 1024, flush_interval=None,
+                      max_in_flight=4):
+        """ Opens a buffered mutator keeping several batches in flight,
+        see ``AsyncMutator``.
+
+        >>> with client.async_mutator('test', 'foo', max_in_flight=8) as m:
+        ...     for row, value in rows:
+        ...         m.set(row, 'cf', 'q', value)
+
+        :param max_in_flight: the number of batches sent but not yet
+               acknowledged by the broker
+
+        The other parameters are those of ``mutator()``.
+
+        :return: the ``AsyncMutator``
+        """
+        return AsyncMutator(self, ns, table, flags=flags,
+                            max_cells=max_cells, max_bytes=max_bytes,
+                            flush_interval=flush_interval,
+                            max_in_flight=max_in_flight)
+
+    def clone(self):
+        """ Opens a new connection with the same settings. """
+        return self.__class__(self.host,
+                              self.port,
+                              timeout_ms=self.timeout_ms,
+                              connect_timeout_ms=self.connect_timeout_ms,
+                              socket_options=self.socket_options,
+                              unix_socket=self.unix_socket,
+                              accelerated=self.accelerated,
+                              namespace_cache_size=self.mns.capacity)
+
+    def detach(self):
+        """ Forgets this connection without talking to the broker.
+
+        Used after a fork: the parent process still owns the socket,
+        so neither the namespaces nor the connection may be closed
+        from here. Only this process's file descriptor is released.
+        Also used once the transport broke, when the broker could not
+        be reached anyway; it releases the namespaces of a connection
+        when the connection goes away.
+        """
         if self.mns:
-            self.mns.close()
-        ThriftClient.close(self)
+            self.mns.invalidate()
+        if self.do_close:
+            self.do_close = 0
+            self.transport.close()
+
+    def close(self):
+        try:
+            if self.mns:
+                self.mns.close()
+        finally:
+            ThriftClient.close(self)
 
     def __del__(self):
         try:
@@ -309,14 +751,42 @@ class ManagedThriftClient(ThriftClient):
 class ManagedNamespaces(object):
     """ Manages opening and closing namespaces.
 
-    Not thread safe.
+    Thread safe: a namespace requested by several threads at once is
+    opened once. The lock is not held during the RPCs, so the lookups of
+    opened namespaces never wait for the broker. With a ``capacity``,
+    opening one more namespace closes the least recently used one, which
+    must not be in use any more.
+
+    ``hits``, ``misses`` and ``evictions`` count the lookups answered
+    from the cache, those which opened the namespace, and the
+    namespaces closed to make room.
     """
 
     namespaces = None
 
-    def __init__(self, client):
+    def __init__(self, client, capacity=None):
+        """
+        :param client: the ``ManagedThriftClient``
+        :param capacity: the most namespaces kept open, None for no limit
+        """
+        if capacity is not None and capacity < 1:
+            raise ValueError("capacity must be at least 1, or None")
         self.client = client
+        self.capacity = capacity
         self.namespaces = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # name -> an Event set once the thread opening it is done
+        self._opening = {}
+        # with a capacity, name -> when it was last used, in lookups, and
+        # the (name, when) of every lookup since, oldest first. Only the
+        # latest lookup of a name counts, the others are skipped.
+        self._used = {}
+        self._order = deque()
+        self._clock = 0
 
     def __getitem__(self, key):
         return self.open_namespace(key)
@@ -331,14 +801,78 @@ class ManagedNamespaces(object):
         :param: name str: the name of the namespace
         :return: the namespace identifier
         """
+        while True:
+            with self._lock:
+                ns = self.namespaces.get(name)
+                if ns is not None:
+                    self.hits += 1
+                    self._touch(name)
+                    return ns
+                opening = self._opening.get(name)
+                if opening is None:
+                    opening = self._opening[name] = threading.Event()
+                    self.misses += 1
+                    break
+            # opened by another thread, or not if it failed
+            opening.wait()
 
-        if name in self.namespaces:
-            return self.namespaces[name]
-
-        ns = self.namespaces[name] = self.client.open_namespace(name)
-
+        evicted = []
+        try:
+            ns = self.client.open_namespace(name)
+            with self._lock:
+                self.namespaces[name] = ns
+                self._touch(name)
+                if self.capacity is not None:
+                    while len(self.namespaces) > self.capacity:
+                        evicted.append(self._pop_oldest())
+        finally:
+            with self._lock:
+                del self._opening[name]
+            opening.set()
+
+        for old_name, old_ns in evicted:
+            try:
+                self.client.close_namespace(old_ns)
+            except Exception:
+                log.warning("could not close the evicted namespace %s",
+                            old_name, exc_info=True)
         return ns
 
+    def _touch(self, name):
+        """ marks a namespace as the most recently used, must hold the
+        lock """
+        if self.capacity is None:
+            return
+        self._clock += 1
+        self._used[name] = self._clock
+        self._order.append((name, self._clock))
+        if len(self._order) > 2 * len(self._used) + 16:
+            # drop the outdated lookups, keeping the order
+            used = self._used
+            self._order = deque(entry for entry in self._order
+                                if used.get(entry[0]) == entry[1])
+
+    def _pop_oldest(self):
+        """ forgets the least recently used namespace, must hold the lock
+
+        :return: its ``(name, identifier)``
+        """
+        while True:
+            name, when = self._order.popleft()
+            if self._used.get(name) == when:
+                del self._used[name]
+                self.evictions += 1
+                return name, self.namespaces.pop(name)
+
+    def name_of(self, ns):
+        """ :return: the name of an opened namespace identifier, or None
+        """
+        with self._lock:
+            for name, ns_id in self.namespaces.items():
+                if ns_id == ns:
+                    return name
+        return None
+
     def close_namespace(self, name):
         """ Closes the specified namespace.
         Does nothing if already closed or was not previously opened.
@@ -346,17 +880,29 @@ class ManagedNamespaces(object):
         :param: name str: the name of the namespace
         :return: the previous identifier or None if never opened
         """
-        ns = self.namespaces.get(name)
+        with self._lock:
+            ns = self.namespaces.pop(name, None)
+            self._used.pop(name, None)
         if ns:
-            self.namespaces[name] = ns
             self.client.close_namespace(ns)
         return ns
 
     def close(self):
         """ Closes all previously opened namespaces. """
-
-        while self.namespaces:
-            self.close_namespace(self.namespaces.popitem()[1])
+        while True:
+            with self._lock:
+                if not self.namespaces:
+                    return
+                name = next(iter(self.namespaces))
+            self.close_namespace(name)
+
+    def invalidate(self):
+        """ Forgets the opened namespaces without closing them, e.g.
+        once the connection broke. """
+        with self._lock:
+            self.namespaces.clear()
+            self._used.clear()
+            self._order.clear()
 
     def __del__(self):
         """ Calls close(). """
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+__all__ = ['MultiScan', 'ScanCancelled']
+
+import logging
+
+from collections import deque
+
+from hyperthrift.gen.ttypes import ClientException, ScanSpec
+
+from ._compat import integer_types, string_types
+
+log = logging.getLogger(__name__)
+
+
+class ScanCancelled(Exception):
+    """ Raised by the iterator of a scan which was cancelled because its
+    cells piled up while the other scans were being read. """
+
+
+class MultiScan(object):
+    """ Runs several scans at once on a single connection, through the
+    broker's asynchronous scanners.
+
+    Every scanner is opened with ``async_scanner_open`` on one future.
+    The RangeServers then work on all of them concurrently, and their
+    ``Result`` batches, fetched with ``future_get_result``, are handed
+    to the scan whose scanner ``id`` they carry. A dozen independent
+    reads take about as long as the slowest one rather than their sum.
+
+    The scans are iterators over their cells, in the order given::
+
+        with client.multi_scan('test', [('users', spec),
+                                        ('orders', other_spec)]) as scans:
+            users, orders = scans
+            for cell in orders:
+                ...
+
+    They may be read in any order, the batches of the others are kept
+    until they are. A batch the broker reports as failed raises a
+    ``ClientException`` from the iterator of its scan. The Results do
+    not tell when a single scan is over, so each iterator only ends once
+    the future has nothing outstanding.
+
+    Two limits keep a large scan from taking up all the memory. The
+    broker buffers up to ``capacity`` bytes of Results, then pauses the
+    scans until they are fetched. Here, once more than ``max_buffered``
+    cells of the scans not being read are kept, the scan holding the most
+    is cancelled: its buffered cells are dropped and its iterator raises
+    ``ScanCancelled``. Reading the scans in turn, or each one to its end
+    before the next, never gets there as long as the smaller ones fit.
+    The iterators of scans left unfinished by ``close()`` raise it too.
+    """
+
+    def __init__(self, client, ns, scans, capacity=8 * 1024 * 1024,
+                 max_buffered=100000, timeout_ms=None):
+        """
+        :param client: a connected ``ManagedThriftClient``
+        :param ns: a namespace name or identifier
+        :param scans: a list of ``(table, scan_spec)`` tuples, or table
+               names to scan whole
+        :param capacity: the bytes of Results the broker may buffer, see
+               ``future_open``
+        :param max_buffered: the most cells kept for the scans not being
+               read, None for no limit
+        :param timeout_ms: how long the broker may wait for a ``Result``,
+               by default half the client's ``timeout_ms``
+        """
+        if not isinstance(ns, integer_types):
+            ns = client.mns[ns]
+
+        self.client = client
+        self.max_buffered = max_buffered
+        self.timeout_ms = timeout_ms or max(client.timeout_ms // 2, 1)
+        self.closed = False
+        self.done = False
+        self.results = 0
+        self.cancelled = 0
+
+        self._scanners = []
+        # scanner -> the Results not read yet, and their number of cells
+        self._pending = {}
+        self._buffered = {}
+        self._cancelled = set()
+        self._future = client.future_open(capacity)
+        try:
+            for scan in scans:
+                if isinstance(scan, string_types):
+                    table, scan_spec = scan, None
+                else:
+                    table, scan_spec = scan
+                scanner = client.async_scanner_open(
+                    ns, table, self._future, scan_spec or ScanSpec())
+                self._scanners.append(scanner)
+                self._pending[scanner] = deque()
+                self._buffered[scanner] = 0
+        except:
+            self.close()
+            raise
+
+        self.scans = [self._cells(s) for s in self._scanners]
+
+    def _cells(self, scanner):
+        pending = self._pending[scanner]
+        while True:
+            while not pending:
+                if scanner in self._cancelled:
+                    raise ScanCancelled(
+                        "more than %d cells of the other scans piled up "
+                        "while reading this one" % self.max_buffered)
+                if self.done:
+                    return
+                if self.closed:
+                    raise ScanCancelled("the scans were closed before this "
+                                        "one was over")
+                self._fetch(scanner)
+            result = pending.popleft()
+            cells = result.cells or ()
+            self._buffered[scanner] -= len(cells)
+            if result.is_error:
+                raise ClientException(code=result.error,
+                                      message=result.error_msg)
+            for cell in cells:
+                yield cell
+
+    def _fetch(self, reading):
+        """ hands the next Result to its scan
+
+        :param reading: the scanner whose cells are wanted
+        """
+        result = self.client.future_get_result(self._future, self.timeout_ms)
+        if result.is_empty:
+            self.done = True
+            return
+        self.results += 1
+        scanner = result.id
+        if scanner in self._cancelled:
+            return
+        if scanner not in self._pending:
+            log.warning("dropped a result for unknown scanner %s", scanner)
+            return
+
+        self._pending[scanner].append(result)
+        self._buffered[scanner] += len(result.cells or ())
+        if self.max_buffered is None or scanner == reading:
+            return
+        others = [s for s in self._buffered if s != reading]
+        while sum(self._buffered[s] for s in others) > self.max_buffered:
+            largest = max(others, key=self._buffered.get)
+            others.remove(largest)
+            self._cancel(largest)
+
+    def _cancel(self, scanner):
+        """ stops a scan, dropping its buffered cells """
+        log.warning("cancelling scanner %s, %d of its cells are buffered",
+                    scanner, self._buffered[scanner])
+        self.cancelled += 1
+        self._cancelled.add(scanner)
+        self._pending[scanner].clear()
+        del self._buffered[scanner]
+        self.client.async_scanner_cancel(scanner)
+
+    def close(self):
+        """ Cancels what is left of the scans, then closes the scanners
+        and the future. May be called more than once.
+
+        Unless every Result was already fetched, the buffered cells are
+        dropped and the iterators of the scans raise ``ScanCancelled``
+        rather than end as if they were over. """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not self.done:
+                for pending in self._pending.values():
+                    pending.clear()
+                self.client.future_cancel(self._future)
+            for scanner in self._scanners:
+                self.client.async_scanner_close(scanner)
+        finally:
+            self.client.future_close(self._future)
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __getitem__(self, index):
+        return self.scans[index]
+
+    def __iter__(self):
+        return iter(self.scans)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+__all__ = ['Mutator', 'AsyncMutator', 'MutatorManager']
+
+import logging
+import os
+import threading
+import time
+
+from Queue import Queue, Empty
+
+from hyperthrift.gen.ttypes import ClientException, KeyFlag
+from thrift.transport.TTransport import TTransportException
+
+from ._compat import integer_types, string_types
+from .serialized import SerializedCell, SerializedCellsWriter
+
+log = logging.getLogger(__name__)
+
+
+class Mutator(object):
+    """ Buffers cells on the client and sends them to a table mutator a
+    batch at a time, turning many small writes into a few large RPCs.
+
+    The cells are encoded by a ``SerializedCellsWriter`` and sent with
+    ``mutator_set_cells_serialized`` once ``max_cells`` cells or
+    ``max_bytes`` bytes are buffered, or when a write comes in more than
+    ``flush_interval`` seconds after the oldest buffered one.
+
+    ``close()`` sends what is left and closes the mutator, which the
+    ``with`` statement takes care of::
+
+        with client.mutator('test', 'users', max_cells=500) as mutator:
+            for user in users:
+                mutator.set(user.id, 'info', 'name', user.name)
+
+    Not thread safe.
+    """
+
+    def __init__(self, client, ns, table, flags=0, max_cells=1000,
+                 max_bytes=1024 * 1024, flush_interval=None):
+        """
+        :param client: a connected ``ManagedThriftClient``
+        :param ns: a namespace name or identifier
+        :param table: the table name
+        :param flags: ``MutatorFlag`` bits, e.g. ``NO_LOG_SYNC``
+        :param max_cells: send once this many cells are buffered,
+               None for no limit
+        :param max_bytes: send once the buffer grows this large,
+               None for no limit
+        :param flush_interval: send on the next write once the oldest
+               buffered cell waited this many seconds, None never does
+        """
+        if not isinstance(ns, integer_types):
+            ns = client.mns[ns]
+
+        self.client = client
+        self.table = table
+        self.max_cells = max_cells
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.closed = False
+
+        self._writer = SerializedCellsWriter()
+        self._oldest = None
+
+        self.cells = 0
+        self.flushes = 0
+
+        self._mutator = self._open(ns, table, flags)
+
+    def _open(self, ns, table, flags):
+        return self.client.mutator_open(ns, table, flags, 0)
+
+    @property
+    def pending(self):
+        """ the number of buffered cells """
+        return len(self._writer)
+
+    def set(self, row, column_family, column_qualifier=b'', value=b'',
+            timestamp=None, revision=None, flag=KeyFlag.INSERT):
+        """ Buffers a cell, see ``SerializedCellsWriter.add``. """
+        if self.closed:
+            raise ValueError("the mutator is closed")
+        self._writer.add(row, column_family, column_qualifier, value,
+                         timestamp, revision, flag)
+        self._added()
+
+    def set_cell(self, cell):
+        """ Buffers a ``Cell`` struct. """
+        if self.closed:
+            raise ValueError("the mutator is closed")
+        self._writer.add_cell(cell)
+        self._added()
+
+    def set_cells(self, cells):
+        """ Buffers a list of ``Cell`` structs. """
+        for cell in cells:
+            self.set_cell(cell)
+
+    def extend(self, writer):
+        """ Buffers the cells of a ``SerializedCellsWriter`` which is not
+        finalized. """
+        if self.closed:
+            raise ValueError("the mutator is closed")
+        if len(writer):
+            self._writer.extend(writer)
+            self._added(len(writer))
+
+    def delete_row(self, row):
+        """ Buffers the deletion of a whole row. """
+        self.set(row, b'', flag=KeyFlag.DELETE_ROW)
+
+    def _added(self, count=1):
+        self.cells += count
+        now = time.time()
+        if self._oldest is None:
+            self._oldest = now
+
+        writer = self._writer
+        if (self.max_cells is not None and len(writer) >= self.max_cells) \
+                or (self.max_bytes is not None
+                    and writer.size >= self.max_bytes) \
+                or (self.flush_interval is not None
+                    and now - self._oldest >= self.flush_interval):
+            self._send(False)
+
+    def _send(self, flush):
+        writer, self._writer = self._writer, SerializedCellsWriter()
+        self._oldest = None
+        if not len(writer):
+            if flush:
+                self.client.mutator_flush(self._mutator)
+            return
+        self.client.mutator_set_cells_serialized(self._mutator,
+                                                 writer.getvalue(), flush)
+        self.flushes += 1
+
+    def flush(self):
+        """ Sends the buffered cells and has the broker commit them. """
+        if self.closed:
+            raise ValueError("the mutator is closed")
+        self._send(True)
+
+    def discard(self):
+        """ Drops the buffered cells. """
+        self._writer = SerializedCellsWriter()
+        self._oldest = None
+
+    def close(self):
+        """ Sends the buffered cells and closes the mutator, which commits
+        them. May be called more than once. """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._send(False)
+        finally:
+            self.client.mutator_close(self._mutator)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        if t is None:
+            self.close()
+            return
+        # the pending cells are still sent, but nothing may hide the
+        # original error, e.g. from a broken connection
+        try:
+            self.close()
+        except Exception:
+            log.debug("could not close mutator %s", self._mutator,
+                      exc_info=True)
+
+
+class AsyncMutator(Mutator):
+    """ A ``Mutator`` keeping up to ``max_in_flight`` batches in flight,
+    through the broker's asynchronous mutator API.
+
+    Each batch is handed to ``async_mutator_set_cells_serialized``,
+    which returns as soon as the broker has it, while the RangeServers
+    apply it. The outcome of every batch comes back as a ``Result`` on
+    the mutator's ``future``; once ``max_in_flight`` batches are
+    outstanding, sending the next one first waits for a ``Result``.
+    The throughput is then no longer bound by a round trip per batch::
+
+        with client.async_mutator('test', 'logs', max_in_flight=8) as m:
+            for line in lines:
+                m.set(line.id, 'raw', value=line.text)
+
+    A failed batch raises a ``ClientException`` from the call which
+    drained its ``Result``, maybe a few batches later. ``flush()`` and
+    ``close()`` wait for every batch.
+    """
+
+    def __init__(self, client, ns, table, flags=0, max_cells=1000,
+                 max_bytes=1024 * 1024, flush_interval=None, max_in_flight=4,
+                 capacity=0, timeout_ms=None):
+        """
+        :param max_in_flight: the number of batches sent but not yet
+               acknowledged by a ``Result``
+        :param capacity: of the future, see ``future_open``
+        :param timeout_ms: how long the broker may wait for a ``Result``,
+               by default half the client's ``timeout_ms``
+
+        The other parameters are those of ``Mutator``.
+        """
+        self.max_in_flight = max(max_in_flight, 1)
+        self.capacity = capacity
+        self.timeout_ms = timeout_ms or max(client.timeout_ms // 2, 1)
+        self.in_flight = 0
+        self.errors = 0
+        self._future = None
+        Mutator.__init__(self, client, ns, table, flags=flags,
+                         max_cells=max_cells, max_bytes=max_bytes,
+                         flush_interval=flush_interval)
+
+    def _open(self, ns, table, flags):
+        self._future = self.client.future_open(self.capacity)
+        try:
+            return self.client.async_mutator_open(ns, table, self._future,
+                                                  flags)
+        except:
+            self.client.future_close(self._future)
+            raise
+
+    def _send(self, flush):
+        if not len(self._writer):
+            return
+        # make room for the batch, which stays buffered if an earlier
+        # one failed
+        self._drain(self.max_in_flight - 1)
+        writer, self._writer = self._writer, SerializedCellsWriter()
+        self._oldest = None
+        # flushed on the broker's side so that it is acknowledged by a
+        # Result
+        self.client.async_mutator_set_cells_serialized(
+            self._mutator, writer.getvalue(), True)
+        self.flushes += 1
+        self.in_flight += 1
+
+    def _drain(self, limit):
+        """ waits for Results until at most ``limit`` batches are in
+        flight """
+        while self.in_flight > limit:
+            result = self.client.future_get_result(self._future,
+                                                   self.timeout_ms)
+            if result.is_empty:
+                # nothing outstanding any more
+                self.in_flight = 0
+                return
+            self.in_flight -= 1
+            if result.is_error:
+                self.errors += 1
+                raise ClientException(code=result.error,
+                                      message=result.error_msg)
+
+    def flush(self):
+        """ Sends the buffered cells and waits for every batch. """
+        if self.closed:
+            raise ValueError("the mutator is closed")
+        self._send(True)
+        self._drain(0)
+
+    def close(self):
+        """ Sends the buffered cells, waits for every batch, then closes
+        the mutator and its future. May be called more than once. """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._send(False)
+            self._drain(0)
+        finally:
+            try:
+                self.client.async_mutator_close(self._mutator)
+            finally:
+                self.client.future_close(self._future)
+
+
+class _Waiter(object):
+    """ a caller waiting for its cells to be flushed """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def done(self, error=None):
+        """ answers the caller, only the first time """
+        if not self.event.is_set():
+            self.error = error
+            self.event.set()
+
+
+#: asks the background thread to flush everything, or to stop
+_FLUSH = object()
+_STOP = object()
+
+
+class MutatorManager(object):
+    """ Long-lived mutators shared by every request of the process, one
+    per ``(namespace, table, flags)``, fed by a background thread.
+
+    Request threads hand their cells over without waiting for the
+    broker. The thread drains what was queued in the meantime into
+    ``Mutator`` buffers, which are sent once ``max_cells`` or
+    ``max_bytes`` is reached and committed every ``flush_interval``
+    seconds. The larger the batches, the fewer the RPCs, whatever the
+    request rate::
+
+        ht.mutators.set('test', 'hits', request.path, 'count', value='1')
+
+    The cells are encoded by the calling thread, so an invalid one
+    raises ``ValueError`` right away. With ``wait=True``, the call
+    returns once the cells were committed, raising the error of their
+    mutator if they could not be. Otherwise writes are best effort: a
+    failure is logged and counted in ``errors``. It only loses the cells
+    buffered by the mutator which failed, or by all of them along with
+    the connection after a transport error, in which case the next
+    write reconnects.
+
+    The thread owns its connection, opened with ``connect`` when the
+    first cells arrive, so the namespace must be given by name. It is
+    started again in a process forked from this one.
+    """
+
+    def __init__(self, connect, max_cells=10000, max_bytes=4 * 1024 * 1024,
+                 flush_interval=1.0, wait=False):
+        """
+        :param connect: a callable returning a new ``ManagedThriftClient``
+        :param max_cells: send a mutator's buffer once it holds this many
+               cells, the cells of a single call are sent together
+        :param max_bytes: or once it grows this large
+        :param flush_interval: commit the cells written since the last
+               commit every this many seconds, None only commits on
+               ``flush()``, waiting writes and ``close()``
+        :param wait: the default of ``wait`` for the writes
+        """
+        self.connect = connect
+        self.max_cells = max_cells
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.wait = wait
+        self.closed = False
+
+        self.cells = 0
+        self.flushes = 0
+        self.errors = 0
+
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = Queue()
+        self._thread = None
+
+    def set(self, ns, table, row, column_family, column_qualifier=b'',
+            value=b'', timestamp=None, revision=None, flag=KeyFlag.INSERT,
+            flags=0, wait=None):
+        """ Writes a cell, see ``SerializedCellsWriter.add``.
+
+        :param ns: the namespace name
+        :param flags: the ``MutatorFlag`` bits of the mutator to use
+        :param wait: whether to return only once the cell was committed,
+               by default the manager's ``wait``
+        """
+        self.set_cells(ns, table, [SerializedCell(
+            row, column_family, column_qualifier, timestamp, revision, flag,
+            value)], flags=flags, wait=wait)
+
+    def set_cells(self, ns, table, cells, flags=0, wait=None):
+        """ Writes a list of ``Cell`` structs or ``SerializedCell`` tuples.
+
+        :param ns: the namespace name
+        :param flags: the ``MutatorFlag`` bits of the mutator to use
+        :param wait: whether to return only once the cells were
+               committed, by default the manager's ``wait``
+        :raise: ValueError if one of the cells is invalid, none of them
+                is written then
+        """
+        if not isinstance(ns, string_types):
+            raise ValueError("the namespace must be given by name, not %r"
+                             % (ns,))
+        writer = SerializedCellsWriter()
+        for cell in cells:
+            writer.add_cell(cell)
+        self._submit(((ns, table, flags), writer),
+                     self.wait if wait is None else wait)
+
+    def flush(self):
+        """ Commits every cell written so far, waiting for it. """
+        self._submit(_FLUSH, True)
+
+    def _submit(self, item, wait):
+        waiter = _Waiter() if wait else None
+        with self._lock:
+            if self.closed:
+                raise ValueError("the mutator manager is closed")
+            if self._pid != os.getpid():
+                # the parent's thread did not survive the fork
+                self._reset()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._queue,),
+                    name='hypertable-mutators')
+                self._thread.daemon = True
+                self._thread.start()
+            self._queue.put((item, waiter))
+
+        if waiter:
+            # a timeout keeps the wait interruptible, on Python 2.6 wait()
+            # always returns None
+            while not waiter.event.is_set():
+                waiter.event.wait(3600)
+            if waiter.error is not None:
+                raise waiter.error
+
+    def close(self, timeout=None):
+        """ Commits the pending cells, closes the mutators and the
+        connection, then stops the thread.
+
+        :param timeout: seconds to wait for the thread, None waits for it
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._queue.put((_STOP, None))
+        thread.join(timeout)
+
+    def _run(self, queue):
+        client = None
+        mutators = {}
+        # the mutators written to since their last commit
+        dirty = set()
+        deadline = None
+        stop = False
+
+        while not stop:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                items = [queue.get(True, timeout) if timeout is not None
+                         else queue.get()]
+            except Empty:
+                items = []
+            # coalesce whatever was queued meanwhile
+            while True:
+                try:
+                    items.append(queue.get_nowait())
+                except Empty:
+                    break
+
+            stop = any(item is _STOP for item, _ in items)
+            flush_all = stop or deadline is not None and \
+                time.time() >= deadline
+            waiters = [waiter for _, waiter in items if waiter]
+            unexpected = None
+            try:
+                # mutator key -> the waiters of the cells it buffers
+                waiting = {}
+                flushes = []
+                flush_error = None
+
+                for item, waiter in items:
+                    if item is _FLUSH:
+                        flush_all = True
+                        flushes.append(waiter)
+                        continue
+                    elif item is _STOP:
+                        continue
+                    key, writer = item
+                    try:
+                        if client is None:
+                            client = self.connect()
+                        mutator = mutators.get(key)
+                        if mutator is None:
+                            mutator = mutators[key] = Mutator(
+                                client, *key, max_cells=self.max_cells,
+                                max_bytes=self.max_bytes)
+                        mutator.extend(writer)
+                    except Exception as e:
+                        client = self._failed(e, key, len(writer), client,
+                                              mutators, dirty, waiting)
+                        if waiter:
+                            waiter.done(e)
+                        continue
+                    self.cells += len(writer)
+                    dirty.add(key)
+                    if waiter:
+                        waiting.setdefault(key, []).append(waiter)
+
+                commit = dirty if flush_all else set(waiting) & dirty
+                for key in list(commit):
+                    if key not in mutators:
+                        # lost along with the connection meanwhile
+                        continue
+                    try:
+                        mutators[key].flush()
+                    except Exception as e:
+                        flush_error = e
+                        client = self._failed(e, key, 0, client, mutators,
+                                              dirty, waiting)
+                        continue
+                    self.flushes += 1
+                    dirty.discard(key)
+                    for waiter in waiting.pop(key, ()):
+                        waiter.done()
+
+                for waiter in flushes:
+                    waiter.done(flush_error)
+
+                if stop:
+                    for key in list(mutators):
+                        if key not in mutators:
+                            # lost along with the connection meanwhile
+                            continue
+                        try:
+                            mutators[key].close()
+                        except Exception as e:
+                            client = self._failed(e, key, 0, client,
+                                                  mutators, dirty, waiting)
+            except Exception as e:
+                # the write failures are handled above, start over anyway
+                self.errors += 1
+                log.exception("the mutators' thread failed")
+                unexpected = e
+                if client is not None:
+                    try:
+                        client.close()
+                    except Exception:
+                        pass
+                client = None
+                mutators.clear()
+                dirty.clear()
+            finally:
+                # answers whoever is still waiting
+                for waiter in waiters:
+                    waiter.done(unexpected)
+
+            if not dirty or self.flush_interval is None:
+                deadline = None
+            elif deadline is None or flush_all:
+                deadline = time.time() + self.flush_interval
+
+        if client is not None:
+            try:
+                client.close()
+            except Exception:
+                log.debug("could not close the mutators' connection",
+                          exc_info=True)
+
+    def _failed(self, error, key, cells, client, mutators, dirty, waiting):
+        """ Drops what a failure lost: the mutator of ``key``, or every
+        mutator along with the connection after a transport error.
+        Their waiters get the error.
+
+        :param cells: the number of cells which could not be buffered
+        :return: the client to go on with, None to reconnect
+        """
+        self.errors += 1
+        broken = client is None or isinstance(error, TTransportException)
+        keys = list(mutators) if broken else [key]
+        lost = cells + sum(mutators[k].pending for k in keys
+                           if k in mutators)
+        log.error("could not write to %s, %d cells may be lost",
+                  '.'.join(str(part) for part in key[:2]), lost,
+                  exc_info=True)
+
+        for k in set(keys) | set([key]):
+            mutator = mutators.pop(k, None)
+            dirty.discard(k)
+            for waiter in waiting.pop(k, ()):
+                waiter.done(error)
+            if mutator is not None and not broken:
+                try:
+                    mutator.discard()
+                    mutator.close()
+                except Exception:
+                    log.debug("could not close the failed mutator of %s",
+                              k, exc_info=True)
+
+        if broken and client is not None:
+            # start over with a new connection
+            try:
+                client.close()
+            except Exception:
+                pass
+            client = None
+        return None if broken else client
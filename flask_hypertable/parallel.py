@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+__all__ = ['ParallelScan', 'split_intervals']
+
+import copy
+import logging
+import threading
+
+from Queue import Queue, Empty, Full
+
+from hyperthrift.gen.ttypes import RowInterval, ScanSpec
+from thrift.transport.TTransport import TTransportException
+
+from ._compat import string_types
+from .scanner import Scanner
+
+log = logging.getLogger(__name__)
+
+
+class ParallelScan(object):
+    """ Scans a table split by split, several splits at a time.
+
+    The ranges returned by ``get_table_splits`` are intersected with the
+    ``scan_spec``'s row intervals, and scanned by ``workers`` threads on
+    connections checked out of ``pool``. A ``BalancedPool`` hands each
+    split to the broker running on the split's RangeServer, if it knows
+    one.
+
+    With ``ordered``, the cells come back in row order: the splits are
+    handed out in order and read back one after the other, while the
+    workers scan ahead. Otherwise batches are yielded as soon as any
+    worker fetched them.
+
+    >>> with ParallelScan(ht.pool, 'test', 'foo', workers=8) as cells:
+    ...     for cell in cells:
+    ...         export(cell)
+
+    ``row_limit`` and ``cell_limit`` of the ``scan_spec`` apply to each
+    split. ``cell_intervals`` are not supported.
+    """
+
+    def __init__(self, pool, ns, table, scan_spec=None, workers=4,
+                 ordered=True, prefetch=2):
+        """
+        :param pool: a ``ConnectionPool`` or ``BalancedPool``
+        :param ns: the namespace name, opened on every connection
+        :param table: the table name
+        :param scan_spec: a ``ScanSpec``, by default every cell
+        :param workers: the most splits scanned at once
+        :param ordered: yield the cells in row order
+        :param prefetch: the number of batches each worker may fetch
+               ahead of the caller
+        """
+        if not isinstance(ns, string_types):
+            raise ValueError("parallel scans need the namespace name, "
+                             "namespace identifiers are per connection")
+        if workers < 1 or prefetch < 1:
+            raise ValueError("workers and prefetch must be >= 1")
+        scan_spec = scan_spec or ScanSpec()
+        if scan_spec.cell_intervals:
+            raise ValueError("cell_intervals are not supported")
+
+        self.pool = pool
+        self.ns = ns
+        self.table = table
+        self.scan_spec = scan_spec
+        self.ordered = ordered
+        self.closed = False
+
+        client = pool.checkout()
+        try:
+            splits = client.get_table_splits(client.mns[ns], table)
+        except Exception as e:
+            pool.checkin(client, discard=isinstance(e, TTransportException))
+            raise
+        pool.checkin(client)
+
+        self.splits = sorted(splits, key=lambda s: s.start_row or '')
+        self._tasks = Queue()
+        for split in self.splits:
+            intervals = split_intervals(split, scan_spec.row_intervals)
+            if not intervals:
+                continue
+            spec = copy.copy(scan_spec)
+            spec.row_intervals = intervals
+            prefer = [name for name in (split.hostname, split.ip_address)
+                      if name]
+            self._tasks.put((self._tasks.qsize(), spec, prefer))
+        self.tasks = self._tasks.qsize()
+
+        if ordered:
+            self._outputs = [Queue(prefetch) for _ in range(self.tasks)]
+        else:
+            self._outputs = Queue(prefetch * workers)
+
+        self._stop = threading.Event()
+        self._threads = []
+        for _ in range(min(workers, self.tasks)):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                index, spec, prefer = self._tasks.get_nowait()
+            except Empty:
+                return
+            if self.ordered:
+                out = self._outputs[index]
+            else:
+                out = self._outputs
+            self._scan(spec, prefer, out)
+
+    def _scan(self, spec, prefer, out):
+        try:
+            client = self.pool.checkout(prefer=prefer)
+        except Exception as e:
+            self._put(out, _Failure(e))
+            return
+
+        discard = False
+        try:
+            with Scanner(client, client.mns[self.ns], self.table,
+                         spec) as scanner:
+                for cells in scanner.batches():
+                    if not self._put(out, cells):
+                        return
+        except Exception as e:
+            discard = isinstance(e, TTransportException)
+            self._put(out, _Failure(e))
+        else:
+            self._put(out, _DONE)
+        finally:
+            self.pool.checkin(client, discard=discard)
+
+    def _put(self, out, item):
+        """ :return: False if the scan was closed meanwhile """
+        while not self._stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, out):
+        item = out.get()
+        if isinstance(item, _Failure):
+            raise item.exception
+        return item
+
+    def batches(self):
+        """ yields the lists of cells as they are fetched """
+        try:
+            if self.ordered:
+                for out in self._outputs:
+                    while True:
+                        cells = self._get(out)
+                        if cells is _DONE:
+                            break
+                        yield cells
+            else:
+                remaining = self.tasks
+                while remaining:
+                    cells = self._get(self._outputs)
+                    if cells is _DONE:
+                        remaining -= 1
+                    else:
+                        yield cells
+        finally:
+            self.close()
+
+    def __iter__(self):
+        for cells in self.batches():
+            for cell in cells:
+                yield cell
+
+    def close(self):
+        """ stops the workers and returns their connections """
+        if self.closed:
+            return
+        self.closed = True
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
+
+
+class _Failure(object):
+    """ an exception raised by a worker """
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+# the end of a split's cells
+_DONE = object()
+
+
+def _later_start(a, b):
+    """ the later of two ``(row, inclusive)`` starts, None is unbounded """
+    if a[0] is None:
+        return b
+    if b[0] is None or a[0] > b[0]:
+        return a
+    if a[0] < b[0]:
+        return b
+    return a[0], a[1] and b[1]
+
+
+def _earlier_end(a, b):
+    """ the earlier of two ``(row, inclusive)`` ends, None is unbounded """
+    if a[0] is None:
+        return b
+    if b[0] is None or a[0] < b[0]:
+        return a
+    if a[0] > b[0]:
+        return b
+    return a[0], a[1] and b[1]
+
+
+def split_intervals(split, row_intervals=None):
+    """ Intersects a ``TableSplit`` with row intervals.
+
+    A split covers the rows after its ``start_row``, up to and including
+    its ``end_row``. Empty rows are unbounded.
+
+    :param split: the ``TableSplit``
+    :param row_intervals: a list of ``RowInterval``, None for every row
+    :return: the list of non empty ``RowInterval`` within the split
+    """
+    split_start = (split.start_row or None, False)
+    split_end = (split.end_row or None, True)
+    if not row_intervals:
+        row_intervals = [RowInterval()]
+
+    intervals = []
+    for interval in row_intervals:
+        start = _later_start(split_start, (interval.start_row or None,
+                                           interval.start_inclusive))
+        end = _earlier_end(split_end, (interval.end_row or None,
+                                       interval.end_inclusive))
+        if start[0] is not None and end[0] is not None and \
+                (start[0] > end[0] or
+                 (start[0] == end[0] and not (start[1] and end[1]))):
+            continue
+        intervals.append(RowInterval(start_row=start[0],
+                                     start_inclusive=start[1],
+                                     end_row=end[0],
+                                     end_inclusive=end[1]))
+    return intervals
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+__all__ = ['Pipeline']
+
+from hyperthrift.gen.ttypes import ClientException
+from thrift.Thrift import TApplicationException
+
+
+class Pipeline(object):
+    """ Queues calls to a client's Thrift methods, then sends them back to
+    back and reads the replies in order, so N independent requests cost
+    about one round trip instead of N.
+
+    This relies on the ``send_X``/``recv_X`` split of the generated
+    clients, and on the ThriftBroker answering the requests of a
+    connection in the order they were sent.
+
+    >>> with client.pipeline() as p:
+    ...     p.get_row(ns, 'users', 'alice')
+    ...     p.get_cell(ns, 'users', 'bob', 'email')
+    >>> alice, email = p.results
+
+    Requests are sent in batches of ``max_in_flight``, so a long pipeline
+    does not fill up the socket buffers in both directions while neither
+    side reads.
+    """
+
+    def __init__(self, client, raise_on_error=True, max_in_flight=100):
+        """
+        :param client: a connected ``ManagedThriftClient``
+        :param raise_on_error: if True, ``execute()`` raises the first
+               exception any call failed with, once every reply was
+               read. Otherwise the exceptions take the place of the
+               failed calls' results.
+        :param max_in_flight: the most requests sent before their replies
+               are read
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be >= 1")
+
+        self.client = client
+        self.raise_on_error = raise_on_error
+        self.max_in_flight = max_in_flight
+        self.calls = []
+        self.results = None
+
+    def __getattr__(self, name):
+        if name.startswith('_') or \
+                not hasattr(self.client, 'send_' + name) or \
+                not hasattr(self.client, 'recv_' + name):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        queue.__name__ = str(name)
+        return queue
+
+    def __len__(self):
+        return len(self.calls)
+
+    def execute(self):
+        """ sends the queued calls and reads their replies
+
+        :return: the list of results, in the order of the calls
+        """
+        calls, self.calls = self.calls, []
+        results = []
+        for i in range(0, len(calls), self.max_in_flight):
+            batch = calls[i:i + self.max_in_flight]
+            self._send(batch)
+            for name, args, kwargs in batch:
+                # the connection is unusable after a transport error, so
+                # only the calls' own exceptions are collected
+                try:
+                    results.append(getattr(self.client, 'recv_' + name)())
+                except Exception as e:
+                    if not _is_reply(e):
+                        raise
+                    results.append(e)
+
+        self.results = results
+        if self.raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def _send(self, batch):
+        transport = self.client.transport
+        if not hasattr(transport, 'cork'):
+            # python 2.6, see hypertable.thriftclient.TFramedRecvTransport
+            for name, args, kwargs in batch:
+                getattr(self.client, 'send_' + name)(*args, **kwargs)
+            return
+
+        transport.cork()
+        try:
+            for name, args, kwargs in batch:
+                getattr(self.client, 'send_' + name)(*args, **kwargs)
+        except:
+            # nothing went out, the connection stays usable
+            transport.uncork(send=False)
+            raise
+        transport.uncork()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        if t is None and self.calls:
+            self.execute()
+
+
+def _is_reply(e):
+    """ True for an exception sent back by the broker, after which the
+    next reply can still be read """
+    return isinstance(e, (ClientException, TApplicationException))
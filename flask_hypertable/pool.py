@@ -0,0 +1,854 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+__all__ = ['ConnectionPool', 'BalancedPool', 'PoolTimeout', 'EVENTS',
+           'DISCARD_REASONS']
+
+import logging
+import os
+import random
+import threading
+import time
+
+from Queue import Queue, LifoQueue, Empty
+
+from ._compat import string_types
+
+log = logging.getLogger(__name__)
+
+#: the events which may be passed to ``ConnectionPool.listen``
+EVENTS = ('connect', 'checkout', 'checkin', 'discard', 'timeout')
+
+#: why a connection was thrown away, see the ``discard`` event
+#:
+#: * error: checked in with ``discard=True``, e.g. after a transport error
+#: * closed: checked in, or found idle, already closed
+#: * overflow: checked in while the pool already held ``pool_size``
+#: * recycle: older than ``recycle``
+#: * idle_timeout: idle for longer than ``idle_timeout``
+#: * ping: failed the ``pre_ping``
+#: * dispose: closed by ``dispose()``
+#: * fork: inherited from the parent process
+DISCARD_REASONS = ('error', 'closed', 'overflow', 'recycle', 'idle_timeout',
+                   'ping', 'dispose', 'fork')
+
+
+class PoolTimeout(Exception):
+    """ Raised when no connection became available within the pool's
+    ``timeout``. """
+
+
+class ConnectionPool(object):
+    """ A thread safe pool of Thrift client connections.
+
+    All of the bookkeeping (the idle queue, the number of opened
+    connections and the number of checked out connections) is guarded
+    by a single ``threading.Condition``, so the pool can never open more
+    than ``pool_size + max_overflow`` connections, no matter how many
+    threads are competing for them.
+
+    Connections are created and closed outside of the lock, so a slow
+    broker never blocks threads which are only returning connections.
+
+    The pool is fork safe: a child process (e.g. a gunicorn worker
+    forked after ``preload_app``) notices the pid change and starts over
+    with an empty pool. The inherited connections are ``detach()``-ed,
+    leaving the sockets to the parent process.
+
+    >>> pool = ConnectionPool(lambda: ManagedThriftClient("localhost", 38080))
+    >>> client = pool.checkout()
+    >>> pool.checkin(client)
+    """
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, qClass=None,
+                 timeout=30, pre_ping=False, recycle=None,
+                 idle_timeout=None, lifo=False):
+        """
+        :param creator: a callable returning a new, opened client
+        :param pool_size: the number of idle connections to keep around
+        :param max_overflow: how many connections may be opened beyond
+               ``pool_size`` when all of the pooled ones are busy
+        :param qClass: the queue class used to hold idle connections,
+               optional. Default is ``Queue.Queue``, or ``Queue.LifoQueue``
+               when ``lifo`` is set
+        :param timeout: seconds to wait for a connection when the pool
+               is exhausted before raising ``PoolTimeout``.
+               None waits forever.
+        :param pre_ping: bool, if True idle connections are ``ping()``-ed
+               before being handed out and replaced if they fail
+        :param recycle: seconds, connections older than this
+               (see ``created_at``) are closed instead of being reused.
+               None disables.
+        :param idle_timeout: seconds, connections which sat in the pool
+               for longer than this are closed. None disables.
+        :param lifo: bool, if True the most recently returned connection
+               is handed out first. Under light load only a few
+               connections stay busy and the others can time out.
+        """
+        if pool_size < 0:
+            raise ValueError("pool_size must be >= 0")
+        elif max_overflow < 0:
+            raise ValueError("max_overflow must be >= 0")
+        elif timeout is not None and timeout < 0:
+            raise ValueError("timeout must be >= 0 or None")
+        elif recycle is not None and recycle < 0:
+            raise ValueError("recycle must be >= 0 or None")
+        elif idle_timeout is not None and idle_timeout < 0:
+            raise ValueError("idle_timeout must be >= 0 or None")
+
+        self._creator = creator
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self.recycle = recycle
+        self.idle_timeout = idle_timeout
+
+        self._qClass = qClass or (LifoQueue if lifo else Queue)
+        self.lifo = issubclass(self._qClass, LifoQueue)
+
+        self._listeners = dict((event, []) for event in EVENTS)
+
+        self._reset_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """ (re)initializes the pool's state for the current process """
+        self._pid = os.getpid()
+        self._q = self._qClass(maxsize=self.pool_size)
+
+        self._cond = threading.Condition(threading.Lock())
+        self._opened = 0  # idle + checked out
+        self._checkedout = 0
+        self._idle_since = {}  # client -> time.time() of its checkin
+        self._next_sweep = 0
+
+        # how long checkouts had to wait for a connection
+        self.wait_count = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+
+        self.connects = 0
+        self.connect_errors = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.discards = {}  # reason -> count, see DISCARD_REASONS
+
+    def _check_pid(self):
+        """ Starts over with an empty pool after a fork.
+
+        The old lock may have been held by a thread which does not exist
+        in this process, so the idle connections are collected without it.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._reset_lock:
+            if self._pid == os.getpid():
+                return
+            inherited = list(self._idle_since)
+            self._reset()
+            if inherited:
+                self.discards['fork'] = len(inherited)
+        for client in inherited:
+            client.detach()
+            self._fire('discard', client, 'fork')
+
+    @property
+    def size(self):
+        """ the number of connections currently opened by this pool """
+        return self._opened
+
+    @property
+    def checkedout(self):
+        """ the number of connections currently in use """
+        return self._checkedout
+
+    @property
+    def idle(self):
+        """ the number of connections waiting in the pool """
+        return self._opened - self._checkedout
+
+    @property
+    def overflow(self):
+        """ the number of opened connections beyond ``pool_size`` """
+        return max(0, self._opened - self.pool_size)
+
+    @property
+    def full(self):
+        """ whether a checkout would have to wait for a checkin """
+        return self._checkedout >= self.pool_size + self.max_overflow
+
+    def stats(self):
+        """ A consistent snapshot of the pool's gauges and counters.
+
+        The counters are cumulative since the pool was created (or since
+        the last fork), so rates can be derived from two snapshots.
+
+        :return: dict
+        """
+        self._check_pid()
+        with self._cond:
+            return {
+                'pool_size': self.pool_size,
+                'max_overflow': self.max_overflow,
+                'size': self._opened,
+                'checkedout': self._checkedout,
+                'idle': self._opened - self._checkedout,
+                'overflow': max(0, self._opened - self.pool_size),
+                'connects': self.connects,
+                'connect_errors': self.connect_errors,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'discards': dict(self.discards),
+                'wait_count': self.wait_count,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'timeouts': self.timeouts,
+            }
+
+    def listen(self, event, fn=None):
+        """ Registers a callback for one of the pool's ``EVENTS``:
+
+        * ``connect(client)``: a new connection was opened
+        * ``checkout(client, waited)``: a connection was handed out,
+          after waiting ``waited`` seconds for it
+        * ``checkin(client)``: a connection was returned
+        * ``discard(client, reason)``: a connection was thrown away,
+          see ``DISCARD_REASONS``
+        * ``timeout(waited)``: ``PoolTimeout`` is about to be raised
+
+        Callbacks run on the calling thread, outside of the pool's lock.
+        Their errors are logged and otherwise ignored.
+
+        May be used as a decorator::
+
+            @ht.pool.listen('discard')
+            def on_discard(client, reason):
+                statsd.incr('hypertable.pool.discard.' + reason)
+        """
+        if event not in self._listeners:
+            raise ValueError("unknown pool event %r" % (event,))
+        if fn is None:
+            return lambda fn: self.listen(event, fn)
+        self._listeners[event].append(fn)
+        return fn
+
+    def _fire(self, event, *args):
+        for fn in self._listeners[event]:
+            try:
+                fn(*args)
+            except Exception:
+                log.exception("pool %s listener failed", event)
+
+    def checkout(self, prefer=None, block=True):
+        """ Grabs an idle connection from the pool, creates a new one
+        if the pool may still grow, or else waits for another thread
+        to return one.
+
+        :param prefer: ignored, see ``BalancedPool.checkout``
+        :param block: if False, raise ``PoolTimeout`` right away rather
+               than wait, without counting it as a timeout
+        :return: the client
+        :raise: PoolTimeout if nothing became available within ``timeout``
+        """
+        self._check_pid()
+        started = None
+        client = None
+        timed_out = full = False
+
+        with self._cond:
+            expired = self._sweep()
+            while True:
+                try:
+                    client = self._q.get_nowait()
+                except Empty:
+                    pass
+                else:
+                    idle_since = self._idle_since.pop(client)
+                    self._checkedout += 1
+                    self.checkouts += 1
+                    waited = self._record_wait(started)
+                    break
+
+                if self._opened < self.pool_size + self.max_overflow:
+                    # reserve the slot now, connect once the lock is released
+                    self._opened += 1
+                    self._checkedout += 1
+                    self.checkouts += 1
+                    waited = self._record_wait(started)
+                    break
+
+                if not block:
+                    full = True
+                    break
+
+                if started is None:
+                    started = time.time()
+
+                if self.timeout is None:
+                    self._cond.wait()
+                    continue
+
+                remaining = started + self.timeout - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    waited = self._record_wait(started)
+                    timed_out = True
+                    break
+                self._cond.wait(remaining)
+
+        self._close_expired(expired)
+
+        if full:
+            raise PoolTimeout("the pool is full (pool_size=%s, "
+                              "max_overflow=%s)"
+                              % (self.pool_size, self.max_overflow))
+        if timed_out:
+            self._fire('timeout', waited)
+            raise PoolTimeout(
+                "no connection available within %ss "
+                "(pool_size=%s, max_overflow=%s)"
+                % (self.timeout, self.pool_size, self.max_overflow))
+
+        if client is not None:
+            reason = self._stale_reason(client, idle_since)
+            if reason is None:
+                self._fire('checkout', client, waited)
+                return client
+            # stale, reuse its slot for a fresh connection
+            with self._cond:
+                self._count_discard(reason)
+            if reason == 'ping':
+                # broken, closing its namespaces would only time out
+                client.detach()
+            else:
+                _close_quietly(client)
+            self._fire('discard', client, reason)
+
+        client = self._connect()
+        self._fire('checkout', client, waited)
+        return client
+
+    def _connect(self):
+        """ opens a connection for an already reserved slot """
+        try:
+            client = self._creator()
+        except:
+            self._release()
+            raise
+        with self._cond:
+            self.connects += 1
+        self._fire('connect', client)
+        return client
+
+    def _stale_reason(self, client, idle_since):
+        """ validates an idle connection, called without the lock held
+
+        :return: why the client should be discarded, or None if usable
+        """
+        reason = self._expiry_reason(client, idle_since, time.time())
+        if reason is None:
+            if self.pre_ping:
+                if not client.ping():
+                    reason = 'ping'
+            elif not client.is_active:
+                reason = 'closed'
+        return reason
+
+    def _expiry_reason(self, client, idle_since, now):
+        """ checks the recycle and idle_timeout limits """
+        if self.recycle is not None and \
+                now - client.created_at > self.recycle:
+            return 'recycle'
+        if self.idle_timeout is not None and \
+                now - idle_since > self.idle_timeout:
+            return 'idle_timeout'
+        return None
+
+    def _count_discard(self, reason):
+        """ must hold the lock """
+        self.discards[reason] = self.discards.get(reason, 0) + 1
+
+    def _sweep(self):
+        """ Removes the expired idle connections, must hold the lock.
+        Runs at most every half of the shortest limit, since it has to
+        look at every idle connection.
+
+        :return: the removed (client, reason) pairs, to be closed once
+                 the lock is released
+        """
+        limits = [limit for limit in (self.recycle, self.idle_timeout)
+                  if limit is not None]
+        now = time.time()
+        if not limits or now < self._next_sweep:
+            return []
+        self._next_sweep = now + min(limits) / 2
+
+        kept, expired = [], []
+        while True:
+            try:
+                client = self._q.get_nowait()
+            except Empty:
+                break
+            reason = self._expiry_reason(client, self._idle_since[client],
+                                         now)
+            if reason:
+                del self._idle_since[client]
+                self._count_discard(reason)
+                expired.append((client, reason))
+            else:
+                kept.append(client)
+
+        # put the survivors back in their original order
+        for client in (reversed(kept) if self.lifo else kept):
+            self._q.put_nowait(client)
+        self._opened -= len(expired)
+        if expired:
+            self._cond.notify(len(expired))
+        return expired
+
+    def _close_expired(self, expired):
+        for client, reason in expired:
+            _close_quietly(client)
+            self._fire('discard', client, reason)
+
+    def sweep(self):
+        """ Closes the idle connections which exceeded ``idle_timeout``
+        or ``recycle``. This already happens lazily on checkout and
+        checkin, but may be called from a timer as well.
+
+        :return: the number of connections closed
+        """
+        self._check_pid()
+        with self._cond:
+            self._next_sweep = 0
+            expired = self._sweep()
+        self._close_expired(expired)
+        return len(expired)
+
+    def _record_wait(self, started):
+        """ accounts for a checkout which had to wait, must hold the lock
+
+        :return: the seconds waited
+        """
+        if started is None:
+            return 0.0
+        waited = time.time() - started
+        self.wait_count += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return waited
+
+    def checkin(self, client, discard=False):
+        """ Returns a connection to the pool.
+
+        The connection is closed instead when ``discard`` is set,
+        when it is no longer active, or when the pool already holds
+        ``pool_size`` idle connections.
+
+        :param client: a client previously returned by ``checkout``
+        :param discard: bool, if True the client is closed and thrown away
+        """
+        self._check_pid()
+        if client.pid != self._pid:
+            # checked out before a fork, the socket belongs to the parent
+            client.detach()
+            self._fire('discard', client, 'fork')
+            return
+
+        reason = None
+        if discard:
+            reason = 'error'
+        elif not client.is_active:
+            reason = 'closed'
+
+        with self._cond:
+            self._checkedout -= 1
+            self.checkins += 1
+            if reason is None and self._opened - self._checkedout > \
+                    self.pool_size:
+                reason = 'overflow'
+
+            if reason:
+                self._opened -= 1
+                self._count_discard(reason)
+            else:
+                self._q.put_nowait(client)
+                self._idle_since[client] = time.time()
+
+            self._cond.notify()
+            expired = self._sweep()
+
+        self._fire('checkin', client)
+        if reason == 'error':
+            # most likely a broken transport, which would only time out
+            # closing the namespaces
+            client.detach()
+            self._fire('discard', client, reason)
+        elif reason:
+            _close_quietly(client)
+            self._fire('discard', client, reason)
+        self._close_expired(expired)
+
+    def prefill(self, setup=None):
+        """ Opens connections, in parallel, until the pool holds
+        ``pool_size`` of them. They go straight to the idle connections,
+        without counting as checkins nor firing ``checkin``.
+
+        :param setup: optional callable invoked with each new client
+               before it is added to the pool, e.g. to open namespaces
+        :return: the number of connections opened
+        :raise: the first error encountered, once every connection
+                attempt has finished. The successful ones are kept.
+        """
+        self._check_pid()
+        with self._cond:
+            count = max(0, self.pool_size - self._opened)
+            self._opened += count
+            self._checkedout += count
+
+        opened = []
+        errors = []
+
+        def open_one():
+            try:
+                client = self._connect()
+            except Exception as e:
+                errors.append(e)
+                return
+            reason = None
+            try:
+                if setup is not None:
+                    setup(client)
+            except Exception as e:
+                errors.append(e)
+                reason = 'error'
+
+            with self._cond:
+                self._checkedout -= 1
+                if reason is None and self._opened - self._checkedout > \
+                        self.pool_size:
+                    # overflow connections were returned meanwhile
+                    reason = 'overflow'
+                if reason:
+                    self._opened -= 1
+                    self._count_discard(reason)
+                else:
+                    self._q.put_nowait(client)
+                    self._idle_since[client] = time.time()
+                    opened.append(client)
+                self._cond.notify()
+            if reason:
+                _close_quietly(client)
+                self._fire('discard', client, reason)
+
+        threads = [threading.Thread(target=open_one) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+        return len(opened)
+
+    def _release(self):
+        """ gives back a reserved slot whose connection never opened """
+        with self._cond:
+            self._opened -= 1
+            self._checkedout -= 1
+            self.connect_errors += 1
+            self._cond.notify()
+
+    def dispose(self, detach=False):
+        """ Closes all of the idle connections.
+        Connections which are checked out are closed when checked in.
+
+        :param detach: ``detach()`` the connections rather than closing
+               them, without a word to a broker which is most likely gone
+        :return: the last exception raised while closing, if any
+        """
+        self._check_pid()
+        clients = []
+        with self._cond:
+            while True:
+                try:
+                    clients.append(self._q.get_nowait())
+                except Empty:
+                    break
+            self._idle_since.clear()
+            self._opened -= len(clients)
+            if clients:
+                self.discards['dispose'] = \
+                    self.discards.get('dispose', 0) + len(clients)
+            self._cond.notify_all()
+
+        err = None
+        for client in clients:
+            if detach:
+                client.detach()
+            else:
+                try:
+                    client.close()
+                except Exception as e:
+                    err = e
+            self._fire('discard', client, 'dispose')
+        return err
+
+
+class BalancedPool(object):
+    """ Spreads connections over several ThriftBrokers.
+
+    Keeps one ``ConnectionPool`` per broker and sends each checkout to
+    the less busy of two randomly picked brokers ("power of two
+    choices"), where busy means the number of checked out connections.
+    This follows the least loaded brokers without every thread piling
+    onto the same one. Brokers whose pool is full are skipped, a
+    checkout only waits once all of them are.
+
+    With ``breakers``, brokers whose ``CircuitBreaker`` tripped are left
+    out until they recover. Connect failures and connections checked in
+    with ``discard=True`` count as failures. A checkout which fails to
+    connect is retried on the other brokers.
+
+    Offers the same interface as ``ConnectionPool``. The sizing options
+    apply to each broker's pool.
+
+    >>> pool = BalancedPool(ManagedThriftClient,
+    ...                     [("ht1", 38080), ("ht2", 38080)])
+    >>> client = pool.checkout()
+    >>> pool.checkin(client)
+    """
+
+    def __init__(self, creator, hosts, breakers=None, **kwargs):
+        """
+        :param creator: a callable taking ``(host, port)`` and returning
+               a new, opened client, which must expose ``host`` and
+               ``port``
+        :param hosts: a list of ``(host, port)`` tuples
+        :param breakers: optional dict of ``(host, port)`` to
+               ``CircuitBreaker``
+        :param kwargs: passed to each ``ConnectionPool``
+        """
+        if not hosts:
+            raise ValueError("at least one host is required")
+
+        self.hosts = list(hosts)
+        self.breakers = breakers or {}
+        # a seeded ``random.Random`` makes the choices repeatable
+        self._random = random
+        self.pools = dict(
+            (address, ConnectionPool(self._bind(creator, address), **kwargs))
+            for address in self.hosts)
+        self._pool_list = [self.pools[address] for address in self.hosts]
+
+        first = self._pool_list[0]
+        self.pool_size = first.pool_size
+        self.max_overflow = first.max_overflow
+        self.timeout = first.timeout
+        self.pre_ping = first.pre_ping
+        self.recycle = first.recycle
+        self.idle_timeout = first.idle_timeout
+        self.lifo = first.lifo
+
+    @property
+    def size(self):
+        return sum(pool.size for pool in self._pool_list)
+
+    @property
+    def checkedout(self):
+        return sum(pool.checkedout for pool in self._pool_list)
+
+    @property
+    def idle(self):
+        return sum(pool.idle for pool in self._pool_list)
+
+    @property
+    def overflow(self):
+        return sum(pool.overflow for pool in self._pool_list)
+
+    def _bind(self, creator, address):
+        """ wraps the creator, feeding the broker's circuit breaker """
+        host, port = address
+
+        def create():
+            try:
+                client = creator(host, port)
+            except Exception:
+                self._record_failure(address)
+                raise
+            self._record_success(address)
+            return client
+        return create
+
+    def _record_success(self, address):
+        breaker = self.breakers.get(address)
+        if breaker:
+            breaker.record_success()
+
+    def _record_failure(self, address):
+        breaker = self.breakers.get(address)
+        if breaker and breaker.record_failure():
+            # the idle connections are most likely dead as well, closing
+            # their namespaces would only wait for the read timeouts
+            self.pools[address].dispose(detach=True)
+
+    def _candidates(self, exclude=()):
+        """ :return: the healthy brokers not in ``exclude``, or all of
+        them if none is healthy """
+        candidates = [address for address in self.hosts
+                      if address not in exclude]
+        healthy = [address for address in candidates
+                   if address not in self.breakers
+                   or self.breakers[address].healthy]
+        return healthy or candidates
+
+    def _choose(self, candidates, prefer=None):
+        """ Picks the least busy broker on one of the ``prefer`` hosts,
+        else the less busy of two random candidates ("power of two
+        choices"), busy meaning the number of checked out connections.
+
+        :return: the ``(host, port)``
+        """
+        def busy(address):
+            return self.pools[address].checkedout
+
+        if prefer:
+            if isinstance(prefer, string_types):
+                prefer = (prefer,)
+            preferred = [address for address in candidates
+                         if address[0] in prefer]
+            if preferred:
+                return min(preferred, key=busy)
+
+        if len(candidates) < 2:
+            return candidates[0]
+        a, b = self._random.sample(candidates, 2)
+        return a if busy(a) <= busy(b) else b
+
+    def checkout(self, prefer=None):
+        """ Grabs a connection from one of the less busy brokers whose
+        pool is not full, moving on to the next one if connecting fails.
+        Only once every pool is full, waits for a connection on one of
+        them.
+
+        :param prefer: a host name, or several names of the same host,
+               whose broker is used if it is healthy and not full, e.g.
+               the ``hostname`` and ``ip_address`` of a ``TableSplit``
+        :return: the client
+        :raise: PoolTimeout if every pool stayed exhausted, or the last
+                connect error if no broker could be reached
+        """
+        tried = set()
+        while True:
+            candidates = self._candidates(exclude=tried)
+            available = [address for address in candidates
+                         if not self.pools[address].full]
+            if available:
+                attempts = [(self._choose(available, prefer), False)]
+            else:
+                # take a connection returned to any of them meanwhile,
+                # before waiting on one
+                attempts = [(address, False) for address in candidates]
+                attempts.append((self._choose(candidates, prefer), True))
+
+            for address, block in attempts:
+                try:
+                    return self.pools[address].checkout(block=block)
+                except PoolTimeout:
+                    if block:
+                        raise
+                    # filled up by another thread, look again
+                except Exception:
+                    tried.add(address)
+                    if len(tried) == len(self.hosts):
+                        raise
+                    break
+
+    def checkin(self, client, discard=False):
+        """ Returns a connection to its broker's pool.
+        ``discard=True`` counts as a failure of that broker. """
+        address = (client.host, client.port)
+        self.pools[address].checkin(client, discard=discard)
+        if discard:
+            self._record_failure(address)
+        else:
+            breaker = self.breakers.get(address)
+            if breaker:
+                # the connection may predate a trip, the broker only
+                # recovers through new connections and the probes
+                breaker.record_success(recover=False)
+
+    def stats(self):
+        """ The sum of every broker's ``ConnectionPool.stats()``,
+        along with the per broker snapshots under ``hosts``.
+
+        :return: dict
+        """
+        hosts = dict(('%s:%s' % address, self.pools[address].stats())
+                     for address in self.hosts)
+        totals = {'hosts': hosts, 'discards': {}}
+        for stats in hosts.values():
+            for key, value in stats.items():
+                if key == 'discards':
+                    for reason, count in value.items():
+                        totals['discards'][reason] = \
+                            totals['discards'].get(reason, 0) + count
+                elif key == 'max_wait_time':
+                    totals[key] = max(totals.get(key, 0.0), value)
+                elif key not in ('pool_size', 'max_overflow'):
+                    totals[key] = totals.get(key, 0) + value
+        totals['pool_size'] = self.pool_size
+        totals['max_overflow'] = self.max_overflow
+
+        for address in self.hosts:
+            breaker = self.breakers.get(address)
+            hosts['%s:%s' % address]['healthy'] = \
+                breaker.healthy if breaker else True
+        return totals
+
+    def listen(self, event, fn=None):
+        """ Registers the callback with every broker's pool,
+        see ``ConnectionPool.listen``. """
+        if fn is None:
+            return lambda fn: self.listen(event, fn)
+        for pool in self._pool_list:
+            pool.listen(event, fn)
+        return fn
+
+    def sweep(self):
+        return sum(pool.sweep() for pool in self._pool_list)
+
+    def prefill(self, setup=None):
+        """ Prefills every broker's pool, see ``ConnectionPool.prefill``.
+        """
+        opened = 0
+        err = None
+        for pool in self._pool_list:
+            try:
+                opened += pool.prefill(setup=setup)
+            except Exception as e:
+                err = err or e
+        if err:
+            raise err
+        return opened
+
+    def dispose(self):
+        err = None
+        for pool in self._pool_list:
+            err = pool.dispose() or err
+        return err
+
+
+def _close_quietly(client):
+    """ closes a client which is being thrown away, most likely because
+    its transport is already broken """
+    try:
+        if client.is_active:
+            client.close()
+    except Exception:
+        pass
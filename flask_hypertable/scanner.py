@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+__all__ = ['Scanner']
+
+import logging
+import threading
+
+from Queue import Queue, Full
+
+from hyperthrift.gen.ttypes import ScanSpec
+
+from ._compat import integer_types
+
+log = logging.getLogger(__name__)
+
+
+class Scanner(object):
+    """ Iterates over the cells of a table scan, fetched a
+    ``scanner_get_cells`` batch at a time.
+
+    The scanner is closed once the cells run out, or by ``close()``,
+    which the ``with`` statement calls even if the loop stops early::
+
+        with client.scan(client.mns['test'], 'foo') as cells:
+            for cell in cells:
+                print(cell.key.row, cell.value)
+
+    With ``prefetch``, a background thread opens the scanner on a
+    dedicated connection, a ``clone()`` of the client, and fetches up to
+    that many batches ahead of the caller. Network latency then overlaps
+    with the processing of the current batch. The namespace is opened
+    again on that connection, so it must be given by name, or have been
+    opened through ``client.mns``.
+    """
+
+    def __init__(self, client, ns, table, scan_spec=None, prefetch=0):
+        """
+        :param client: a connected ``ManagedThriftClient``
+        :param ns: a namespace name or identifier
+        :param table: the table name
+        :param scan_spec: a ``ScanSpec``, by default every cell
+        :param prefetch: the number of batches to fetch ahead, 0 (or
+               False) fetches them on the caller's connection as they
+               are needed
+        """
+        self.client = client
+        self.table = table
+        self.scan_spec = scan_spec or ScanSpec()
+        self.prefetch = int(prefetch)
+        self.closed = False
+        self._thread = None
+
+        if not self.prefetch:
+            if not isinstance(ns, integer_types):
+                ns = client.mns[ns]
+            self._scanner = client.scanner_open(ns, table, self.scan_spec)
+            return
+
+        name = ns
+        if isinstance(ns, integer_types):
+            name = client.mns.name_of(ns)
+            if name is None:
+                raise ValueError("prefetch needs the namespace name, %r "
+                                 "was not opened through client.mns" % ns)
+
+        conn = client.clone()
+        try:
+            self._scanner = conn.scanner_open(conn.mns[name], table,
+                                              self.scan_spec)
+        except:
+            conn.close()
+            raise
+
+        self._queue = Queue(self.prefetch)
+        self._stop = threading.Event()
+        # the thread holds no reference to the Scanner, so an abandoned
+        # one can still be collected, which stops the thread
+        self._thread = threading.Thread(
+            target=_fetch, args=(conn, self._scanner, self._queue,
+                                 self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def batches(self):
+        """ yields the lists of cells as they are fetched """
+        try:
+            while not self.closed:
+                if self._thread is None:
+                    cells = self.client.scanner_get_cells(self._scanner)
+                else:
+                    cells = self._queue.get()
+                    if isinstance(cells, _Failure):
+                        raise cells.exception
+                if not cells:
+                    break
+                yield cells
+        finally:
+            self.close()
+
+    def __iter__(self):
+        for cells in self.batches():
+            for cell in cells:
+                yield cell
+
+    def close(self):
+        """ closes the scanner, may be called more than once """
+        if self.closed:
+            return
+        self.closed = True
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            return
+
+        try:
+            self.client.scanner_close(self._scanner)
+        except Exception:
+            # e.g. the connection broke mid scan, which the caller
+            # already heard about
+            log.debug("could not close scanner %s", self._scanner,
+                      exc_info=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
+
+    def __del__(self):
+        # never a round trip from here, see _fetch
+        if self._thread is not None:
+            self._stop.set()
+
+
+class _Failure(object):
+    """ an exception raised by the fetching thread """
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _fetch(conn, scanner, queue, stop):
+    """ the prefetching thread, which owns ``conn`` """
+    try:
+        while not stop.is_set():
+            try:
+                cells = conn.scanner_get_cells(scanner)
+            except Exception as e:
+                cells = _Failure(e)
+
+            while not stop.is_set():
+                try:
+                    queue.put(cells, timeout=0.1)
+                    break
+                except Full:
+                    pass
+
+            if not cells or isinstance(cells, _Failure):
+                break
+    finally:
+        try:
+            conn.scanner_close(scanner)
+        except Exception:
+            log.debug("could not close scanner %s", scanner, exc_info=True)
+        conn.close()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+__all__ = ['SerializedCell', 'SerializedCellsReader', 'SerializedCellsWriter',
+           'SCVERSION', 'TIMESTAMP_NULL', 'AUTO_ASSIGN']
+
+from collections import namedtuple
+from struct import Struct, error as StructError
+
+from hypertable.thriftclient import _HAS_MEMORYVIEW
+from hyperthrift.gen.ttypes import KeyFlag
+
+from ._compat import text_type
+
+#: the buffer format version, written as its first 4 bytes
+SCVERSION = 1
+
+#: the per cell flags, as Hypertable's SerializedCellsFlag.h
+EOB = 0x01
+EOS = 0x02
+FLUSH = 0x04
+REV_IS_TS = 0x10
+AUTO_TIMESTAMP = 0x20
+HAVE_TIMESTAMP = 0x40
+HAVE_REVISION = 0x80
+
+#: Hypertable's special timestamps
+TIMESTAMP_NULL = -(2 ** 63) + 1
+AUTO_ASSIGN = -(2 ** 63) + 2
+
+_i32 = Struct(str('<i'))
+_i64 = Struct(str('<q'))
+
+#: a decoded cell, ``timestamp`` and ``revision`` are None when the
+#: buffer holds none, or ``AUTO_ASSIGN``
+SerializedCell = namedtuple('SerializedCell', [
+    'row', 'column_family', 'column_qualifier', 'timestamp', 'revision',
+    'flag', 'value'])
+
+
+class SerializedCellsReader(object):
+    """ Decodes the buffers of the ``*_serialized`` calls, such as
+    ``scanner_get_cells_serialized`` or ``get_cells_serialized``, which
+    are far cheaper to transfer and decode than lists of ``Cell``.
+
+    Iterating yields ``SerializedCell`` tuples, decoded lazily as the
+    buffer is walked. The fixed size fields are unpacked in place with
+    ``struct.unpack_from``, a row repeated by consecutive cells is only
+    decoded once, and with ``copy_values=False`` the values are
+    ``memoryview`` slices of the buffer rather than copies (``buffer``
+    slices on Python 2.6).
+
+    >>> buf = client.scanner_get_cells_serialized(scanner)
+    >>> reader = SerializedCellsReader(buf)
+    >>> for cell in reader:
+    ...     print(cell.row, cell.column_family, cell.value)
+    >>> reader.eos
+    False
+    """
+
+    def __init__(self, buf, copy_values=True):
+        """
+        :param buf: the serialized cells, a str, bytearray, buffer or
+               memoryview
+        :param copy_values: if False, the values are memoryviews (or
+               buffers) into ``buf``, valid for as long as it is kept
+               around
+        """
+        if _HAS_MEMORYVIEW and isinstance(buf, memoryview):
+            # bytes() of a memoryview is its repr on Python 2
+            buf = buf.tobytes()
+        elif not isinstance(buf, bytes):
+            buf = bytes(buf)
+        self.buf = buf
+        self.copy_values = copy_values
+        self.eos = False
+
+    def __iter__(self):
+        buf = self.buf
+        # Python 2.6 has no memoryview, but buffer() does not copy either
+        view = memoryview(buf) if _HAS_MEMORYVIEW else None
+        end = len(buf)
+        copy_values = self.copy_values
+        find = buf.find
+        i32_from = _i32.unpack_from
+        i64_from = _i64.unpack_from
+        row = None
+
+        if end == 0:
+            return
+        if end < 4:
+            raise ValueError("truncated serialized cells")
+        version, = i32_from(buf, 0)
+        if version != SCVERSION:
+            raise ValueError("unsupported serialized cells version %d"
+                             % version)
+        pos = 4
+
+        try:
+            while pos < end:
+                flag = ord(buf[pos:pos + 1])
+                pos += 1
+                if flag & EOS:
+                    self.eos = True
+                if flag & EOB:
+                    return
+
+                if flag & HAVE_TIMESTAMP:
+                    timestamp, = i64_from(buf, pos)
+                    pos += 8
+                elif flag & AUTO_TIMESTAMP:
+                    timestamp = AUTO_ASSIGN
+                else:
+                    timestamp = None
+
+                if flag & HAVE_REVISION:
+                    if flag & REV_IS_TS:
+                        revision = timestamp
+                    else:
+                        revision, = i64_from(buf, pos)
+                        pos += 8
+                else:
+                    revision = None
+
+                # an empty row repeats the previous one
+                nul = find(b'\0', pos)
+                if nul < 0:
+                    raise IndexError()
+                if nul > pos:
+                    row = buf[pos:nul]
+                elif row is None:
+                    raise ValueError("serialized cells start with an "
+                                     "empty row")
+                pos = nul + 1
+
+                nul = find(b'\0', pos)
+                if nul < 0:
+                    raise IndexError()
+                column_family = buf[pos:nul]
+                pos = nul + 1
+
+                nul = find(b'\0', pos)
+                if nul < 0:
+                    raise IndexError()
+                column_qualifier = buf[pos:nul]
+                pos = nul + 1
+
+                length, = i32_from(buf, pos)
+                pos += 4
+                if length < 0 or pos + length + 1 > end:
+                    raise IndexError()
+                if copy_values:
+                    value = buf[pos:pos + length]
+                elif view is not None:
+                    value = view[pos:pos + length]
+                else:
+                    value = buffer(buf, pos, length)
+                pos += length
+
+                cell_flag = ord(buf[pos:pos + 1])
+                pos += 1
+
+                yield SerializedCell(row, column_family, column_qualifier,
+                                     timestamp, revision, cell_flag, value)
+        except (IndexError, TypeError, StructError):
+            raise ValueError("truncated serialized cells at offset %d"
+                             % pos)
+
+
+def _to_bytes(s, what):
+    if isinstance(s, text_type):
+        s = s.encode('utf-8')
+    if b'\0' in s:
+        raise ValueError("%s may not contain NUL bytes" % what)
+    return s
+
+
+class SerializedCellsWriter(object):
+    """ Encodes cells into one growing ``bytearray`` for
+    ``set_cells_serialized`` and ``mutator_set_cells_serialized``,
+    rather than building a ``Cell(Key(...))`` per cell for Thrift to
+    serialize struct by struct.
+
+    >>> writer = SerializedCellsWriter()
+    >>> for user in users:
+    ...     writer.add(user.id, 'info', 'name', user.name)
+    ...     writer.add(user.id, 'info', 'email', user.email)
+    >>> client.set_cells_serialized(client.mns['test'], 'users',
+    ...                             writer.getvalue())
+
+    Text is encoded as UTF-8. A row repeated by consecutive cells is
+    only written once.
+    """
+
+    def __init__(self):
+        self.buf = bytearray(_i32.pack(SCVERSION))
+        self.count = 0
+        self._row = None
+        self._flag = None
+
+    def add(self, row, column_family, column_qualifier=b'', value=b'',
+            timestamp=None, revision=None, flag=KeyFlag.INSERT):
+        """ Appends a cell.
+
+        :param timestamp: nanoseconds since the epoch, None (left to the
+               RangeServer) or ``AUTO_ASSIGN``
+        :param revision: None, or a revision number
+        :param flag: a ``KeyFlag``, e.g. ``KeyFlag.DELETE_ROW``
+        """
+        if self._flag is not None:
+            raise ValueError("the cells were already finalized")
+        if row != self._row or row is None:
+            row = _to_bytes(row, 'row')
+            if not row:
+                raise ValueError("row may not be empty")
+        column_family = _to_bytes(column_family, 'column_family')
+        column_qualifier = _to_bytes(column_qualifier or b'',
+                                     'column_qualifier')
+        if value is None:
+            value = b''
+        elif isinstance(value, text_type):
+            value = value.encode('utf-8')
+
+        buf = self.buf
+        cell_flag = 0
+        if timestamp == AUTO_ASSIGN:
+            cell_flag = AUTO_TIMESTAMP
+        elif timestamp is not None:
+            cell_flag = HAVE_TIMESTAMP
+        if revision is not None:
+            cell_flag |= HAVE_REVISION
+            if revision == timestamp:
+                cell_flag |= REV_IS_TS
+
+        buf.append(cell_flag)
+        if cell_flag & HAVE_TIMESTAMP:
+            buf += _i64.pack(timestamp)
+        if cell_flag & HAVE_REVISION and not cell_flag & REV_IS_TS:
+            buf += _i64.pack(revision)
+
+        if row == self._row:
+            buf.append(0)
+        else:
+            buf += row
+            buf.append(0)
+            self._row = row
+        buf += column_family
+        buf.append(0)
+        buf += column_qualifier
+        buf.append(0)
+        buf += _i32.pack(len(value))
+        buf += value
+        buf.append(flag)
+        self.count += 1
+
+    def add_cell(self, cell):
+        """ Appends a ``Cell`` struct or a ``SerializedCell``. """
+        if isinstance(cell, SerializedCell):
+            self.add(cell.row, cell.column_family, cell.column_qualifier,
+                     cell.value, cell.timestamp, cell.revision, cell.flag)
+            return
+        key = cell.key
+        self.add(key.row, key.column_family, key.column_qualifier,
+                 cell.value, key.timestamp, key.revision,
+                 key.flag if key.flag is not None else KeyFlag.INSERT)
+
+    def extend(self, other):
+        """ Appends the cells of another writer, which is not finalized.
+        """
+        if self._flag is not None:
+            raise ValueError("the cells were already finalized")
+        if other._flag is not None:
+            raise ValueError("the other cells were already finalized")
+        if not other.count:
+            return
+        # the other buffer starts with a full row, so the repeated row
+        # shortcut goes on with its last one
+        self.buf += other.buf[_i32.size:]
+        self.count += other.count
+        self._row = other._row
+
+    def finalize(self, flag=0):
+        """ Ends the buffer, further ``add()`` calls are refused.
+
+        :param flag: ``EOS`` or ``FLUSH`` to set along with ``EOB``
+        """
+        if self._flag is None:
+            self._flag = EOB | flag
+            self.buf.append(self._flag)
+
+    def getvalue(self):
+        """ :return: the finalized buffer, as a str for Thrift """
+        self.finalize()
+        return bytes(self.buf)
+
+    def clear(self):
+        """ Starts over with an empty buffer. """
+        self.__init__()
+
+    def __len__(self):
+        """ the number of cells added """
+        return self.count
+
+    @property
+    def size(self):
+        """ the length of the buffer in bytes """
+        return len(self.buf)
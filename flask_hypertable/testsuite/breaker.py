@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `breaker` module."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import time
+
+from ..breaker import CircuitBreaker
+
+from . import unittest
+from .pool import wait_for
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def test_trips_after_consecutive_failures(self):
+        breaker = CircuitBreaker(lambda: False, threshold=3, backoff=60,
+                                 max_backoff=60)
+
+        self.assertFalse(breaker.record_failure())
+        self.assertFalse(breaker.record_failure())
+        breaker.record_success()
+        self.assertEqual(0, breaker.failures)
+
+        self.assertFalse(breaker.record_failure())
+        self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.healthy)
+        self.assertTrue(breaker.record_failure())
+        self.assertFalse(breaker.healthy)
+        self.assertEqual(1, breaker.trips)
+
+        # already tripped
+        self.assertFalse(breaker.record_failure())
+        self.assertEqual(1, breaker.trips)
+
+        breaker.record_success(recover=False)
+        self.assertFalse(breaker.healthy)
+        breaker.record_success()
+        self.assertTrue(breaker.healthy)
+
+    def test_success_without_recover(self):
+        breaker = CircuitBreaker(lambda: False, threshold=2, backoff=60,
+                                 max_backoff=60)
+        breaker.record_failure()
+        breaker.record_success(recover=False)
+        self.assertEqual(0, breaker.failures)
+
+    def test_probe_recovers(self):
+        answers = [False, False, True]
+        breaker = CircuitBreaker(lambda: answers.pop(0), threshold=1,
+                                 backoff=0.01, max_backoff=0.02)
+
+        breaker.record_failure()
+        self.assertFalse(breaker.healthy)
+        self.assertTrue(wait_for(lambda: breaker.healthy))
+        self.assertEqual(3, breaker.probes)
+        self.assertEqual(0, breaker.failures)
+
+    def test_probe_errors_back_off(self):
+        def probe():
+            raise IOError("still down")
+        breaker = CircuitBreaker(probe, threshold=1, backoff=0.01,
+                                 max_backoff=0.04)
+
+        breaker.record_failure()
+        self.assertTrue(wait_for(lambda: breaker.probes >= 4))
+        self.assertFalse(breaker.healthy)
+        self.assertEqual(0.04, breaker._next_backoff)
+
+        breaker.record_success()
+        self.assertTrue(breaker.healthy)
+        probes = breaker.probes
+        time.sleep(0.1)
+        self.assertEqual(probes, breaker.probes)
+
+    def test_validation(self):
+        self.assertRaises(ValueError, CircuitBreaker, None, threshold=0)
+        self.assertRaises(ValueError, CircuitBreaker, None, backoff=0)
+        self.assertRaises(ValueError, CircuitBreaker, None, backoff=2,
+                          max_backoff=1)
+
+
+def suite():
+    from .helpers import setup_path
+    setup_path()
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CircuitBreakerTestCase))
+    return suite
@@ -6,9 +6,29 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement, unicode_literals
 
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import types
+
+from struct import pack
+
+from flask import Flask
+
+from hypertable import thriftclient
+from hypertable.thriftclient import ACCELERATED, TFramedRecvTransport
+from hyperthrift.gen2 import HqlService, ttypes
+from thrift.protocol.TBinaryProtocol import TBinaryProtocolAccelerated
+from thrift.transport.TTransport import TTransportException
+
 from .. import flask_hypertable
+from ..pool import PoolTimeout
 
 from . import unittest
+from .helpers import StandInBroker, StandInHandler
 
 
 class Flask_hypertableTestCase(unittest.TestCase):
@@ -27,9 +47,573 @@ class Flask_hypertableTestCase(unittest.TestCase):
         pass
 
 
+class ParseHostsTestCase(unittest.TestCase):
+
+    def test_parse_hosts(self):
+        self.assertEqual(
+            [('ht1', 38080), ('ht2', 15867), ('ht3', 1), ('::1', 2)],
+            flask_hypertable.parse_hosts(
+                ['ht1', 'ht2:15867', ('ht3', '1'), '::1:2'], 38080))
+
+    def test_default_host(self):
+        app = Flask(__name__)
+        ht = flask_hypertable.FlaskHypertable(app)
+        self.assertEqual([('localhost', 38080)], ht.hosts)
+
+
+class FlaskHypertableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.brokers = [StandInBroker().start() for _ in range(2)]
+        self.app = Flask(__name__)
+        self.app.config['HYPERTABLE_HOSTS'] = [(b.host, b.port)
+                                               for b in self.brokers]
+        self.app.config['HYPERTABLE_BREAKER_THRESHOLD'] = 1
+        self.app.config['HYPERTABLE_BREAKER_BACKOFF'] = 60
+        self.app.config['HYPERTABLE_BREAKER_MAX_BACKOFF'] = 60
+        self.ht = flask_hypertable.FlaskHypertable(self.app)
+
+    def tearDown(self):
+        for broker in self.brokers:
+            broker.stop()
+
+    def test_connect_routes_around_dead_broker(self):
+        dead = self.brokers[0]
+        dead.stop()
+
+        # enough random picks to hit the dead broker at least once
+        for _ in range(50):
+            with self.app.app_context():
+                client = self.ht.connection
+                self.assertEqual(self.brokers[1].port, client.port)
+                self.assertTrue(client.ping())
+
+        breaker = self.ht.breakers[(dead.host, dead.port)]
+        self.assertFalse(breaker.healthy)
+        self.assertEqual(1, breaker.failures)
+
+    def test_single_host_has_no_breaker(self):
+        self.app.config['HYPERTABLE_HOSTS'] = []
+        self.ht.init_app(self.app)
+        self.assertEqual({}, self.ht.breakers)
+
+    def test_namespace_cache_size(self):
+        self.app.config['HYPERTABLE_NAMESPACE_CACHE_SIZE'] = 3
+        self.ht.init_app(self.app)
+        with self.ht as client:
+            self.assertEqual(3, client.mns.capacity)
+            clone = client.clone()
+            self.assertEqual(3, clone.mns.capacity)
+            clone.close()
+
+        self.app.config['HYPERTABLE_NAMESPACE_CACHE_SIZE'] = 0
+        self.assertRaises(ValueError, self.ht.init_app, self.app)
+
+
+class ManagedThriftClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.client = flask_hypertable.ManagedThriftClient(self.broker.host,
+                                                           self.broker.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.stop()
+
+    def test_ping(self):
+        self.assertTrue(self.client.ping())
+        self.broker.drop_connections()
+        self.assertFalse(self.client.ping())
+
+    def test_ping_closed(self):
+        self.client.close()
+        self.assertFalse(self.client.ping())
+
+    def test_close_namespaces(self):
+        handler = self.broker.handler
+        test = self.client.mns['test']
+        self.assertTrue(self.client.mns['test'] is test)
+        self.client.mns['other']
+        self.assertEqual(2, len(handler.namespaces))
+
+        self.assertEqual(test, self.client.mns.close_namespace('test'))
+        self.assertEqual(['other'], list(self.client.mns.namespaces))
+        self.assertEqual(None, self.client.mns.close_namespace('test'))
+
+        self.client.close()
+        self.assertEqual({}, self.client.mns.namespaces)
+        self.assertEqual({}, handler.namespaces)
+
+    def test_namespace_lru(self):
+        handler = self.broker.handler
+        mns = flask_hypertable.ManagedNamespaces(self.client, capacity=2)
+        a = mns['a']
+        mns['b']
+        self.assertEqual(a, mns['a'])
+        # b is the least recently used
+        mns['c']
+        self.assertEqual(set(['a', 'c']), set(mns.namespaces))
+        self.assertEqual(set(['a', 'c']), set(handler.namespaces.values()))
+        self.assertEqual((1, 3, 1), (mns.hits, mns.misses, mns.evictions))
+
+        mns['b']
+        self.assertEqual(set(['b', 'c']), set(mns.namespaces))
+        self.assertEqual(2, mns.evictions)
+        mns.close()
+        self.assertEqual({}, handler.namespaces)
+
+        self.assertRaises(ValueError, flask_hypertable.ManagedNamespaces,
+                          self.client, capacity=0)
+
+    def test_namespace_lru_bounded(self):
+        mns = flask_hypertable.ManagedNamespaces(self.client, capacity=2)
+        for i in range(1000):
+            mns['ab'[i % 2]]
+        # the outdated lookups are dropped along the way
+        self.assertTrue(len(mns._order) <= 2 * 2 + 16 + 1)
+        mns['c']
+        self.assertEqual(set(['b', 'c']), set(mns.namespaces))
+        mns.close()
+
+    def test_lookup_during_open(self):
+        gate = threading.Event()
+
+        class Handler(StandInHandler):
+            def namespace_open(self, ns):
+                if ns == 'slow':
+                    gate.wait(5)
+                return StandInHandler.namespace_open(self, ns)
+            open_namespace = namespace_open
+
+        with StandInBroker(Handler()) as broker:
+            client = flask_hypertable.ManagedThriftClient(broker.host,
+                                                          broker.port)
+            try:
+                mns = client.mns
+                test = mns['test']
+                thread = threading.Thread(target=mns.open_namespace,
+                                          args=('slow',))
+                thread.start()
+                for _ in range(500):
+                    if 'slow' in mns._opening:
+                        break
+                    time.sleep(0.01)
+
+                # answered while the broker is still opening the other
+                started = time.time()
+                self.assertEqual(test, mns['test'])
+                self.assertTrue(time.time() - started < 1)
+                gate.set()
+                thread.join(5)
+                self.assertEqual(set(['test', 'slow']), set(mns.namespaces))
+            finally:
+                client.close()
+
+    def test_namespace_opened_once(self):
+        mns = self.client.mns
+        results = []
+
+        def lookup():
+            for _ in range(20):
+                results.append(mns['test'])
+
+        threads = [threading.Thread(target=lookup) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(1, len(self.broker.handler.namespaces))
+        self.assertEqual((99, 1), (mns.hits, mns.misses))
+
+    def test_detach_forgets_namespaces(self):
+        self.client.mns['test']
+        self.client.detach()
+        self.assertEqual({}, self.client.mns.namespaces)
+        self.assertEqual(1, len(self.broker.handler.namespaces))
+        self.assertFalse(self.client.is_active)
+
+    def test_codec(self):
+        expected = ACCELERATED and 'fastbinary' or 'python'
+        self.assertEqual(self.client.codec, expected)
+        self.assertEqual(self.client.hql_query(0, 'select').results,
+                         ['select'])
+
+    def test_codec_large_result(self):
+        class Handler(StandInHandler):
+            def hql_query(self, ns, command):
+                return ttypes.HqlResult(results=[command] * 10001)
+
+        with StandInBroker(Handler()) as broker:
+            client = flask_hypertable.ManagedThriftClient(broker.host,
+                                                          broker.port)
+            try:
+                for _ in range(2):
+                    res = client.hql_query(0, 'select')
+                    self.assertEqual(len(res.results), 10001)
+                self.assertTrue(client.ping())
+            finally:
+                client.close()
+
+    def test_decode_fallback(self):
+        client = self.client
+        accelerated = TBinaryProtocolAccelerated(client.transport)
+
+        def recv_hql_query(self):
+            if self._iprot is accelerated:
+                # as fastbinary giving up half way through the reply
+                self.transport.read(9)
+                raise OverflowError("list size out of the sanity limit")
+            return HqlService.Client.recv_hql_query(self)
+        client.recv_hql_query = types.MethodType(
+            thriftclient._decode_fallback(recv_hql_query), client)
+        client.accelerated = True
+        client._iprot = accelerated
+
+        for _ in range(2):
+            self.assertEqual(['select'],
+                             client.hql_query(0, 'select').results)
+        self.assertTrue(client._iprot is accelerated)
+        # nothing was left behind on the connection
+        client._iprot = client._python_protocol
+        self.assertTrue(client.ping())
+
+        client._iprot = accelerated
+        client.accelerated = False
+        self.assertRaises(OverflowError, client.hql_query, 0, 'select')
+
+    def test_refill_keeps_the_reply(self):
+        reply = b''.join(pack(str('!i'), i) for i in range(64))
+        ours, theirs = socket.socketpair()
+        try:
+            class Socket(object):
+                handle = ours
+            transport = TFramedRecvTransport(Socket())
+            # a reply spanning three frames
+            for frame in (reply[:100], reply[100:150], reply[150:]):
+                theirs.sendall(pack(str('!i'), len(frame)) + frame)
+
+            self.assertEqual(reply[:10], transport.read(10))
+            # what fastbinary does when it needs more than the frame holds
+            prefix = transport.cstringio_buf.read(120)
+            self.assertEqual(reply[10:100], prefix)
+            buf = transport.cstringio_refill(prefix, 200)
+            self.assertEqual(reply[10:210], buf.read(200))
+
+            transport.rewind()
+            self.assertEqual(reply, transport.read(len(reply)))
+        finally:
+            ours.close()
+            theirs.close()
+
+    def test_frame_buffer_reused(self):
+        transport = self.client.transport
+        for _ in range(3):
+            self.client.hql_query(0, 'select')
+        self.assertEqual(transport.allocations, 1)
+
+    def test_large_frame_not_retained(self):
+        class Handler(StandInHandler):
+            def hql_query(self, ns, command):
+                return ttypes.HqlResult(results=[command * 1024] * 64)
+
+        with StandInBroker(Handler()) as broker:
+            client = flask_hypertable.ManagedThriftClient(broker.host,
+                                                          broker.port)
+            try:
+                client.transport.max_buffer = 16 * 1024
+                client.ping()
+                retained = client.transport._buf
+                for _ in range(2):
+                    res = client.hql_query(0, 'select')
+                    self.assertEqual(res.results, ['select' * 1024] * 64)
+                self.assertTrue(client.transport._buf is retained)
+                self.assertEqual(client.transport.allocations, 3)
+            finally:
+                client.close()
+
+    def test_socket_options(self):
+        client = flask_hypertable.ManagedThriftClient(
+            self.broker.host, self.broker.port, timeout_ms=2000,
+            connect_timeout_ms=500,
+            socket_options={'nodelay': True, 'keepalive': True,
+                            'keepalive_idle': 30, 'rcvbuf': 65536})
+        try:
+            handle = client.transport.socket.handle
+            self.assertTrue(handle.getsockopt(socket.IPPROTO_TCP,
+                                              socket.TCP_NODELAY))
+            self.assertTrue(handle.getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_KEEPALIVE))
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                self.assertEqual(handle.getsockopt(socket.IPPROTO_TCP,
+                                                   socket.TCP_KEEPIDLE), 30)
+            self.assertTrue(handle.getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_RCVBUF) >= 65536)
+            # the connect timeout only applies while connecting
+            self.assertEqual(handle.gettimeout(), 2.0)
+            self.assertTrue(client.ping())
+        finally:
+            client.close()
+
+    def test_unknown_socket_option(self):
+        self.assertRaises(ValueError, flask_hypertable.ManagedThriftClient,
+                          self.broker.host, self.broker.port,
+                          socket_options={'nagle': False})
+
+    def test_socket_config(self):
+        app = Flask(__name__)
+        app.config['HYPERTABLE_HOST'] = self.broker.host
+        app.config['HYPERTABLE_PORT'] = self.broker.port
+        app.config['HYPERTABLE_CONNECT_TIMEOUT_MSECS'] = 250
+        ht = flask_hypertable.FlaskHypertable(app)
+        with app.app_context():
+            sock = ht.connection.transport.socket
+            self.assertEqual(sock.connect_timeout_ms, 250)
+            self.assertEqual(sock.timeout_ms, 5000)
+            self.assertTrue(sock.handle.getsockopt(socket.IPPROTO_TCP,
+                                                   socket.TCP_NODELAY))
+
+        app.config['HYPERTABLE_SOCKET_OPTIONS'] = {'nagle': False}
+        self.assertRaises(ValueError, flask_hypertable.FlaskHypertable, app)
+
+    def test_codec_disabled(self):
+        client = flask_hypertable.ManagedThriftClient(self.broker.host,
+                                                      self.broker.port,
+                                                      accelerated=False)
+        try:
+            self.assertEqual(client.codec, 'python')
+            self.assertEqual(client.hql_query(0, 'select').results,
+                             ['select'])
+        finally:
+            client.close()
+
+    def test_accelerated_config(self):
+        app = Flask(__name__)
+        app.config['HYPERTABLE_HOST'] = self.broker.host
+        app.config['HYPERTABLE_PORT'] = self.broker.port
+        app.config['HYPERTABLE_ACCELERATED'] = False
+        ht = flask_hypertable.FlaskHypertable(app)
+        with app.app_context():
+            self.assertEqual(ht.connection.codec, 'python')
+
+
+class FlaskPooledHypertableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.app = Flask(__name__)
+        self.app.config['HYPERTABLE_HOST'] = self.broker.host
+        self.app.config['HYPERTABLE_PORT'] = self.broker.port
+        self.app.config['HYPERTABLE_POOL_SIZE'] = 1
+        self.app.config['HYPERTABLE_MAX_OVERFLOW'] = 1
+        self.app.config['HYPERTABLE_POOL_TIMEOUT'] = 0.05
+        self.ht = flask_hypertable.FlaskPooledHypertable(self.app)
+
+    def tearDown(self):
+        self.ht.close_app()
+        self.broker.stop()
+
+    def test_teardown_returns_connection(self):
+        with self.app.app_context():
+            client = self.ht.connection
+            self.assertTrue(self.ht.connection is client)
+            self.assertEqual(1, self.ht.pool.checkedout)
+
+        self.assertEqual(0, self.ht.pool.checkedout)
+        self.assertEqual(1, self.ht.pool.idle)
+
+        with self.app.app_context():
+            self.assertTrue(self.ht.connection is client)
+
+    def test_overflow_count(self):
+        with self.ht as first:
+            second = self.ht.connect()
+            self.assertEqual(1, self.ht.overflow_count)
+            self.ht.put_back(second)
+            self.assertTrue(second.is_active)
+            self.assertEqual(1, self.ht.overflow_count)
+        # the pool was already full, so the overflow is closed
+        self.assertFalse(first.is_active)
+        self.assertEqual(0, self.ht.overflow_count)
+        self.assertEqual(1, self.ht.pool.idle)
+
+    def test_prefill(self):
+        self.ht.close_app()
+        self.app.config['HYPERTABLE_POOL_SIZE'] = 2
+        self.app.config['HYPERTABLE_POOL_PREFILL'] = True
+        self.app.config['HYPERTABLE_NAMESPACES'] = ['test', 'other']
+        self.ht.init_app(self.app)
+
+        self.assertEqual(2, self.ht.pool.idle)
+        self.assertEqual(4, len(self.broker.handler.namespaces))
+
+        with self.app.app_context():
+            mns = self.ht.connection.mns
+            self.assertEqual(set(['test', 'other']), set(mns.namespaces))
+
+    def test_prefill_failure(self):
+        self.ht.close_app()
+        self.app.config['HYPERTABLE_POOL_SIZE'] = 2
+        self.app.config['HYPERTABLE_POOL_PREFILL'] = True
+        self.broker.stop()
+        # the broker being down does not keep the app from starting
+        self.ht.init_app(self.app)
+
+        self.assertEqual(0, self.ht.pool.size)
+        self.assertEqual(2, self.ht.pool.stats()['connect_errors'])
+
+    def test_namespaces_stay_open(self):
+        self.ht.close_app()
+        self.app.config['HYPERTABLE_NAMESPACES'] = ['test']
+        self.ht.init_app(self.app)
+        handler = self.broker.handler
+
+        with self.app.app_context():
+            client = self.ht.connection
+            ns = client.mns.namespaces['test']
+            self.assertEqual({ns: 'test'}, handler.namespaces)
+            # an overflow connection is set up as well
+            overflow = self.ht.connect()
+            self.assertEqual(['test'], list(overflow.mns.namespaces))
+        # and closes its namespace when it is thrown away
+        self.ht.put_back(overflow)
+        self.assertFalse(overflow.is_active)
+
+        with self.app.app_context():
+            self.assertTrue(self.ht.connection is client)
+            self.assertEqual(ns, client.mns['test'])
+        self.assertEqual({ns: 'test'}, handler.namespaces)
+
+    def test_transport_error_skips_namespaces(self):
+        with self.app.app_context():
+            client = self.ht.connection
+            client.mns['test']
+            self.ht.teardown(TTransportException())
+        self.assertFalse(client.is_active)
+        self.assertEqual({}, client.mns.namespaces)
+        # nothing was sent over the connection deemed broken
+        self.assertEqual(1, len(self.broker.handler.namespaces))
+        self.assertEqual({'error': 1}, self.ht.pool.stats()['discards'])
+
+    def test_max_lifetime_aliases_recycle(self):
+        self.ht.close_app()
+        self.app.config['HYPERTABLE_POOL_RECYCLE'] = 60
+        self.app.config['HYPERTABLE_POOL_IDLE_TIMEOUT'] = 30
+        self.ht.init_app(self.app)
+        self.assertEqual(60, self.ht.pool.recycle)
+        self.assertEqual(30, self.ht.pool.idle_timeout)
+
+        self.app.config['HYPERTABLE_POOL_MAX_LIFETIME'] = 10
+        self.ht.init_app(self.app)
+        self.assertEqual(10, self.ht.pool.recycle)
+
+    def test_lifo(self):
+        self.assertFalse(self.ht.pool.lifo)
+        self.app.config['HYPERTABLE_POOL_LIFO'] = True
+        self.ht.init_app(self.app)
+        self.assertTrue(self.ht.pool.lifo)
+        self.ht.init_app(self.app, lifo=False)
+        self.assertFalse(self.ht.pool.lifo)
+
+    def test_multiple_hosts(self):
+        other = StandInBroker().start()
+        try:
+            self.app.config['HYPERTABLE_HOSTS'] = [
+                '%s:%s' % (self.broker.host, self.broker.port),
+                (other.host, other.port)]
+            self.ht.init_app(self.app)
+            self.assertTrue(isinstance(self.ht.pool,
+                                       flask_hypertable.BalancedPool))
+
+            with self.ht as first:
+                with self.app.app_context():
+                    second = self.ht.connection
+                    self.assertNotEqual((first.host, first.port),
+                                        (second.host, second.port))
+                    self.assertTrue(second.ping())
+            self.assertEqual(2, self.ht.pool.idle)
+        finally:
+            self.ht.close_app()
+            other.stop()
+
+    def test_pool_timeout_can_be_handled(self):
+        @self.app.errorhandler(PoolTimeout)
+        def shed_load(e):
+            return 'busy', 503
+
+        @self.app.route('/')
+        def index():
+            self.ht.connection.namespace_exists('test')
+            return 'ok'
+
+        held = [self.ht.connect(), self.ht.connect()]
+        try:
+            rv = self.app.test_client().get('/')
+            self.assertEqual(503, rv.status_code)
+        finally:
+            for client in held:
+                self.ht.put_back(client)
+
+        self.assertEqual(200, self.app.test_client().get('/').status_code)
+
+
+class UnixSocketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'thriftbroker.sock')
+        self.broker = StandInBroker(unix_socket=path).start()
+        self.app = Flask(__name__)
+        self.app.config['HYPERTABLE_UNIX_SOCKET'] = path
+        # ignored in favour of the socket
+        self.app.config['HYPERTABLE_HOSTS'] = ['localhost:1', 'localhost:2']
+
+    def tearDown(self):
+        self.broker.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_client(self):
+        client = flask_hypertable.ManagedThriftClient(
+            'localhost', None, unix_socket=self.broker.unix_socket,
+            socket_options={'nodelay': True, 'rcvbuf': 65536})
+        try:
+            self.assertEqual(client.transport.socket.handle.family,
+                             socket.AF_UNIX)
+            self.assertEqual(client.hql_query(0, 'select').results,
+                             ['select'])
+        finally:
+            client.close()
+
+    def test_flask_hypertable(self):
+        ht = flask_hypertable.FlaskHypertable(self.app)
+        self.assertEqual(ht.breakers, {})
+        with self.app.app_context():
+            self.assertTrue(ht.connection.ping())
+        self.assertEqual(self.broker.accepted, 1)
+
+    def test_pooled(self):
+        ht = flask_hypertable.FlaskPooledHypertable(self.app)
+        try:
+            for _ in range(3):
+                with self.app.app_context():
+                    self.assertTrue(ht.connection.ping())
+            self.assertTrue(isinstance(ht.pool,
+                                       flask_hypertable.ConnectionPool))
+            self.assertEqual(self.broker.accepted, 1)
+        finally:
+            ht.close_app()
+
+
 def suite():
     from .helpers import setup_path
     setup_path()
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(Flask_hypertableTestCase))
+    suite.addTest(unittest.makeSuite(ParseHostsTestCase))
+    suite.addTest(unittest.makeSuite(FlaskHypertableTestCase))
+    suite.addTest(unittest.makeSuite(ManagedThriftClientTestCase))
+    suite.addTest(unittest.makeSuite(FlaskPooledHypertableTestCase))
+    suite.addTest(unittest.makeSuite(UnixSocketTestCase))
     return suite
\ No newline at end of file
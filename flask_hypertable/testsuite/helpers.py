@@ -5,11 +5,21 @@ from __future__ import absolute_import, division, print_function, \
     with_statement, unicode_literals
 
 import os
+import socket
 import sys
+import threading
 
 from contextlib import contextmanager
 
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TSocket, TTransport
+
+from hyperthrift.gen.ttypes import Cell, ClientException, Key, Result, \
+    TableSplit
+from hyperthrift.gen2 import HqlService, ttypes
+
 from .._compat import StringIO
+from ..serialized import EOS, SerializedCellsReader, SerializedCellsWriter
 
 
 def add_to_path(path):
@@ -61,4 +71,360 @@ def captureStdOut(command, *args, **kwargs):
     command(*args, **kwargs)
     sys.stdout.seek(0)
     yield sys.stdout.read()
-    sys.stdout = out
\ No newline at end of file
+    sys.stdout = out
+
+
+class StandInHandler(object):
+    """ An in memory implementation of the handful of ThriftBroker
+    calls used by the testsuite. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.namespaces = {}
+        self.next_id = 1
+        # table name -> list of Cells, served scan_batch cells at a time
+        self.tables = {}
+        # table name -> list of TableSplits
+        self.splits = {}
+        # mutator -> table name, and the calls made on mutators
+        self.mutators = {}
+        self.mutator_calls = []
+        # future -> queued Results, async mutator -> future, the async
+        # scanners, and the tables whose async updates and scans fail
+        self.futures = {}
+        self.async_mutators = {}
+        self.async_scanners = set()
+        self.failing = set()
+        self.scanners = {}
+        self.scan_batch = 2
+
+    def _new_id(self):
+        with self.lock:
+            new_id = self.next_id
+            self.next_id += 1
+        return new_id
+
+    def namespace_open(self, ns):
+        ns_id = self._new_id()
+        with self.lock:
+            self.namespaces[ns_id] = ns
+        return ns_id
+    open_namespace = namespace_open
+
+    def namespace_close(self, ns):
+        with self.lock:
+            self.namespaces.pop(ns, None)
+    close_namespace = namespace_close
+
+    def namespace_exists(self, ns):
+        return True
+    exists_namespace = namespace_exists
+
+    def hql_query(self, ns, command):
+        return ttypes.HqlResult(results=[command])
+
+    def _scan(self, table_name, scan_spec):
+        if table_name not in self.tables:
+            raise ClientException(code=1, message='no such table')
+        cells = self.tables[table_name]
+        if scan_spec.row_intervals:
+            cells = [cell for cell in cells
+                     if any(_in_interval(cell.key.row, interval)
+                            for interval in scan_spec.row_intervals)]
+        return list(cells)
+
+    def scanner_open(self, ns, table_name, scan_spec):
+        cells = self._scan(table_name, scan_spec)
+        scanner = self._new_id()
+        with self.lock:
+            self.scanners[scanner] = cells
+        return scanner
+    open_scanner = scanner_open
+
+    def async_scanner_open(self, ns, table_name, future, scan_spec):
+        cells = self._scan(table_name, scan_spec)
+        scanner = self._new_id()
+        if table_name in self.failing:
+            results = [Result(is_empty=False, id=scanner, is_scan=True,
+                              is_error=True, error=5, error_msg='failed')]
+        else:
+            results = [Result(is_empty=False, id=scanner, is_scan=True,
+                              is_error=False,
+                              cells=cells[i:i + self.scan_batch])
+                       for i in range(0, len(cells), self.scan_batch)]
+        with self.lock:
+            self.async_scanners.add(scanner)
+            self.futures[future].extend(results)
+        return scanner
+    open_scanner_async = async_scanner_open
+
+    def async_scanner_cancel(self, scanner):
+        with self.lock:
+            for results in self.futures.values():
+                results[:] = [r for r in results if r.id != scanner]
+    cancel_scanner_async = async_scanner_cancel
+
+    def async_scanner_close(self, scanner):
+        with self.lock:
+            self.async_scanners.remove(scanner)
+    close_scanner_async = async_scanner_close
+
+    def future_cancel(self, ff):
+        with self.lock:
+            del self.futures[ff][:]
+    cancel_future = future_cancel
+
+    def get_table_splits(self, ns, table_name):
+        if table_name not in self.tables:
+            raise ClientException(code=1, message='no such table')
+        return self.splits.get(table_name) or [TableSplit()]
+
+    def scanner_get_cells(self, scanner):
+        with self.lock:
+            if scanner not in self.scanners:
+                raise ClientException(code=2, message='no such scanner')
+            cells = self.scanners[scanner]
+            batch, self.scanners[scanner] = (cells[:self.scan_batch],
+                                             cells[self.scan_batch:])
+        return batch
+    next_cells = scanner_get_cells
+
+    def scanner_get_cells_serialized(self, scanner):
+        writer = SerializedCellsWriter()
+        cells = self.scanner_get_cells(scanner)
+        for cell in cells:
+            writer.add_cell(cell)
+        writer.finalize(0 if cells else EOS)
+        return writer.getvalue()
+    next_cells_serialized = scanner_get_cells_serialized
+
+    def set_cells(self, ns, table_name, cells):
+        with self.lock:
+            self.tables.setdefault(table_name, []).extend(cells)
+
+    def set_cells_serialized(self, ns, table_name, cells):
+        self.set_cells(ns, table_name, [
+            Cell(key=Key(row=c.row, column_family=c.column_family,
+                         column_qualifier=c.column_qualifier,
+                         timestamp=c.timestamp, revision=c.revision,
+                         flag=c.flag),
+                 value=c.value)
+            for c in SerializedCellsReader(cells)])
+
+    def mutator_open(self, ns, table_name, flags, flush_interval):
+        if table_name in self.failing:
+            raise ClientException(code=5, message='failed')
+        mutator = self._new_id()
+        with self.lock:
+            self.mutators[mutator] = table_name
+        return mutator
+    open_mutator = mutator_open
+
+    def _mutator_table(self, mutator, call):
+        with self.lock:
+            self.mutator_calls.append(call)
+            if mutator not in self.mutators:
+                raise ClientException(code=3, message='no such mutator')
+            return self.mutators[mutator]
+
+    def mutator_set_cells(self, mutator, cells):
+        self.set_cells(0, self._mutator_table(mutator, 'set_cells'), cells)
+
+    def mutator_set_cells_serialized(self, mutator, cells, flush):
+        table = self._mutator_table(mutator, flush and 'set_cells_flush'
+                                    or 'set_cells')
+        self.set_cells_serialized(0, table, cells)
+
+    def mutator_flush(self, mutator):
+        self._mutator_table(mutator, 'flush')
+    flush_mutator = mutator_flush
+
+    def mutator_close(self, mutator):
+        self._mutator_table(mutator, 'close')
+        with self.lock:
+            del self.mutators[mutator]
+    close_mutator = mutator_close
+
+    def future_open(self, capacity):
+        ff = self._new_id()
+        with self.lock:
+            self.futures[ff] = []
+        return ff
+    open_future = future_open
+
+    def future_get_result(self, ff, timeout_millis):
+        with self.lock:
+            if ff not in self.futures:
+                raise ClientException(code=3, message='no such future')
+            if not self.futures[ff]:
+                return Result(is_empty=True, id=0, is_scan=False,
+                              is_error=False)
+            return self.futures[ff].pop(0)
+    get_future_result = future_get_result
+
+    def future_close(self, ff):
+        with self.lock:
+            del self.futures[ff]
+    close_future = future_close
+
+    def async_mutator_open(self, ns, table_name, future, flags):
+        mutator = self._new_id()
+        with self.lock:
+            self.mutators[mutator] = table_name
+            self.async_mutators[mutator] = future
+        return mutator
+    open_mutator_async = async_mutator_open
+
+    def _async_update(self, mutator, cells, flush):
+        table = self._mutator_table(mutator, flush and 'async_set_cells_flush'
+                                    or 'async_set_cells')
+        if table in self.failing:
+            result = Result(is_empty=False, id=mutator, is_scan=False,
+                            is_error=True, error=5, error_msg='rejected')
+        else:
+            self.set_cells(0, table, cells)
+            result = Result(is_empty=False, id=mutator, is_scan=False,
+                            is_error=False)
+        if flush:
+            with self.lock:
+                self.futures[self.async_mutators[mutator]].append(result)
+
+    def async_mutator_set_cells(self, mutator, cells):
+        self._async_update(mutator, cells, False)
+    set_cells_async = async_mutator_set_cells
+
+    def async_mutator_set_cells_serialized(self, mutator, cells, flush):
+        self._async_update(mutator, [
+            Cell(key=Key(row=c.row, column_family=c.column_family),
+                 value=c.value)
+            for c in SerializedCellsReader(cells)], flush)
+    set_cells_serialized_async = async_mutator_set_cells_serialized
+
+    def async_mutator_close(self, mutator):
+        self.mutator_close(mutator)
+        with self.lock:
+            del self.async_mutators[mutator]
+    close_mutator_async = async_mutator_close
+
+    def scanner_close(self, scanner):
+        with self.lock:
+            if self.scanners.pop(scanner, None) is None:
+                raise ClientException(code=2, message='no such scanner')
+    close_scanner = scanner_close
+
+
+def _in_interval(row, interval):
+    if interval.start_row is not None and (
+            row < interval.start_row or
+            (row == interval.start_row and not interval.start_inclusive)):
+        return False
+    if interval.end_row is not None and (
+            row > interval.end_row or
+            (row == interval.end_row and not interval.end_inclusive)):
+        return False
+    return True
+
+
+class StandInBroker(object):
+    """ A tiny ThriftBroker stand-in, served from a background thread.
+
+    >>> with StandInBroker() as broker:
+    ...     client = ManagedThriftClient(broker.host, broker.port)
+
+    With ``unix_socket``, it listens on that socket file instead.
+    """
+
+    def __init__(self, handler=None, unix_socket=None):
+        self.handler = handler or StandInHandler()
+        self.processor = HqlService.Processor(self.handler)
+
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.active = 0
+        self._conns = set()
+        self._running = False
+        self._thread = None
+        self._workers = set()
+
+        self.unix_socket = unix_socket
+        if unix_socket:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(unix_socket)
+            self.host, self.port = 'localhost', None
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(('127.0.0.1', 0))
+            self.host, self.port = self._sock.getsockname()
+        self._sock.listen(128)
+        self._sock.settimeout(0.05)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._accept_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        self._sock.close()
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+        self.drop_connections()
+        for t in list(self._workers):
+            t.join(5)
+
+    def drop_connections(self):
+        """ hangs up on every client, as a restarted broker would """
+        with self.lock:
+            conns, self._conns = self._conns, set()
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, t, value, traceback):
+        self.stop()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            conn.settimeout(None)
+            with self.lock:
+                self.accepted += 1
+                self.active += 1
+                self._conns.add(conn)
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            with self.lock:
+                self._workers.add(t)
+            t.start()
+
+    def _serve(self, conn):
+        handle = TSocket.TSocket()
+        handle.setHandle(conn)
+        transport = TTransport.TFramedTransport(handle)
+        protocol = TBinaryProtocol.TBinaryProtocol(transport)
+        try:
+            while True:
+                self.processor.process(protocol, protocol)
+        except (TTransport.TTransportException, socket.error, EOFError):
+            pass
+        finally:
+            with self.lock:
+                self.active -= 1
+                self._conns.discard(conn)
+                self._workers.discard(threading.current_thread())
+            conn.close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `multiscan` module."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+from hyperthrift.gen.ttypes import ClientException, RowInterval, ScanSpec
+
+from ..flask_hypertable import ManagedThriftClient
+from ..multiscan import ScanCancelled
+
+from . import unittest
+from .helpers import StandInBroker
+from .scanner import make_cells
+
+
+def rows(cells):
+    return [cell.key.row for cell in cells]
+
+
+class MultiScanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.handler = self.broker.handler
+        self.handler.tables['foo'] = make_cells(7)
+        self.handler.tables['bar'] = make_cells(3)
+        self.client = ManagedThriftClient(self.broker.host, self.broker.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.stop()
+
+    def test_scans(self):
+        spec = ScanSpec(row_intervals=[RowInterval(start_row='row002',
+                                                   end_row='row004')])
+        with self.client.multi_scan('test', [('foo', spec), 'bar',
+                                             ('foo', None)]) as scans:
+            self.assertEqual(3, len(scans))
+            some, bar, foo = scans
+            self.assertEqual(['row002', 'row003', 'row004'], rows(some))
+            self.assertEqual(rows(make_cells(3)), rows(bar))
+            self.assertEqual(rows(make_cells(7)), rows(foo))
+            self.assertTrue(scans.done)
+            # one Result per batch of 2 cells
+            self.assertEqual(2 + 2 + 4, scans.results)
+        self.assertTrue(scans.closed)
+        self.assertEqual(set(), self.handler.async_scanners)
+        self.assertEqual({}, self.handler.futures)
+
+    def test_any_order(self):
+        with self.client.multi_scan(self.client.mns['test'],
+                                    ['foo', 'bar']) as scans:
+            # the Results of foo are kept meanwhile
+            self.assertEqual(rows(make_cells(3)), rows(scans[1]))
+            self.assertEqual(rows(make_cells(7)), rows(scans[0]))
+
+    def test_max_buffered(self):
+        with self.client.multi_scan('test', ['foo', 'bar'],
+                                    max_buffered=4) as scans:
+            # 6 cells of foo came before those of bar
+            self.assertEqual(rows(make_cells(3)), rows(scans[1]))
+            self.assertEqual(1, scans.cancelled)
+            self.assertRaises(ScanCancelled, list, scans[0])
+        self.assertEqual(set(), self.handler.async_scanners)
+
+    def test_max_buffered_in_turn(self):
+        with self.client.multi_scan('test', ['foo', 'bar'],
+                                    max_buffered=4) as scans:
+            self.assertEqual(rows(make_cells(7)), rows(scans[0]))
+            self.assertEqual(rows(make_cells(3)), rows(scans[1]))
+            self.assertEqual(0, scans.cancelled)
+
+    def test_error(self):
+        self.handler.failing.add('bar')
+        with self.client.multi_scan('test', ['foo', 'bar']) as scans:
+            self.assertRaises(ClientException, list, scans[1])
+            self.assertEqual(rows(make_cells(7)), rows(scans[0]))
+
+    def test_open_failure(self):
+        self.assertRaises(ClientException, self.client.multi_scan, 'test',
+                          ['foo', 'missing'])
+        self.assertEqual(set(), self.handler.async_scanners)
+        self.assertEqual({}, self.handler.futures)
+
+    def test_close_early(self):
+        scans = self.client.multi_scan('test', ['foo', 'bar'])
+        foo = scans[0]
+        self.assertEqual('row000', next(foo).key.row)
+        scans.close()
+        self.assertFalse(scans.done)
+        # the rest of the Result being read, then the scan is cut short
+        self.assertEqual('row001', next(foo).key.row)
+        self.assertRaises(ScanCancelled, next, foo)
+        self.assertRaises(ScanCancelled, list, scans[1])
+        self.assertEqual({}, self.handler.futures)
+        scans.close()
+
+    def test_close_when_done(self):
+        with self.client.multi_scan('test', ['foo', 'bar']) as scans:
+            self.assertEqual(rows(make_cells(7)), rows(scans[0]))
+            self.assertTrue(scans.done)
+        # every Result was fetched, so bar is complete
+        self.assertEqual(rows(make_cells(3)), rows(scans[1]))
+
+
+def suite():
+    from .helpers import setup_path
+    setup_path()
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MultiScanTestCase))
+    return suite
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `mutator` module."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import threading
+import time
+
+from flask import Flask
+
+from hyperthrift.gen.ttypes import Cell, ClientException, Key, KeyFlag
+from thrift.transport.TTransport import TTransportException
+
+from ..flask_hypertable import FlaskHypertable, ManagedThriftClient
+from ..mutator import MutatorManager
+
+from . import unittest
+from .helpers import StandInBroker
+
+
+class MutatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.handler = self.broker.handler
+        self.client = ManagedThriftClient(self.broker.host, self.broker.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.stop()
+
+    def rows(self, table='foo'):
+        return [cell.key.row for cell in self.handler.tables.get(table, [])]
+
+    def test_buffers_until_close(self):
+        with self.client.mutator('test', 'foo') as mutator:
+            for i in range(10):
+                mutator.set('row%d' % i, 'cf', 'q', 'v%d' % i)
+            self.assertEqual([], self.rows())
+            self.assertEqual(10, mutator.pending)
+        self.assertEqual(['row%d' % i for i in range(10)], self.rows())
+        self.assertEqual(['set_cells', 'close'], self.handler.mutator_calls)
+        self.assertEqual({}, self.handler.mutators)
+        self.assertTrue(mutator.closed)
+        self.assertEqual(10, mutator.cells)
+        self.assertEqual(1, mutator.flushes)
+
+    def test_max_cells(self):
+        mutator = self.client.mutator('test', 'foo', max_cells=4)
+        for i in range(10):
+            mutator.set('row%d' % i, 'cf')
+        self.assertEqual(8, len(self.rows()))
+        self.assertEqual(2, mutator.pending)
+        mutator.close()
+        self.assertEqual(10, len(self.rows()))
+        self.assertEqual(3, mutator.flushes)
+
+    def test_max_bytes(self):
+        mutator = self.client.mutator('test', 'foo', max_cells=None,
+                                      max_bytes=1000)
+        mutator.set('a', 'cf', 'q', 'x' * 600)
+        self.assertEqual(0, len(self.rows()))
+        mutator.set('b', 'cf', 'q', 'x' * 600)
+        self.assertEqual(2, len(self.rows()))
+        mutator.close()
+        self.assertEqual(1, mutator.flushes)
+
+    def test_flush_interval(self):
+        mutator = self.client.mutator('test', 'foo', flush_interval=0.05)
+        mutator.set('a', 'cf')
+        mutator.set('b', 'cf')
+        self.assertEqual(0, len(self.rows()))
+        time.sleep(0.06)
+        mutator.set('c', 'cf')
+        self.assertEqual(['a', 'b', 'c'], self.rows())
+        mutator.close()
+
+    def test_flush(self):
+        mutator = self.client.mutator(self.client.mns['test'], 'foo')
+        mutator.set_cell(Cell(key=Key(row='a', column_family='cf'),
+                              value='v'))
+        mutator.flush()
+        self.assertEqual(['a'], self.rows())
+        # nothing buffered, still commits
+        mutator.flush()
+        mutator.close()
+        self.assertEqual(['set_cells_flush', 'flush', 'close'],
+                         self.handler.mutator_calls)
+        self.assertRaises(ValueError, mutator.set, 'b', 'cf')
+        self.assertRaises(ValueError, mutator.flush)
+        mutator.close()
+
+    def test_set_cells_and_delete(self):
+        with self.client.mutator('test', 'foo') as mutator:
+            mutator.set_cells([Cell(key=Key(row='a', column_family='cf'))])
+            mutator.delete_row('a')
+        self.assertEqual([KeyFlag.INSERT, KeyFlag.DELETE_ROW],
+                         [cell.key.flag
+                          for cell in self.handler.tables['foo']])
+
+    def test_discard(self):
+        with self.client.mutator('test', 'foo') as mutator:
+            mutator.set('a', 'cf')
+            mutator.discard()
+        self.assertEqual([], self.rows())
+        self.assertEqual(['close'], self.handler.mutator_calls)
+
+    def test_sent_on_error(self):
+        try:
+            with self.client.mutator('test', 'foo') as mutator:
+                mutator.set('a', 'cf')
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertEqual(['a'], self.rows())
+        self.assertTrue(mutator.closed)
+
+    def test_close_error_does_not_hide_original(self):
+        try:
+            with self.client.mutator('test', 'foo') as mutator:
+                self.handler.mutators.clear()
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertTrue(mutator.closed)
+
+        mutator = self.client.mutator('test', 'foo')
+        self.handler.mutators.clear()
+        self.assertRaises(ClientException, mutator.close)
+
+
+class AsyncMutatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.handler = self.broker.handler
+        self.client = ManagedThriftClient(self.broker.host, self.broker.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.stop()
+
+    def rows(self, table='foo'):
+        return [cell.key.row for cell in self.handler.tables.get(table, [])]
+
+    def test_in_flight(self):
+        mutator = self.client.async_mutator('test', 'foo', max_cells=2,
+                                            max_in_flight=3)
+        for i in range(6):
+            mutator.set('row%d' % i, 'cf')
+        self.assertEqual(3, mutator.in_flight)
+        self.assertEqual(3, len(self.handler.futures[mutator._future]))
+        mutator.set('row6', 'cf')
+        mutator.set('row7', 'cf')
+        # one Result was drained to make room for the fourth batch
+        self.assertEqual(3, mutator.in_flight)
+
+        mutator.flush()
+        self.assertEqual(0, mutator.in_flight)
+        self.assertEqual(['row%d' % i for i in range(8)], self.rows())
+        self.assertEqual(4, mutator.flushes)
+        mutator.close()
+        self.assertEqual({}, self.handler.futures)
+        self.assertEqual({}, self.handler.async_mutators)
+
+    def test_close(self):
+        with self.client.async_mutator('test', 'foo') as mutator:
+            mutator.set_cells([Cell(key=Key(row='a', column_family='cf'),
+                                    value='v')])
+            self.assertEqual([], self.rows())
+        self.assertEqual(['a'], self.rows())
+        self.assertEqual(['async_set_cells_flush', 'close'],
+                         self.handler.mutator_calls)
+        self.assertTrue(mutator.closed)
+        self.assertEqual({}, self.handler.futures)
+
+    def test_error(self):
+        self.handler.failing.add('foo')
+        mutator = self.client.async_mutator('test', 'foo', max_cells=1,
+                                            max_in_flight=1)
+        mutator.set('a', 'cf')
+        # raised once its Result is drained, the next batch is kept
+        self.assertRaises(ClientException, mutator.set, 'b', 'cf')
+        self.assertEqual(1, mutator.errors)
+        self.assertEqual(1, mutator.pending)
+        self.handler.failing.clear()
+        mutator.close()
+        self.assertEqual(['b'], self.rows())
+        self.assertTrue(mutator.closed)
+        self.assertEqual({}, self.handler.futures)
+
+    def test_open_failure(self):
+        def fail(*args):
+            raise ClientException(code=1, message='no such table')
+        self.handler.async_mutator_open = fail
+        self.assertRaises(ClientException, self.client.async_mutator, 'test',
+                          'foo')
+        self.assertEqual({}, self.handler.futures)
+
+
+class MutatorManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.handler = self.broker.handler
+        self.connections = 0
+        self.manager = MutatorManager(self.connect, flush_interval=None)
+
+    def connect(self):
+        self.connections += 1
+        return ManagedThriftClient(self.broker.host, self.broker.port)
+
+    def tearDown(self):
+        self.manager.close()
+        self.broker.stop()
+
+    def rows(self, table='foo'):
+        return [cell.key.row for cell in self.handler.tables.get(table, [])]
+
+    def test_wait(self):
+        self.manager.set('test', 'foo', 'a', 'cf', wait=True)
+        self.assertEqual(['a'], self.rows())
+        self.assertEqual(['set_cells_flush'], self.handler.mutator_calls)
+
+    def test_shared(self):
+        for i in range(100):
+            self.manager.set('test', 'foo', 'row%03d' % i, 'cf')
+        self.manager.set_cells('test', 'bar', [
+            Cell(key=Key(row='a', column_family='cf'))])
+        self.manager.flush()
+        self.assertEqual(['row%03d' % i for i in range(100)], self.rows())
+        self.assertEqual(['a'], self.rows('bar'))
+        # one long-lived mutator per table, on a single connection
+        self.assertEqual(2, len(self.handler.mutators))
+        self.assertEqual(1, self.connections)
+        self.assertEqual(101, self.manager.cells)
+        self.assertEqual(2, self.manager.flushes)
+
+        self.manager.set('test', 'foo', 'z', 'cf', wait=True)
+        self.assertEqual(2, len(self.handler.mutators))
+
+    def test_flags(self):
+        self.manager.set('test', 'foo', 'a', 'cf', flags=1)
+        self.manager.set('test', 'foo', 'b', 'cf', flags=2)
+        self.manager.flush()
+        self.assertEqual(2, len(self.handler.mutators))
+
+    def test_max_cells(self):
+        self.manager.max_cells = 10
+        for i in range(25):
+            self.manager.set('test', 'foo', 'r%02d' % i, 'cf')
+        self.manager.flush()
+        self.assertEqual(['set_cells', 'set_cells', 'set_cells_flush'],
+                         self.handler.mutator_calls)
+
+    def test_flush_interval(self):
+        self.manager.flush_interval = 0.05
+        self.manager.set('test', 'foo', 'a', 'cf')
+        for i in range(100):
+            if self.rows():
+                break
+            time.sleep(0.01)
+        self.assertEqual(['a'], self.rows())
+        self.assertEqual(['set_cells_flush'], self.handler.mutator_calls)
+
+    def test_error(self):
+        self.manager.set('test', 'foo', 'a', 'cf', wait=True)
+        self.handler.mutators.clear()
+        self.assertRaises(ClientException, self.manager.set,
+                          'test', 'foo', 'b', 'cf', wait=True)
+        self.assertEqual(1, self.manager.errors)
+
+        # only the mutator is opened again
+        self.manager.set('test', 'foo', 'c', 'cf', wait=True)
+        self.assertEqual(['a', 'c'], self.rows())
+        self.assertEqual(1, self.connections)
+
+    def test_transport_error(self):
+        clients = []
+        connect = self.manager.connect
+
+        def keep_connect():
+            clients.append(connect())
+            return clients[-1]
+        self.manager.connect = keep_connect
+
+        self.manager.set('test', 'foo', 'a', 'cf', wait=True)
+        clients[0].transport.close()
+        self.assertRaises(TTransportException, self.manager.set,
+                          'test', 'foo', 'b', 'cf', wait=True)
+        self.assertEqual(1, self.manager.errors)
+
+        # starts over on a new connection
+        self.manager.set('test', 'foo', 'c', 'cf', wait=True)
+        self.assertEqual(['a', 'c'], self.rows())
+        self.assertEqual(2, self.connections)
+
+    def test_invalid_cell(self):
+        self.assertRaises(ValueError, self.manager.set, 'test', 'foo', '',
+                          'cf')
+        self.assertRaises(ValueError, self.manager.set_cells, 'test', 'foo',
+                          [Cell(key=Key(row='a', column_family='cf')),
+                           Cell(key=Key(row='b\0', column_family='cf'))])
+        self.assertTrue(self.manager._queue.empty())
+        self.manager.flush()
+        self.assertEqual([], self.rows())
+        self.assertEqual(0, self.manager.errors)
+
+    def test_coalesced_failure(self):
+        self.handler.failing.add('bar')
+        entered = threading.Event()
+        gate = threading.Event()
+        connect = self.manager.connect
+
+        def slow_connect():
+            entered.set()
+            gate.wait(5)
+            return connect()
+        self.manager.connect = slow_connect
+
+        # the thread waits for its connection, meanwhile a write to a
+        # failing table, a waiting write and a flush are queued behind it
+        self.manager.set('test', 'foo', 'a', 'cf')
+        entered.wait(5)
+        errors = {}
+
+        def wait_for(name, call, *args, **kwargs):
+            try:
+                call(*args, **kwargs)
+            except Exception as e:
+                errors[name] = e
+        threads = [
+            threading.Thread(target=wait_for, args=(
+                'bar', self.manager.set, 'test', 'bar', 'x', 'cf'),
+                kwargs=dict(wait=True)),
+            threading.Thread(target=wait_for, args=(
+                'foo', self.manager.set, 'test', 'foo', 'b', 'cf'),
+                kwargs=dict(wait=True)),
+            threading.Thread(target=wait_for, args=(
+                'flush', self.manager.flush))]
+        for thread in threads:
+            thread.start()
+        while self.manager._queue.qsize() < 3:
+            time.sleep(0.01)
+        gate.set()
+
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        # only the failing table's caller got the error
+        self.assertEqual(['bar'], list(errors))
+        self.assertTrue(isinstance(errors['bar'], ClientException))
+        self.assertEqual(['a', 'b'], self.rows())
+        self.assertEqual(1, self.manager.errors)
+        self.assertEqual(1, self.connections)
+
+    def test_close_after_failure(self):
+        self.handler.failing.add('bar')
+        self.manager.set('test', 'bar', 'a', 'cf')
+        self.manager.close(5)
+        self.assertFalse(self.manager._thread.is_alive())
+        self.assertEqual(1, self.manager.errors)
+
+    def test_close(self):
+        self.manager.set('test', 'foo', 'a', 'cf')
+        self.manager.close()
+        self.assertEqual(['a'], self.rows())
+        self.assertEqual({}, self.handler.mutators)
+        self.assertRaises(ValueError, self.manager.set, 'test', 'foo', 'b',
+                          'cf')
+        self.manager.close()
+
+    def test_namespace_name(self):
+        self.assertRaises(ValueError, self.manager.set, 1, 'foo', 'a', 'cf')
+
+    def test_extension(self):
+        app = Flask(__name__)
+        app.config['HYPERTABLE_HOST'] = self.broker.host
+        app.config['HYPERTABLE_PORT'] = self.broker.port
+        app.config['HYPERTABLE_MUTATOR_MAX_CELLS'] = 50
+        app.config['HYPERTABLE_MUTATOR_WAIT'] = True
+        ht = FlaskHypertable(app)
+        self.assertEqual(50, ht.mutators.max_cells)
+        self.assertEqual(1.0, ht.mutators.flush_interval)
+
+        ht.mutators.set('test', 'foo', 'a', 'cf')
+        self.assertEqual(['a'], self.rows())
+        ht.mutators.set('test', 'foo', 'b', 'cf', wait=False)
+        ht.close_app()
+        self.assertEqual(['a', 'b'], self.rows())
+        self.assertEqual({}, self.handler.mutators)
+
+
+def suite():
+    from .helpers import setup_path
+    setup_path()
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MutatorTestCase))
+    suite.addTest(unittest.makeSuite(AsyncMutatorTestCase))
+    suite.addTest(unittest.makeSuite(MutatorManagerTestCase))
+    return suite
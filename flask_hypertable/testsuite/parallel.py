@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `parallel` module."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+from hyperthrift.gen.ttypes import CellInterval, ClientException, \
+    RowInterval, ScanSpec, TableSplit
+
+from ..flask_hypertable import ManagedThriftClient
+from ..parallel import ParallelScan, split_intervals
+from ..pool import ConnectionPool
+
+from . import unittest
+from .helpers import StandInBroker
+from .scanner import make_cells
+
+
+def interval(start=None, end=None, start_inclusive=True,
+             end_inclusive=True):
+    return RowInterval(start_row=start, start_inclusive=start_inclusive,
+                       end_row=end, end_inclusive=end_inclusive)
+
+
+def as_tuples(intervals):
+    return [(i.start_row, i.start_inclusive, i.end_row, i.end_inclusive)
+            for i in intervals]
+
+
+class SplitIntervalsTestCase(unittest.TestCase):
+
+    def test_whole_split(self):
+        split = TableSplit(start_row='b', end_row='d')
+        self.assertEqual([('b', False, 'd', True)],
+                         as_tuples(split_intervals(split)))
+
+    def test_unbounded_split(self):
+        self.assertEqual([(None, True, None, True)],
+                         as_tuples(split_intervals(TableSplit())))
+
+    def test_intersection(self):
+        split = TableSplit(start_row='b', end_row='d')
+        self.assertEqual(
+            [('b', False, 'c', True),
+             ('c', True, 'd', True),
+             ('b', False, 'd', False)],
+            as_tuples(split_intervals(split, [
+                interval('a', 'c'),
+                interval('c', 'z'),
+                interval('b', 'd', True, False)])))
+
+    def test_disjoint(self):
+        split = TableSplit(start_row='b', end_row='d')
+        self.assertEqual([], split_intervals(split, [
+            interval('e', 'f'),
+            interval('a', 'b'),
+            interval('d', 'e', False)]))
+        self.assertEqual([('d', True, 'd', True)],
+                         as_tuples(split_intervals(split,
+                                                   [interval('d', 'e')])))
+
+
+class ParallelScanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.handler = self.broker.handler
+        self.cells = make_cells(30)
+        self.handler.tables['foo'] = self.cells
+        self.handler.splits['foo'] = [
+            TableSplit(start_row='row019', end_row=None),
+            TableSplit(start_row=None, end_row='row004'),
+            TableSplit(start_row='row004', end_row='row019'),
+        ]
+        self.pool = ConnectionPool(
+            lambda: ManagedThriftClient(self.broker.host, self.broker.port),
+            pool_size=4, max_overflow=0, timeout=5)
+
+    def tearDown(self):
+        self.pool.dispose()
+        self.broker.stop()
+
+    def rows(self, cells):
+        return [cell.key.row for cell in cells]
+
+    def test_ordered(self):
+        with ParallelScan(self.pool, 'test', 'foo', workers=3) as cells:
+            self.assertEqual(self.rows(self.cells), self.rows(cells))
+        self.assertEqual(0, self.pool.checkedout)
+        self.assertEqual({}, self.handler.scanners)
+
+    def test_unordered(self):
+        scan = ParallelScan(self.pool, 'test', 'foo', workers=2,
+                            ordered=False)
+        self.assertEqual(sorted(self.rows(self.cells)),
+                         sorted(self.rows(scan)))
+        self.assertTrue(scan.closed)
+        self.assertEqual(0, self.pool.checkedout)
+
+    def test_row_intervals(self):
+        spec = ScanSpec(row_intervals=[interval('row002', 'row006'),
+                                       interval('row025', None, False)])
+        with ParallelScan(self.pool, 'test', 'foo', spec) as cells:
+            self.assertEqual(['row002', 'row003', 'row004', 'row005',
+                              'row006', 'row026', 'row027', 'row028',
+                              'row029'], self.rows(cells))
+
+    def test_more_splits_than_workers(self):
+        self.handler.splits['foo'] = [
+            TableSplit(start_row=start, end_row=end)
+            for start, end in zip([None] + ['row%03d' % i
+                                            for i in range(2, 30, 2)],
+                                  ['row%03d' % i
+                                   for i in range(2, 30, 2)] + [None])]
+        with ParallelScan(self.pool, 'test', 'foo', workers=2,
+                          prefetch=1) as cells:
+            self.assertEqual(self.rows(self.cells), self.rows(cells))
+
+    def test_early_close(self):
+        with ParallelScan(self.pool, 'test', 'foo', workers=3,
+                          prefetch=1) as cells:
+            for cell in cells:
+                break
+        self.assertFalse(any(t.is_alive() for t in cells._threads))
+        self.assertEqual(0, self.pool.checkedout)
+        self.assertEqual({}, self.handler.scanners)
+
+    def test_errors(self):
+        self.assertRaises(ClientException, ParallelScan, self.pool, 'test',
+                          'bar')
+        self.assertRaises(ValueError, ParallelScan, self.pool, 1, 'foo')
+        self.assertRaises(ValueError, ParallelScan, self.pool, 'test',
+                          'foo', ScanSpec(cell_intervals=[CellInterval()]))
+
+        scan = ParallelScan(self.pool, 'test', 'foo', workers=1)
+        # the table disappears before the workers reach the last split
+        del self.handler.tables['foo']
+        self.assertRaises((ClientException, KeyError), list, scan)
+        self.assertTrue(scan.closed)
+        self.assertEqual(0, self.pool.checkedout)
+
+
+def suite():
+    from .helpers import setup_path
+    setup_path()
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SplitIntervalsTestCase))
+    suite.addTest(unittest.makeSuite(ParallelScanTestCase))
+    return suite
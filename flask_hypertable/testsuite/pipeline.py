@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `pipeline` module."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+from hyperthrift.gen.ttypes import ClientException
+
+from ..flask_hypertable import ManagedThriftClient
+from ..pipeline import Pipeline
+
+from . import unittest
+from .helpers import StandInBroker, StandInHandler
+
+
+class FailingHandler(StandInHandler):
+
+    def hql_query(self, ns, command):
+        if command == 'fail':
+            raise ClientException(code=1, message='no such table')
+        return StandInHandler.hql_query(self, ns, command)
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker(FailingHandler()).start()
+        self.client = ManagedThriftClient(self.broker.host, self.broker.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.stop()
+
+    def count_writes(self):
+        sock = self.client.transport.socket
+        writes = []
+        write = sock.write
+
+        def counting_write(buf):
+            writes.append(buf)
+            return write(buf)
+        sock.write = counting_write
+        return writes
+
+    def test_results_in_order(self):
+        writes = self.count_writes()
+        with self.client.pipeline() as p:
+            for i in range(20):
+                p.hql_query(0, 'select %d' % i)
+            p.namespace_exists('sys')
+            self.assertEqual(21, len(p))
+        self.assertEqual([['select %d' % i] for i in range(20)],
+                         [r.results for r in p.results[:20]])
+        self.assertEqual(True, p.results[20])
+        self.assertEqual(1, len(writes))
+
+    def test_batches(self):
+        writes = self.count_writes()
+        p = self.client.pipeline(max_in_flight=3)
+        for i in range(7):
+            p.hql_query(0, str(i))
+        results = p.execute()
+        self.assertEqual([[str(i)] for i in range(7)],
+                         [r.results for r in results])
+        self.assertEqual(3, len(writes))
+        self.assertEqual(0, len(p))
+
+    def test_raise_on_error(self):
+        p = self.client.pipeline()
+        p.hql_query(0, 'a').hql_query(0, 'fail').hql_query(0, 'b')
+        self.assertRaises(ClientException, p.execute)
+        # every reply was read, the connection is still in sync
+        self.assertEqual(['b'], p.results[2].results)
+        self.assertEqual(['c'], self.client.hql_query(0, 'c').results)
+
+    def test_errors_as_results(self):
+        p = self.client.pipeline(raise_on_error=False)
+        p.hql_query(0, 'fail')
+        p.hql_query(0, 'a')
+        results = p.execute()
+        self.assertTrue(isinstance(results[0], ClientException))
+        self.assertEqual(['a'], results[1].results)
+
+    def test_failed_send_is_not_sent(self):
+        p = self.client.pipeline()
+        p.hql_query(0, 'a')
+        p.hql_query(0, 'b', 'unexpected')
+        self.assertRaises(TypeError, p.execute)
+        self.assertEqual(['c'], self.client.hql_query(0, 'c').results)
+
+    def test_not_executed_on_error(self):
+        try:
+            with self.client.pipeline() as p:
+                p.hql_query(0, 'a')
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertTrue(p.results is None)
+        self.assertEqual(['c'], self.client.hql_query(0, 'c').results)
+
+    def test_unknown_method(self):
+        p = self.client.pipeline()
+        self.assertRaises(AttributeError, getattr, p, 'no_such_method')
+        self.assertRaises(AttributeError, getattr, p, '_iprot')
+        self.assertRaises(ValueError, Pipeline, self.client, max_in_flight=0)
+
+
+def suite():
+    from .helpers import setup_path
+    setup_path()
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PipelineTestCase))
+    return suite
@@ -0,0 +1,646 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `pool` module."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import os
+import random
+import threading
+import time
+
+from ..breaker import CircuitBreaker
+from ..flask_hypertable import ManagedThriftClient
+from ..pool import ConnectionPool, BalancedPool, PoolTimeout
+
+from . import unittest
+from .helpers import StandInBroker
+
+
+def wait_for(predicate, timeout=5.0):
+    """ polls predicate() until it is true or the timeout expires """
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def make_pool(self, **kwargs):
+        def creator():
+            return ManagedThriftClient(self.broker.host, self.broker.port,
+                                       timeout_ms=5000)
+        return ConnectionPool(creator, **kwargs)
+
+    def test_checkout_reuses_idle_connection(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0)
+
+        client = pool.checkout()
+        pool.checkin(client)
+
+        self.assertTrue(pool.checkout() is client)
+        self.assertEqual(1, pool.size)
+        self.assertTrue(wait_for(lambda: self.broker.accepted == 1))
+
+    def test_overflow_is_closed_on_checkin(self):
+        pool = self.make_pool(pool_size=1, max_overflow=2)
+
+        clients = [pool.checkout() for _ in range(3)]
+        self.assertEqual(3, pool.size)
+        self.assertEqual(2, pool.overflow)
+
+        for client in clients:
+            pool.checkin(client)
+
+        self.assertEqual(1, pool.size)
+        self.assertEqual(1, pool.idle)
+        self.assertEqual(0, pool.overflow)
+        self.assertFalse(clients[1].is_active)
+        self.assertFalse(clients[2].is_active)
+
+    def test_discard_releases_slot(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0)
+
+        client = pool.checkout()
+        pool.checkin(client, discard=True)
+
+        self.assertFalse(client.is_active)
+        self.assertEqual(0, pool.size)
+        self.assertFalse(pool.checkout() is client)
+
+    def test_failed_connect_releases_slot(self):
+        def creator():
+            raise IOError("broker down")
+        pool = ConnectionPool(creator, pool_size=1, max_overflow=0)
+
+        self.assertRaises(IOError, pool.checkout)
+        self.assertRaises(IOError, pool.checkout)
+        self.assertEqual(0, pool.size)
+        self.assertEqual(0, pool.checkedout)
+
+    def test_exhausted_pool_waits_for_checkin(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0)
+        client = pool.checkout()
+        got = []
+
+        t = threading.Thread(target=lambda: got.append(pool.checkout()))
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual([], got)
+
+        pool.checkin(client)
+        t.join(5)
+        self.assertEqual([client], got)
+
+    def test_exhausted_pool_times_out(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0, timeout=0.1)
+        pool.checkout()
+
+        started = time.time()
+        self.assertRaises(PoolTimeout, pool.checkout)
+        self.assertTrue(time.time() - started >= 0.1)
+        self.assertEqual(1, pool.timeouts)
+        self.assertEqual(1, pool.wait_count)
+        self.assertTrue(pool.max_wait_time >= 0.1)
+        self.assertEqual(1, pool.checkedout)
+
+    def test_checkout_without_blocking(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0, timeout=5)
+        self.assertFalse(pool.full)
+        client = pool.checkout(block=False)
+        self.assertTrue(pool.full)
+
+        started = time.time()
+        self.assertRaises(PoolTimeout, pool.checkout, block=False)
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(0, pool.timeouts)
+
+        pool.checkin(client)
+        self.assertTrue(pool.checkout(block=False) is client)
+
+    def test_wait_time_is_recorded(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0, timeout=5)
+        client = pool.checkout()
+        self.assertEqual(0, pool.wait_count)
+
+        timer = threading.Timer(0.05, pool.checkin, args=(client,))
+        timer.start()
+        self.assertTrue(pool.checkout() is client)
+        timer.join()
+
+        self.assertEqual(1, pool.wait_count)
+        self.assertEqual(0, pool.timeouts)
+        self.assertTrue(pool.wait_time > 0)
+
+    def test_pre_ping_replaces_dead_connection(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0, pre_ping=True)
+        stale = pool.checkout()
+        stale.mns['test']
+        stale.mns['other']
+        pool.checkin(stale)
+
+        self.assertTrue(wait_for(lambda: self.broker.active == 1))
+        self.broker.drop_connections()
+
+        client = pool.checkout()
+        self.assertFalse(client is stale)
+        self.assertFalse(stale.is_active)
+        # forgotten rather than closed over the broken connection
+        self.assertEqual({}, stale.mns.namespaces)
+        self.assertTrue(client.ping())
+        self.assertEqual(1, pool.size)
+        self.assertEqual(1, pool.checkedout)
+
+    def test_recycle_replaces_old_connection(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0, recycle=0.05)
+        old = pool.checkout()
+        pool.checkin(old)
+        self.assertTrue(pool.checkout() is old)
+        pool.checkin(old)
+
+        time.sleep(0.1)
+        client = pool.checkout()
+        self.assertFalse(client is old)
+        self.assertFalse(old.is_active)
+        self.assertEqual(1, pool.size)
+
+    def test_idle_timeout_replaces_idle_connection(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0, idle_timeout=0.05)
+        old = pool.checkout()
+        time.sleep(0.1)
+        pool.checkin(old)
+        self.assertTrue(pool.checkout() is old)
+        pool.checkin(old)
+
+        time.sleep(0.1)
+        client = pool.checkout()
+        self.assertFalse(client is old)
+        self.assertFalse(old.is_active)
+
+    def test_sweep_closes_expired_idle_connections(self):
+        pool = self.make_pool(pool_size=3, max_overflow=0, idle_timeout=0.05)
+        clients = [pool.checkout() for _ in range(3)]
+        pool.checkin(clients[0])
+        pool.checkin(clients[1])
+
+        time.sleep(0.1)
+        # the lazy sweep on checkin takes care of the stale ones
+        pool.checkin(clients[2])
+        self.assertEqual(1, pool.size)
+        self.assertEqual(1, pool.idle)
+        self.assertFalse(clients[0].is_active)
+        self.assertFalse(clients[1].is_active)
+        self.assertTrue(clients[2].is_active)
+
+        time.sleep(0.1)
+        self.assertEqual(1, pool.sweep())
+        self.assertEqual(0, pool.size)
+        self.assertTrue(wait_for(lambda: self.broker.active == 0))
+
+    def test_fifo_rotates_connections(self):
+        pool = self.make_pool(pool_size=2, max_overflow=0)
+        first, second = pool.checkout(), pool.checkout()
+        pool.checkin(first)
+        pool.checkin(second)
+
+        self.assertTrue(pool.checkout() is first)
+
+    def test_lifo_reuses_most_recent_connection(self):
+        pool = self.make_pool(pool_size=2, max_overflow=0, lifo=True)
+        self.assertTrue(pool.lifo)
+        first, second = pool.checkout(), pool.checkout()
+        pool.checkin(first)
+        pool.checkin(second)
+
+        for _ in range(3):
+            client = pool.checkout()
+            self.assertTrue(client is second)
+            pool.checkin(client)
+
+    def test_lifo_lets_surplus_connections_idle_out(self):
+        pool = self.make_pool(pool_size=3, max_overflow=0, lifo=True,
+                              idle_timeout=0.1)
+        clients = [pool.checkout() for _ in range(3)]
+        for client in clients:
+            pool.checkin(client)
+
+        # light load keeps reusing the same connection
+        for _ in range(6):
+            time.sleep(0.04)
+            client = pool.checkout()
+            self.assertTrue(client is clients[2])
+            pool.checkin(client)
+
+        self.assertEqual(1, pool.size)
+        self.assertFalse(clients[0].is_active)
+        self.assertFalse(clients[1].is_active)
+
+    def test_lifo_sweep_keeps_order(self):
+        pool = self.make_pool(pool_size=3, max_overflow=0, lifo=True,
+                              idle_timeout=60)
+        clients = [pool.checkout() for _ in range(3)]
+        for client in clients:
+            pool.checkin(client)
+
+        self.assertEqual(0, pool.sweep())
+        self.assertEqual(list(reversed(clients)),
+                         [pool.checkout() for _ in range(3)])
+
+    def test_failed_replacement_releases_slot(self):
+        clients = []
+
+        def creator():
+            if clients:
+                raise IOError("broker down")
+            clients.append(ManagedThriftClient(self.broker.host,
+                                               self.broker.port))
+            return clients[-1]
+
+        pool = ConnectionPool(creator, pool_size=1, max_overflow=0,
+                              pre_ping=True)
+        pool.checkin(pool.checkout())
+        self.assertTrue(wait_for(lambda: self.broker.active == 1))
+        self.broker.drop_connections()
+
+        self.assertRaises(IOError, pool.checkout)
+        self.assertEqual(0, pool.size)
+        self.assertEqual(0, pool.checkedout)
+
+    def test_prefill(self):
+        pool = self.make_pool(pool_size=3, max_overflow=0)
+        setup_calls = []
+        events = []
+        pool.listen('checkin', events.append)
+
+        self.assertEqual(3, pool.prefill(setup=setup_calls.append))
+        self.assertEqual(3, len(setup_calls))
+        self.assertEqual(3, pool.idle)
+        self.assertEqual(0, pool.checkedout)
+        self.assertEqual(0, pool.stats()['checkouts'])
+        self.assertEqual(0, pool.stats()['checkins'])
+        self.assertEqual([], events)
+        self.assertTrue(wait_for(lambda: self.broker.accepted == 3))
+
+        clients = [pool.checkout() for _ in range(3)]
+        self.assertEqual(set(setup_calls), set(clients))
+        self.assertEqual(0, pool.prefill())
+
+    def test_prefill_error(self):
+        def setup(client):
+            raise IOError("no such namespace")
+        pool = self.make_pool(pool_size=2, max_overflow=0)
+
+        self.assertRaises(IOError, pool.prefill, setup=setup)
+        self.assertEqual(0, pool.size)
+        self.assertEqual(0, pool.checkedout)
+        stats = pool.stats()
+        self.assertEqual(0, stats['checkins'])
+        self.assertEqual({'error': 2}, stats['discards'])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "requires os.fork")
+    def test_fork_starts_over(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0)
+        inherited = pool.checkout()
+        ns = inherited.mns['test']
+        pool.checkin(inherited)
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                client = pool.checkout()
+                if client is not inherited and client.ping() and \
+                        not inherited.is_active and pool.size == 1:
+                    pool.checkin(client)
+                    pool.dispose()
+                    code = 0
+            finally:
+                os._exit(code)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+
+        # the child neither closed the socket nor the namespace
+        client = pool.checkout()
+        self.assertTrue(client is inherited)
+        self.assertTrue(client.ping())
+        self.assertEqual({ns: 'test'}, self.broker.handler.namespaces)
+
+    def test_checkin_after_fork_detaches(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0)
+        client = pool.checkout()
+
+        # pretend the client was checked out in a parent process
+        client.pid = -1
+        pool._pid = -1
+
+        pool.checkin(client)
+        self.assertFalse(client.is_active)
+        self.assertEqual(0, pool.size)
+        self.assertEqual(0, pool.checkedout)
+
+    def test_stats(self):
+        pool = self.make_pool(pool_size=1, max_overflow=1)
+        first, second = pool.checkout(), pool.checkout()
+        pool.checkin(first, discard=True)
+        pool.checkin(second)
+
+        stats = pool.stats()
+        self.assertEqual(1, stats['pool_size'])
+        self.assertEqual(1, stats['max_overflow'])
+        self.assertEqual(1, stats['size'])
+        self.assertEqual(1, stats['idle'])
+        self.assertEqual(0, stats['checkedout'])
+        self.assertEqual(0, stats['overflow'])
+        self.assertEqual(2, stats['connects'])
+        self.assertEqual(2, stats['checkouts'])
+        self.assertEqual(2, stats['checkins'])
+        self.assertEqual({'error': 1}, stats['discards'])
+
+        held = [pool.checkout(), pool.checkout()]
+        for client in held:
+            pool.checkin(client)
+
+        stats = pool.stats()
+        self.assertEqual({'error': 1, 'overflow': 1}, stats['discards'])
+        self.assertEqual(3, stats['connects'])
+
+    def test_listeners(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0, timeout=0)
+        events = []
+
+        @pool.listen('checkout')
+        def on_checkout(client, waited):
+            events.append(('checkout', client, waited))
+
+        @pool.listen('discard')
+        def on_discard(client, reason):
+            events.append(('discard', client, reason))
+
+        pool.listen('connect', lambda c: events.append(('connect', c)))
+        pool.listen('checkin', lambda c: events.append(('checkin', c)))
+        pool.listen('timeout', lambda w: events.append(('timeout',)))
+
+        client = pool.checkout()
+        self.assertRaises(PoolTimeout, pool.checkout)
+        pool.checkin(client, discard=True)
+
+        self.assertEqual([('connect', client),
+                          ('checkout', client, 0.0),
+                          ('timeout',),
+                          ('checkin', client),
+                          ('discard', client, 'error')], events)
+
+    def test_listener_errors_are_ignored(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0)
+
+        def broken(client, waited):
+            raise RuntimeError("metrics are down")
+        pool.listen('checkout', broken)
+
+        client = pool.checkout()
+        self.assertEqual(1, pool.checkedout)
+        pool.checkin(client)
+        self.assertRaises(ValueError, pool.listen, 'bogus', broken)
+
+    def test_dispose(self):
+        pool = self.make_pool(pool_size=2, max_overflow=0)
+        clients = [pool.checkout() for _ in range(2)]
+        for client in clients:
+            pool.checkin(client)
+
+        self.assertEqual(None, pool.dispose())
+        self.assertEqual(0, pool.size)
+        self.assertFalse(any(c.is_active for c in clients))
+
+    def test_stress(self):
+        pool_size, max_overflow = 4, 6
+        pool = self.make_pool(pool_size=pool_size, max_overflow=max_overflow)
+        errors = []
+        in_use = [0, 0]  # current, high water
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                for i in range(25):
+                    client = pool.checkout()
+                    with lock:
+                        in_use[0] += 1
+                        in_use[1] = max(in_use[1], in_use[0], pool.size)
+                    try:
+                        client.namespace_exists('test')
+                    finally:
+                        with lock:
+                            in_use[0] -= 1
+                        # every so often pretend the transport broke
+                        pool.checkin(client, discard=(i % 7 == 0))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(64)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+
+        self.assertEqual([], errors)
+        self.assertTrue(in_use[1] <= pool_size + max_overflow)
+        self.assertEqual(0, pool.checkedout)
+        self.assertTrue(pool.size <= pool_size)
+        self.assertTrue(wait_for(lambda: self.broker.active == pool.size))
+
+        pool.dispose()
+        self.assertTrue(wait_for(lambda: self.broker.active == 0))
+
+
+class BalancedPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.brokers = [StandInBroker().start() for _ in range(3)]
+        self.hosts = [(b.host, b.port) for b in self.brokers]
+
+    def tearDown(self):
+        for broker in self.brokers:
+            broker.stop()
+
+    def make_pool(self, **kwargs):
+        return BalancedPool(ManagedThriftClient, self.hosts, **kwargs)
+
+    def test_spreads_outstanding_checkouts(self):
+        pool = self.make_pool(pool_size=2, max_overflow=2)
+        pool._random = random.Random(0)
+        clients = [pool.checkout() for _ in range(9)]
+
+        per_host = [p.checkedout for p in pool._pool_list]
+        self.assertEqual(9, sum(per_host))
+        # power of two choices keeps every broker within reach
+        self.assertTrue(max(per_host) - min(per_host) <= 2, per_host)
+        self.assertEqual(9, pool.checkedout)
+
+        for client in clients:
+            pool.checkin(client)
+        self.assertEqual(0, pool.checkedout)
+        self.assertEqual(6, pool.idle)
+        self.assertEqual(6, pool.size)
+
+    def test_skips_full_pools(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0, timeout=0.05)
+        for _ in range(10):
+            clients = []
+            errors = []
+
+            def checkout():
+                try:
+                    clients.append(pool.checkout())
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=checkout) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual([], errors)
+            self.assertEqual([1, 1, 1],
+                             [p.checkedout for p in pool._pool_list])
+            self.assertRaises(PoolTimeout, pool.checkout)
+            self.assertRaises(PoolTimeout, pool.checkout, prefer='localhost')
+            for client in clients:
+                pool.checkin(client)
+
+    def test_prefer_full_pool(self):
+        self.hosts[1] = ('localhost', self.brokers[1].port)
+        pool = self.make_pool(pool_size=1, max_overflow=0, timeout=5)
+        first = pool.checkout(prefer='localhost')
+        second = pool.checkout(prefer='localhost')
+        self.assertEqual(self.hosts[1], (first.host, first.port))
+        self.assertNotEqual(self.hosts[1], (second.host, second.port))
+
+    def test_prefer(self):
+        # the same stand-in brokers, under distinct host names
+        self.hosts[1] = ('localhost', self.brokers[1].port)
+        pool = self.make_pool(pool_size=2, max_overflow=0)
+        for _ in range(4):
+            client = pool.checkout(prefer=('ht2.example.com', 'localhost'))
+            self.assertEqual(self.hosts[1], (client.host, client.port))
+            pool.checkin(client)
+
+        # unknown hosts fall back to the usual choice
+        pool.checkin(pool.checkout(prefer='ht9'))
+        pool.dispose()
+
+    def test_checkin_returns_to_the_owning_pool(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0)
+        client = pool.checkout()
+        owner = pool.pools[(client.host, client.port)]
+        self.assertEqual(1, owner.checkedout)
+
+        pool.checkin(client)
+        self.assertEqual(0, owner.checkedout)
+        self.assertEqual(1, owner.idle)
+
+    def test_stats(self):
+        pool = self.make_pool(pool_size=1, max_overflow=1)
+        clients = [pool.checkout() for _ in range(4)]
+        pool.checkin(clients[0], discard=True)
+
+        stats = pool.stats()
+        self.assertEqual(3, len(stats['hosts']))
+        self.assertEqual(3, stats['checkedout'])
+        self.assertEqual(4, stats['connects'])
+        self.assertEqual({'error': 1}, stats['discards'])
+        self.assertEqual(1, stats['pool_size'])
+        self.assertEqual(3, sum(s['checkedout']
+                                for s in stats['hosts'].values()))
+
+    def test_routes_around_dead_broker(self):
+        breakers = dict((address, CircuitBreaker(lambda: False, threshold=2,
+                                                 backoff=60,
+                                                 max_backoff=60))
+                        for address in self.hosts)
+        pool = self.make_pool(pool_size=1, max_overflow=5, breakers=breakers)
+        dead = self.hosts[0]
+        self.brokers[0].stop()
+
+        clients = [pool.checkout() for _ in range(12)]
+        self.assertFalse(any((c.host, c.port) == dead for c in clients))
+        self.assertFalse(breakers[dead].healthy)
+        self.assertFalse(pool.stats()['hosts']['%s:%s' % dead]['healthy'])
+
+        # once tripped, the dead broker is not even tried anymore
+        failures = breakers[dead].failures
+        for client in clients:
+            pool.checkin(client)
+        for _ in range(6):
+            pool.checkin(pool.checkout())
+        self.assertEqual(failures, breakers[dead].failures)
+
+    def test_discard_trips_breaker(self):
+        breakers = dict((address, CircuitBreaker(lambda: False, threshold=1,
+                                                 backoff=60,
+                                                 max_backoff=60))
+                        for address in self.hosts)
+        pool = self.make_pool(pool_size=2, max_overflow=0, breakers=breakers)
+        pool.prefill(setup=lambda client: client.mns.open_namespace('test'))
+        client = pool.checkout()
+        address = (client.host, client.port)
+        idle = list(pool.pools[address]._q.queue)
+        self.assertEqual(1, len(idle))
+        handler = self.brokers[self.hosts.index(address)].handler
+        opened = len(handler.namespaces)
+
+        pool.checkin(client, discard=True)
+        self.assertFalse(breakers[address].healthy)
+        # the other idle connection to the broker was dropped as well,
+        # without closing its namespace over the dead connection
+        self.assertEqual(0, pool.pools[address].size)
+        self.assertFalse(any(c.is_active for c in idle))
+        self.assertEqual(opened, len(handler.namespaces))
+
+    def test_old_connection_does_not_recover_breaker(self):
+        breakers = dict((address, CircuitBreaker(lambda: False, threshold=1,
+                                                 backoff=60,
+                                                 max_backoff=60))
+                        for address in self.hosts)
+        pool = self.make_pool(pool_size=1, max_overflow=5, breakers=breakers)
+        client = pool.checkout()
+        address = (client.host, client.port)
+        other = pool.pools[address].checkout()
+
+        pool.checkin(other, discard=True)
+        self.assertFalse(breakers[address].healthy)
+        # checked out before the trip, returned cleanly after it
+        pool.checkin(client)
+        self.assertFalse(breakers[address].healthy)
+
+    def test_all_brokers_down(self):
+        pool = self.make_pool(pool_size=1, max_overflow=0)
+        for broker in self.brokers:
+            broker.stop()
+        self.assertRaises(Exception, pool.checkout)
+        self.assertEqual(0, pool.size)
+
+    def test_prefill_and_dispose(self):
+        pool = self.make_pool(pool_size=2, max_overflow=0)
+        self.assertEqual(6, pool.prefill())
+        self.assertEqual(6, pool.idle)
+        self.assertEqual(None, pool.dispose())
+        self.assertEqual(0, pool.size)
+
+
+def suite():
+    from .helpers import setup_path
+    setup_path()
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase))
+    suite.addTest(unittest.makeSuite(BalancedPoolTestCase))
+    return suite
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `scanner` module."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import gc
+
+from hyperthrift.gen.ttypes import Cell, ClientException, Key
+
+from ..flask_hypertable import ManagedThriftClient
+
+from . import unittest
+from .helpers import StandInBroker
+from .pool import wait_for
+
+
+def make_cells(n):
+    return [Cell(key=Key(row=str('row%03d' % i), column_family=str('cf')),
+                 value=str(i)) for i in range(n)]
+
+
+class ScannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.handler = self.broker.handler
+        self.handler.tables['foo'] = make_cells(7)
+        self.client = ManagedThriftClient(self.broker.host, self.broker.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.stop()
+
+    def rows(self, cells):
+        return [cell.key.row for cell in cells]
+
+    def test_scan(self):
+        with self.client.scan('test', 'foo') as cells:
+            self.assertEqual(self.rows(make_cells(7)), self.rows(cells))
+        self.assertEqual({}, self.handler.scanners)
+
+    def test_exhausted_closes(self):
+        cells = self.client.scan(self.client.mns['test'], 'foo')
+        self.assertEqual(7, len(list(cells)))
+        self.assertTrue(cells.closed)
+        self.assertEqual({}, self.handler.scanners)
+
+    def test_batches(self):
+        scanner = self.client.scan('test', 'foo')
+        self.assertEqual([2, 2, 2, 1],
+                         [len(batch) for batch in scanner.batches()])
+
+    def test_early_close(self):
+        with self.client.scan('test', 'foo') as cells:
+            for cell in cells:
+                break
+        self.assertEqual({}, self.handler.scanners)
+        # the connection is still usable
+        self.assertTrue(self.client.ping())
+        cells.close()
+
+    def test_missing_table(self):
+        self.assertRaises(ClientException, self.client.scan, 'test', 'bar')
+
+    def test_prefetch(self):
+        with self.client.scan('test', 'foo', prefetch=True) as cells:
+            self.assertEqual(self.rows(make_cells(7)), self.rows(cells))
+        self.assertEqual({}, self.handler.scanners)
+        # on a dedicated connection, which was closed
+        self.assertEqual(2, self.broker.accepted)
+        wait_for(lambda: self.broker.active == 1)
+
+    def test_prefetch_ahead(self):
+        scanner = self.client.scan('test', 'foo', prefetch=2)
+        # the thread fetches two batches, then waits for the caller
+        wait_for(lambda: scanner._queue.full())
+        self.assertEqual([2, 2, 2, 1],
+                         [len(batch) for batch in scanner.batches()])
+
+    def test_prefetch_early_close(self):
+        self.handler.tables['foo'] = make_cells(100)
+        with self.client.scan('test', 'foo', prefetch=1) as cells:
+            for i, cell in enumerate(cells):
+                if i == 3:
+                    break
+        self.assertFalse(cells._thread.is_alive())
+        self.assertEqual({}, self.handler.scanners)
+        wait_for(lambda: self.broker.active == 1)
+
+    def test_prefetch_abandoned(self):
+        self.handler.tables['foo'] = make_cells(100)
+        scanner = self.client.scan('test', 'foo', prefetch=1)
+        thread = scanner._thread
+        del scanner
+        gc.collect()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual({}, self.handler.scanners)
+
+    def test_prefetch_error(self):
+        scanner = self.client.scan('test', 'foo', prefetch=True)
+        # the broker loses the scanner halfway
+        wait_for(lambda: scanner._queue.full())
+        with self.handler.lock:
+            self.handler.scanners.clear()
+        batches = scanner.batches()
+        next(batches)
+        self.assertRaises(ClientException, list, batches)
+        self.assertTrue(scanner.closed)
+
+    def test_prefetch_namespace_by_id(self):
+        ns = self.client.mns['test']
+        with self.client.scan(ns, 'foo', prefetch=True) as cells:
+            self.assertEqual(7, len(list(cells)))
+        self.assertRaises(ValueError, self.client.scan, ns + 100, 'foo',
+                          prefetch=True)
+
+    def test_clone(self):
+        client = self.client.clone()
+        try:
+            self.assertFalse(client is self.client)
+            self.assertEqual(self.client.timeout_ms, client.timeout_ms)
+            self.assertTrue(client.ping())
+        finally:
+            client.close()
+
+
+def suite():
+    from .helpers import setup_path
+    setup_path()
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ScannerTestCase))
+    return suite
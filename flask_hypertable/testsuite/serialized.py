@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `serialized` module."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+from struct import pack
+
+from hyperthrift.gen.ttypes import Cell, Key, KeyFlag, ScanSpec
+
+from .. import serialized
+from ..flask_hypertable import ManagedThriftClient
+from ..serialized import SerializedCellsReader, SerializedCellsWriter, \
+    AUTO_ASSIGN
+
+from . import unittest
+from .helpers import StandInBroker
+
+
+def encode(cells, eos=False):
+    """ a straightforward encoder of ``(row, cf, cq, timestamp, revision,
+    flag, value)`` tuples, as Hypertable's SerializedCellsWriter """
+    out = [pack(str('<i'), serialized.SCVERSION)]
+    previous = None
+    for row, cf, cq, timestamp, revision, flag, value in cells:
+        cell_flag = 0
+        fields = []
+        if timestamp == AUTO_ASSIGN:
+            cell_flag |= serialized.AUTO_TIMESTAMP
+        elif timestamp is not None:
+            cell_flag |= serialized.HAVE_TIMESTAMP
+            fields.append(pack(str('<q'), timestamp))
+        if revision is not None:
+            cell_flag |= serialized.HAVE_REVISION
+            if revision == timestamp:
+                cell_flag |= serialized.REV_IS_TS
+            else:
+                fields.append(pack(str('<q'), revision))
+        out.append(pack(str('B'), cell_flag))
+        out.extend(fields)
+        out.append(b'\0' if row == previous else row + b'\0')
+        previous = row
+        out.append(cf + b'\0' + cq + b'\0')
+        out.append(pack(str('<i'), len(value)) + value)
+        out.append(pack(str('B'), flag))
+    out.append(pack(str('B'), serialized.EOB |
+                    (serialized.EOS if eos else 0)))
+    return b''.join(out)
+
+
+CELLS = [
+    (b'r1', b'cf', b'a', 1396000000000000001, 7, 255, b'v1'),
+    (b'r1', b'cf', b'b', 1396000000000000002, 1396000000000000002, 255,
+     b''),
+    (b'r2', b'other', b'', None, None, 255, b'\0binary\xff'),
+    (b'r3', b'cf', b'', AUTO_ASSIGN, None, 2, b''),
+    (b'r3', b'cf', b'q', -5, 0, 255, b'x' * 1000),
+]
+
+#: four cells laid out by hand as Hypertable's SerializedCellsWriter
+#: does, independently of the module's constants
+GOLDEN = (
+    # SCVERSION, little endian
+    b'\x01\x00\x00\x00'
+    # HAVE_TIMESTAMP | HAVE_REVISION, the timestamp and the revision
+    b'\xc0'
+    b'\x08\x07\x06\x05\x04\x03\x02\x01'
+    b'\x18\x17\x16\x15\x14\x13\x12\x11'
+    # row, column family, qualifier, value length and value, flag
+    b'r1\x00' b'cf\x00' b'a\x00' b'\x02\x00\x00\x00' b'v1' b'\xff'
+    # HAVE_TIMESTAMP | HAVE_REVISION | REV_IS_TS, the row is repeated
+    b'\xd0'
+    b'\x05\x00\x00\x00\x00\x00\x00\x00'
+    b'\x00' b'cf\x00' b'b\x00' b'\x00\x00\x00\x00' b'\xff'
+    # AUTO_TIMESTAMP, a DELETE_ROW
+    b'\x20'
+    b'r2\x00' b'cf\x00' b'\x00' b'\x00\x00\x00\x00' b'\x00'
+    # neither timestamp nor revision
+    b'\x00'
+    b'r3\x00' b'cf\x00' b'q\x00' b'\x03\x00\x00\x00' b'xyz' b'\xff'
+    # EOB | EOS
+    b'\x03')
+
+GOLDEN_CELLS = [
+    (b'r1', b'cf', b'a', 0x0102030405060708, 0x1112131415161718, 255,
+     b'v1'),
+    (b'r1', b'cf', b'b', 5, 5, 255, b''),
+    (b'r2', b'cf', b'', AUTO_ASSIGN, None, 0, b''),
+    (b'r3', b'cf', b'q', None, None, 255, b'xyz'),
+]
+
+
+class SerializedCellsReaderTestCase(unittest.TestCase):
+
+    def test_golden(self):
+        reader = SerializedCellsReader(GOLDEN)
+        self.assertEqual(GOLDEN_CELLS, [tuple(cell) for cell in reader])
+        self.assertTrue(reader.eos)
+
+    def test_round_trip(self):
+        reader = SerializedCellsReader(encode(CELLS))
+        self.assertEqual(CELLS, [tuple(cell) for cell in reader])
+        self.assertFalse(reader.eos)
+
+    def test_fields(self):
+        cell = next(iter(SerializedCellsReader(encode(CELLS))))
+        self.assertEqual(b'r1', cell.row)
+        self.assertEqual(b'cf', cell.column_family)
+        self.assertEqual(b'a', cell.column_qualifier)
+        self.assertEqual(1396000000000000001, cell.timestamp)
+        self.assertEqual(7, cell.revision)
+        self.assertEqual(255, cell.flag)
+        self.assertEqual(b'v1', cell.value)
+
+    def test_repeated_row_is_shared(self):
+        first, second = list(SerializedCellsReader(encode(CELLS[:2])))
+        self.assertTrue(first.row is second.row)
+
+    def test_eos(self):
+        reader = SerializedCellsReader(encode(CELLS, eos=True))
+        self.assertEqual(5, len(list(reader)))
+        self.assertTrue(reader.eos)
+
+    def test_lazy(self):
+        buf = encode(CELLS)
+        # the cells before a corruption are still yielded
+        cells = iter(SerializedCellsReader(buf[:-20]))
+        self.assertEqual(CELLS[0], tuple(next(cells)))
+        self.assertRaises(ValueError, list, cells)
+
+    def test_memoryview_values(self):
+        buf = encode(CELLS)
+        cells = list(SerializedCellsReader(buf, copy_values=False))
+        self.assertTrue(isinstance(cells[0].value, memoryview))
+        self.assertEqual([c[6] for c in CELLS],
+                         [cell.value.tobytes() for cell in cells])
+
+    def test_buffer_values(self):
+        # as on Python 2.6, which has no memoryview
+        serialized._HAS_MEMORYVIEW = False
+        try:
+            buf = encode(CELLS)
+            cells = list(SerializedCellsReader(buf, copy_values=False))
+        finally:
+            serialized._HAS_MEMORYVIEW = True
+        self.assertTrue(isinstance(cells[0].value, buffer))
+        self.assertEqual([c[6] for c in CELLS],
+                         [bytes(cell.value) for cell in cells])
+
+    def test_bytearray(self):
+        reader = SerializedCellsReader(bytearray(encode(CELLS)))
+        self.assertEqual(CELLS, [tuple(cell) for cell in reader])
+
+    def test_memoryview(self):
+        reader = SerializedCellsReader(memoryview(encode(CELLS)))
+        self.assertEqual(CELLS, [tuple(cell) for cell in reader])
+        reader = SerializedCellsReader(buffer(encode(CELLS)))
+        self.assertEqual(CELLS, [tuple(cell) for cell in reader])
+
+    def test_empty(self):
+        self.assertEqual([], list(SerializedCellsReader(b'')))
+        self.assertEqual([], list(SerializedCellsReader(encode([]))))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, list, SerializedCellsReader(b'\1\0'))
+        self.assertRaises(ValueError, list,
+                          SerializedCellsReader(pack(str('<i'), 2) + b'\1'))
+        # starts with an empty row
+        buf = encode(CELLS[:1])
+        self.assertRaises(ValueError, list,
+                          SerializedCellsReader(buf[:5] + b'\0' + buf[8:]))
+        for cut in range(5, len(buf) - 1):
+            self.assertRaises(ValueError, list,
+                              SerializedCellsReader(buf[:cut]))
+
+
+def write(cells):
+    writer = SerializedCellsWriter()
+    for row, cf, cq, timestamp, revision, flag, value in cells:
+        writer.add(row, cf, cq, value, timestamp, revision, flag)
+    return writer
+
+
+class SerializedCellsWriterTestCase(unittest.TestCase):
+
+    def test_golden(self):
+        writer = write(GOLDEN_CELLS)
+        writer.finalize(serialized.EOS)
+        self.assertEqual(GOLDEN, writer.getvalue())
+
+    def test_round_trip(self):
+        buf = write(CELLS).getvalue()
+        self.assertEqual(CELLS,
+                         [tuple(cell) for cell in SerializedCellsReader(buf)])
+
+    def test_defaults(self):
+        writer = SerializedCellsWriter()
+        writer.add('row', 'cf')
+        writer.add(u'r\xe9', u'cf', u'q', value=None)
+        cells = list(SerializedCellsReader(writer.getvalue()))
+        self.assertEqual((b'row', b'cf', b'', None, None, KeyFlag.INSERT,
+                          b''), tuple(cells[0]))
+        self.assertEqual(u'r\xe9'.encode('utf-8'), cells[1].row)
+        self.assertEqual(b'', cells[1].value)
+        self.assertEqual(2, len(writer))
+
+    def test_add_cell(self):
+        writer = SerializedCellsWriter()
+        writer.add_cell(Cell(key=Key(row=b'r', column_family=b'cf',
+                                     timestamp=5),
+                             value=b'v'))
+        writer.add_cell(Cell(key=Key(row=b'r', column_family=b'cf',
+                                     flag=KeyFlag.DELETE_ROW)))
+        cells = list(SerializedCellsReader(writer.getvalue()))
+        self.assertEqual([(b'r', b'cf', b'', 5, None, 255, b'v'),
+                          (b'r', b'cf', b'', None, None, 0, b'')],
+                         [tuple(cell) for cell in cells])
+
+        again = SerializedCellsWriter()
+        for cell in cells:
+            again.add_cell(cell)
+        self.assertEqual(writer.getvalue(), again.getvalue())
+
+    def test_extend(self):
+        writer = write(GOLDEN_CELLS[:2])
+        writer.extend(write(GOLDEN_CELLS[2:]))
+        writer.extend(SerializedCellsWriter())
+        writer.finalize(serialized.EOS)
+        self.assertEqual(GOLDEN, writer.getvalue())
+        self.assertEqual(4, len(writer))
+
+        # the next cell may repeat the last row appended
+        writer = SerializedCellsWriter()
+        writer.extend(write(GOLDEN_CELLS[:1]))
+        for row, cf, cq, timestamp, revision, flag, value in \
+                GOLDEN_CELLS[1:]:
+            writer.add(row, cf, cq, value, timestamp, revision, flag)
+        writer.finalize(serialized.EOS)
+        self.assertEqual(GOLDEN, writer.getvalue())
+
+        other = write(GOLDEN_CELLS)
+        self.assertRaises(ValueError, writer.extend, other)
+        other.finalize()
+        self.assertRaises(ValueError, SerializedCellsWriter().extend, other)
+
+    def test_finalize(self):
+        writer = write(CELLS)
+        writer.finalize(serialized.EOS)
+        reader = SerializedCellsReader(writer.getvalue())
+        self.assertEqual(5, len(list(reader)))
+        self.assertTrue(reader.eos)
+        self.assertRaises(ValueError, writer.add, b'r', b'cf')
+
+        writer.clear()
+        self.assertEqual(0, len(writer))
+        self.assertEqual(encode([]), writer.getvalue())
+
+    def test_invalid(self):
+        writer = SerializedCellsWriter()
+        self.assertRaises(ValueError, writer.add, b'', b'cf')
+        self.assertRaises(ValueError, writer.add, b'r\0w', b'cf')
+        self.assertRaises(ValueError, writer.add, b'row', b'c\0f')
+        self.assertEqual(0, len(writer))
+
+
+class SerializedRPCTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.client = ManagedThriftClient(self.broker.host, self.broker.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.stop()
+
+    def test_set_and_scan(self):
+        ns = self.client.mns['test']
+        self.client.set_cells_serialized(ns, 'foo', write(CELLS).getvalue())
+
+        scanner = self.client.scanner_open(ns, 'foo', ScanSpec())
+        cells = []
+        while True:
+            reader = SerializedCellsReader(
+                self.client.scanner_get_cells_serialized(scanner))
+            cells.extend(tuple(cell) for cell in reader)
+            if reader.eos:
+                break
+        self.client.scanner_close(scanner)
+        self.assertEqual(CELLS, cells)
+
+
+def suite():
+    from .helpers import setup_path
+    setup_path()
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SerializedCellsReaderTestCase))
+    suite.addTest(unittest.makeSuite(SerializedCellsWriterTestCase))
+    suite.addTest(unittest.makeSuite(SerializedRPCTestCase))
+    return suite
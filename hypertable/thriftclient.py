@@ -2,23 +2,290 @@ from thrift import Thrift
 from thrift.transport import TSocket
 from thrift.transport import TTransport
 from thrift.protocol import TBinaryProtocol
+try:
+  from thrift.protocol import fastbinary
+except ImportError:
+  fastbinary = None
 
+from hyperthrift.gen import ttypes
 from hyperthrift.gen2 import HqlService
 
+from cStringIO import StringIO
+from struct import pack, unpack_from
+import socket
 import traceback
 
+def _fastbinary_works():
+  """
+  The generated hyperthrift code hands tuples to fastbinary, which the
+  C extension of thrift 0.10 and later rejects, so try a round trip.
+  """
+  if fastbinary is None:
+    return False
+  try:
+    buf = TTransport.TMemoryBuffer()
+    ttypes.Key(row='r', timestamp=1).write(
+        TBinaryProtocol.TBinaryProtocolAccelerated(buf))
+    key = ttypes.Key()
+    key.read(TBinaryProtocol.TBinaryProtocolAccelerated(
+        TTransport.TMemoryBuffer(buf.getvalue())))
+    return key.row == 'r' and key.timestamp == 1
+  except Exception:
+    return False
+
+# whether the fastbinary C extension can decode the hyperthrift structs
+ACCELERATED = _fastbinary_works()
+
+# TFramedRecvTransport needs python 2.7
+try:
+  memoryview
+  _HAS_MEMORYVIEW = True
+except NameError:
+  _HAS_MEMORYVIEW = False
+
+# the options understood by TTunedSocket
+SOCKET_OPTIONS = ('nodelay', 'keepalive', 'keepalive_idle',
+                  'keepalive_interval', 'keepalive_count', 'rcvbuf', 'sndbuf')
+
+def check_socket_options(options):
+  unknown = set(options or ()) - set(SOCKET_OPTIONS)
+  if unknown:
+    raise ValueError('unknown socket options: %s'
+                     % ', '.join(sorted(unknown)))
+
+class TTunedSocket(TSocket.TSocket):
+  """
+  A TSocket with separate connect and read timeouts, which applies the
+  given options once connected:
+
+    nodelay: TCP_NODELAY, sends small requests without Nagle's delay
+    keepalive: SO_KEEPALIVE, keeps idle pooled sockets alive
+    keepalive_idle, keepalive_interval, keepalive_count: TCP_KEEPIDLE,
+      TCP_KEEPINTVL and TCP_KEEPCNT in seconds, where the platform has
+      them
+    rcvbuf, sndbuf: SO_RCVBUF and SO_SNDBUF in bytes
+
+  Options left out, or set to None, keep the system defaults. Over a
+  unix_socket, the TCP level ones are ignored.
+  """
+
+  _tcp_options = (('keepalive_idle', 'TCP_KEEPIDLE'),
+                  ('keepalive_interval', 'TCP_KEEPINTVL'),
+                  ('keepalive_count', 'TCP_KEEPCNT'))
+
+  def __init__(self, host, port, connect_timeout_ms = None,
+               timeout_ms = None, options = None, unix_socket = None):
+    TSocket.TSocket.__init__(self, host, port, unix_socket)
+    check_socket_options(options)
+    self.options = dict(options or {})
+    self.connect_timeout_ms = connect_timeout_ms
+    self.timeout_ms = timeout_ms
+    self.setTimeout(timeout_ms)
+
+  def open(self):
+    self.setTimeout(self.connect_timeout_ms)
+    try:
+      TSocket.TSocket.open(self)
+    finally:
+      self.setTimeout(self.timeout_ms)
+    try:
+      self._set_options(self.handle)
+    except socket.error as e:
+      self.close()
+      raise TTransport.TTransportException(
+          TTransport.TTransportException.NOT_OPEN,
+          'Could not set socket options: %s' % e)
+
+  def _set_options(self, handle):
+    options = self.options
+    tcp = handle.family != getattr(socket, 'AF_UNIX', None)
+
+    if tcp and options.get('nodelay') is not None:
+      handle.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                        int(bool(options['nodelay'])))
+    if options.get('keepalive') is not None:
+      handle.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE,
+                        int(bool(options['keepalive'])))
+    for name, const in self._tcp_options:
+      if tcp and options.get(name) is not None and hasattr(socket, const):
+        handle.setsockopt(socket.IPPROTO_TCP, getattr(socket, const),
+                          int(options[name]))
+    if options.get('rcvbuf') is not None:
+      handle.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        int(options['rcvbuf']))
+    if options.get('sndbuf') is not None:
+      handle.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                        int(options['sndbuf']))
+
+class TFramedRecvTransport(TTransport.TTransportBase,
+                           TTransport.CReadableTransport):
+  """
+  A TFramedTransport over a TSocket which receives each frame with
+  recv_into into a bytearray kept across frames. The protocol decoders
+  read straight from that buffer instead of from a fresh string per
+  frame, so large responses are not copied on their way to fastbinary.
+
+  Frames larger than max_buffer bytes get a buffer of their own which
+  is released with the frame.
+  """
+
+  def __init__(self, socket, max_buffer = 4 << 20):
+    self.socket = socket
+    self.max_buffer = max_buffer
+    self.allocations = 0
+    self._header = bytearray(4)
+    self._buf = None
+    self._rbuf = StringIO('')
+    self._wbuf = StringIO()
+    self._corked = None
+
+  def isOpen(self):
+    return self.socket.isOpen()
+
+  def open(self):
+    return self.socket.open()
+
+  def close(self):
+    self._rbuf = StringIO('')
+    return self.socket.close()
+
+  def _recv_into(self, buf, size):
+    handle = self.socket.handle
+    if handle is None:
+      raise TTransport.TTransportException(
+          TTransport.TTransportException.NOT_OPEN, 'Transport not open')
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+      n = handle.recv_into(view[got:size], size - got)
+      if n == 0:
+        raise TTransport.TTransportException(
+            TTransport.TTransportException.END_OF_FILE,
+            'TSocket read 0 bytes')
+      got += n
+
+  def readFrame(self):
+    self._recv_into(self._header, 4)
+    size, = unpack_from('!i', self._header)
+    if size < 0:
+      raise TTransport.TTransportException(
+          TTransport.TTransportException.UNKNOWN,
+          'Invalid frame size %d' % size)
+    buf = self._buf
+    if buf is None or len(buf) < size:
+      # never resized in place, an older frame may still point into it
+      buf = bytearray(max(size, 4096))
+      self.allocations += 1
+      if size <= self.max_buffer:
+        self._buf = buf
+    self._recv_into(buf, size)
+    self._rbuf = StringIO(buffer(buf, 0, size))
+
+  def read(self, sz):
+    ret = self._rbuf.read(sz)
+    if len(ret) != 0:
+      return ret
+    self.readFrame()
+    return self._rbuf.read(sz)
+
+  def write(self, buf):
+    self._wbuf.write(buf)
+
+  def flush(self):
+    wout = self._wbuf.getvalue()
+    self._wbuf = StringIO()
+    frame = pack('!i', len(wout)) + wout
+    if self._corked is not None:
+      self._corked.append(frame)
+      return
+    self.socket.write(frame)
+    self.socket.flush()
+
+  def cork(self):
+    """ holds back the flushed frames until uncork() """
+    if self._corked is None:
+      self._corked = []
+
+  def uncork(self, send = True):
+    """
+    sends the held back frames with a single write, or with send=False
+    drops them along with any partly written message
+    """
+    frames, self._corked = self._corked, None
+    if not send:
+      self._wbuf = StringIO()
+    elif frames:
+      self.socket.write(''.join(frames))
+      self.socket.flush()
+
+  # CReadableTransport, used by fastbinary
+  @property
+  def cstringio_buf(self):
+    return self._rbuf
+
+  def cstringio_refill(self, prefix, reqlen):
+    # a message spanning several frames, rare enough to be copied. The
+    # prefix is what is left of the current frame, which is kept so that
+    # the buffer still starts with the reply for rewind()
+    frames = [self._rbuf.getvalue()]
+    start = len(frames[0]) - len(prefix)
+    got = len(prefix)
+    while got < reqlen:
+      self.readFrame()
+      frames.append(self._rbuf.getvalue())
+      got += len(frames[-1])
+    self._rbuf = StringIO(''.join(frames))
+    self._rbuf.seek(start)
+    return self._rbuf
+
+  def rewind(self):
+    """
+    goes back to the start of the reply being read, which is the start
+    of the read buffer since the server sends each reply in a frame of
+    its own
+    """
+    self._rbuf.seek(0)
+
 class ThriftClient(HqlService.Client):
-  def __init__(self, host, port, timeout_ms = 300000, do_open = 1):
+  def __init__(self, host, port, timeout_ms = 300000, do_open = 1,
+               accelerated = True, connect_timeout_ms = None,
+               socket_options = None, unix_socket = None):
+    """
+    timeout_ms bounds each read, connect_timeout_ms (by default the
+    same) the connect, socket_options are passed to TTunedSocket.
+    With unix_socket, connects to that socket file instead of host:port.
+    """
+    self.host = host
+    self.port = port
+    self.unix_socket = unix_socket
     self.timeout_ms = timeout_ms
-    socket = TSocket.TSocket(host, port)
-    socket.setTimeout(timeout_ms)
-    self.transport = TTransport.TFramedTransport(socket)
-    protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+    if connect_timeout_ms is None:
+      connect_timeout_ms = timeout_ms
+    self.connect_timeout_ms = connect_timeout_ms
+    self.socket_options = socket_options
+    # decoding again after an OverflowError needs TFramedRecvTransport
+    self.accelerated = bool(accelerated and ACCELERATED and _HAS_MEMORYVIEW)
+    sock = TTunedSocket(host, port, connect_timeout_ms, timeout_ms,
+                        socket_options, unix_socket)
+    if _HAS_MEMORYVIEW:
+      self.transport = TFramedRecvTransport(sock)
+    else:
+      self.transport = TTransport.TFramedTransport(sock)
+    self._python_protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+    if self.accelerated:
+      protocol = TBinaryProtocol.TBinaryProtocolAccelerated(self.transport)
+    else:
+      protocol = self._python_protocol
     HqlService.Client.__init__(self, protocol)
 
     if do_open:
       self.open(timeout_ms)
 
+  @property
+  def codec(self):
+    """ 'fastbinary' if the C extension decodes the responses """
+    return self.accelerated and 'fastbinary' or 'python'
+
   @property
   def is_active(self):
     return self.do_close == 1
@@ -45,3 +312,31 @@ class ThriftClient(HqlService.Client):
         return True
     finally:
         self.close()
+
+def _decode_fallback(recv):
+  """
+  fastbinary of thrift 0.9 refuses containers of more than 10000 items,
+  such responses are decoded again in python, from the start of the
+  buffered reply
+  """
+  def wrapper(self):
+    try:
+      return recv(self)
+    except OverflowError:
+      if not self.accelerated:
+        raise
+      self.transport.rewind()
+      iprot = self._iprot
+      self._iprot = self._python_protocol
+      try:
+        return recv(self)
+      finally:
+        self._iprot = iprot
+  wrapper.__name__ = recv.__name__
+  return wrapper
+
+for _name in dir(HqlService.Client):
+  if _name.startswith('recv_'):
+    setattr(ThriftClient, _name,
+            _decode_fallback(getattr(HqlService.Client, _name)))
+del _name